@@ -0,0 +1,82 @@
+import sys
+import os
+import time
+import json
+import argparse
+import tempfile
+import numpy as np
+import rasterio as rio
+from rasterio.windows import Window
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from ndvi_image_functions import stream_ndvi_image, NDVI_CODECS
+from make_fixtures import synthetic_band, write_band, ORIGIN_X, ORIGIN_Y
+
+def random_window_latency(path, window_size, reads, seed=0):
+    rng = np.random.default_rng(seed)
+    latencies = []
+    with rio.Env(GDAL_CACHEMAX=1):
+        with rio.open(path) as dataset:
+            for _ in range(reads):
+                col = int(rng.integers(0, dataset.width - window_size))
+                row = int(rng.integers(0, dataset.height - window_size))
+                start = time.perf_counter()
+                dataset.read(1, window=Window(col, row, window_size, window_size))
+                latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies)), float(np.percentile(latencies, 95))
+
+def preview_latency(path, factor=16):
+    with rio.Env(GDAL_CACHEMAX=1):
+        with rio.open(path) as dataset:
+            start = time.perf_counter()
+            dataset.read(1, out_shape=(dataset.height // factor, dataset.width // factor))
+            return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare NDVI output codecs and layouts on file size and read latency')
+    parser.add_argument('--size', type=int, default=4096, help='Scene width and height in pixels (default: 4096)')
+    parser.add_argument('--window', type=int, default=256, help='Random window size in pixels (default: 256)')
+    parser.add_argument('--reads', type=int, default=200, help='Random window reads per file (default: 200)')
+    parser.add_argument('--json', metavar='results_file', type=str, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        red_path = os.path.join(work_dir, 'SCENE_B4.TIF')
+        nir_path = os.path.join(work_dir, 'SCENE_B5.TIF')
+        write_band(red_path, synthetic_band(args.size, 4, 500, 4000), 32611, ORIGIN_X, ORIGIN_Y)
+        write_band(nir_path, synthetic_band(args.size, 5, 1500, 6000), 32611, ORIGIN_X, ORIGIN_Y)
+
+        for cog in (False, True):
+            for codec in NDVI_CODECS:
+                name = f"{codec.lower()}_{'cog' if cog else 'strip'}"
+                start = time.perf_counter()
+                if not stream_ndvi_image(red_path, nir_path, name, work_dir, quality='60', codec=codec, cog=cog):
+                    continue
+                write_seconds = time.perf_counter() - start
+
+                path = os.path.join(work_dir, name + '.tif')
+                median_read, p95_read = random_window_latency(path, args.window, args.reads)
+                results.append({
+                    'codec': codec,
+                    'layout': 'cog' if cog else 'stripped',
+                    'size_mb': os.path.getsize(path) / 1e6,
+                    'write_s': write_seconds,
+                    'window_read_median_ms': median_read * 1000,
+                    'window_read_p95_ms': p95_read * 1000,
+                    'preview_ms': preview_latency(path) * 1000
+                })
+
+    print(f"{args.size} x {args.size} scene, {args.window} x {args.window} random windows")
+    print(f"{'codec':>8} {'layout':>9} {'size MB':>9} {'write s':>8} {'read ms':>8} {'p95 ms':>8} {'preview ms':>11}")
+    for result in results:
+        print(f"{result['codec']:>8} {result['layout']:>9} {result['size_mb']:9.2f} {result['write_s']:8.2f} "
+              f"{result['window_read_median_ms']:8.2f} {result['window_read_p95_ms']:8.2f} {result['preview_ms']:11.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'size': args.size, 'window': args.window, 'results': results}, file, indent=2)
+
+if __name__ == '__main__':
+    main()
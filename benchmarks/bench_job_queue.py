@@ -0,0 +1,71 @@
+import sys
+import os
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+from glob import glob
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from make_fixtures import make_fixtures
+from job_queue_functions import JOB_QUEUE_FILE
+
+PROCESS_NDVI = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'process_ndvi.py')
+
+#Starts `workers` separate process_ndvi.py --queue processes at once, standing in for as many hosts, and waits for
+#all of them. Returns the wall time and checks that every scene was converted and recorded exactly once.
+def run_queue_workers(input_directory, output_directory, workers, codec):
+    shutil.rmtree(output_directory, ignore_errors=True)
+    os.makedirs(output_directory)
+    command = [sys.executable, PROCESS_NDVI, '-i', input_directory, '-o', output_directory, '--queue', '--workers', '1', '--codec', codec, '-q']
+    start = time.perf_counter()
+    processes = [subprocess.Popen(command) for _ in range(workers)]
+    codes = [process.wait() for process in processes]
+    seconds = time.perf_counter() - start
+    if any(codes):
+        raise RuntimeError(f"Queue workers exited with {codes}")
+
+    scenes = len(glob(os.path.join(input_directory, '*', '*_B4.TIF')))
+    recorded = 0
+    for manifest_path in glob(os.path.join(output_directory, '*', 'manifest.json')):
+        with open(manifest_path) as file:
+            recorded += len(json.load(file)['scenes'])
+    connection = sqlite3.connect(os.path.join(output_directory, JOB_QUEUE_FILE))
+    try:
+        left = connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+    finally:
+        connection.close()
+    if recorded != scenes or left:
+        raise RuntimeError(f"{recorded} of {scenes} scenes recorded, {left} jobs left in the queue")
+    return {'workers': workers, 'wall_s': seconds, 'scenes': scenes, 'scenes_per_s': scenes / seconds}
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure how conversion throughput scales with the number of cooperating --queue workers')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='Worker process counts to run (default: 1 2 4)')
+    parser.add_argument('--scenes', type=int, default=8, help='Scenes per date (default: 8)')
+    parser.add_argument('--dates', type=int, default=3, help='Number of date folders (default: 3)')
+    parser.add_argument('--size', type=int, default=2048, help='Scene width and height in pixels (default: 2048)')
+    parser.add_argument('--codec', type=str, default='JPEG', help='Codec of the NDVI images (default: JPEG)')
+    parser.add_argument('--json', metavar='results_file', type=str, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        fixtures = make_fixtures(os.path.join(work_dir, 'fixtures'), args.scenes, args.dates, args.size)
+        results = []
+        print(f"{'workers':>8} {'wall s':>8} {'scenes/s':>9} {'speedup':>8}")
+        for workers in args.workers:
+            result = run_queue_workers(fixtures['input_directory'], os.path.join(work_dir, 'output'), workers, args.codec)
+            result['speedup'] = results[0]['wall_s'] * results[0]['workers'] / result['wall_s'] if results else float(workers)
+            results.append(result)
+            print(f"{workers:>8} {result['wall_s']:8.2f} {result['scenes_per_s']:9.2f} {result['speedup']:8.2f}")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == '__main__':
+    main()
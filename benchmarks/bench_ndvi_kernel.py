@@ -0,0 +1,50 @@
+import sys
+import os
+import time
+import argparse
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from ndvi_kernel_functions import make_ndvi_kernel, ndvi_codes_reference, NUMBA_AVAILABLE
+
+def time_best(func, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the NDVI kernel against the original chain, single core')
+    parser.add_argument('--rows', type=int, default=256, help='Rows per chunk (default: 256)')
+    parser.add_argument('--cols', type=int, default=8000, help='Columns per chunk (default: 8000)')
+    parser.add_argument('--repeats', type=int, default=5, help='Repeats per backend, the best time is reported (default: 5)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    red = rng.integers(0, 20000, (args.rows, args.cols), dtype=np.uint16)
+    nir = rng.integers(0, 20000, (args.rows, args.cols), dtype=np.uint16)
+    red[:, :16] = 0
+    nir[:, :16] = 0
+    input_mb = (red.nbytes + nir.nbytes) / 1e6
+
+    expected = ndvi_codes_reference(red, nir)
+    results = {'original': time_best(lambda: ndvi_codes_reference(red, nir), args.repeats)}
+
+    backends = ['numpy'] + (['numba'] if NUMBA_AVAILABLE else [])
+    codes = np.empty(red.shape, dtype=np.uint8)
+    for backend in backends:
+        kernel = make_ndvi_kernel(red.shape, backend)
+        kernel(red, nir, codes)
+        if not np.array_equal(codes, expected):
+            raise RuntimeError(f"{backend}: output differs from the original chain in {np.count_nonzero(codes != expected)} pixels")
+        results[backend] = time_best(lambda: kernel(red, nir, codes), args.repeats)
+
+    print(f"{args.rows} x {args.cols} chunk, {input_mb:.1f} MB of red + NIR input")
+    for name, seconds in results.items():
+        print(f"{name:>10}: {input_mb / seconds:8.1f} MB/s per core  ({results['original'] / seconds:.1f}x)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import sys
+import os
+import time
+import json
+import argparse
+import subprocess
+import statistics
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SRC_DIR = os.path.join(REPO_DIR, 'src')
+
+#Libraries that cost a noticeable part of a second to import; the report lists which of them each path loaded
+HEAVY_MODULES = ['osgeo', 'rasterio', 'geopandas', 'rioxarray', 'xarray', 'zarr', 'pyarrow', 'pandas', 'shapely', 'pyproj', 'numba', 'unittest']
+
+# Each path runs in a fresh interpreter: a CLI script with its arguments (its --help is parsed after all the
+# module level imports), or a module imported on its own
+STARTUP_PATHS = {
+    'timeseries.py --help': ('script', 'timeseries.py', ['--help']),
+    'process_ndvi.py --help': ('script', 'process_ndvi.py', ['--help']),
+    'point and range queries': ('module', 'time_series_functions', []),
+    'query server': ('module', 'query_server', []),
+    'conversion': ('module', 'ndvi_image_functions', []),
+    'datacube': ('module', 'datacube_functions', []),
+}
+
+PROBE = '''
+import sys, json, runpy
+kind, target, args, heavy = json.loads(sys.argv[1])
+if kind == 'script':
+    sys.argv = [target] + args
+    try:
+        runpy.run_path(target, run_name='__main__')
+    except SystemExit:
+        pass
+else:
+    sys.path.append(%r)
+    __import__(target)
+sys.stderr.write('\\nLOADED ' + json.dumps([name for name in heavy if name in sys.modules]) + '\\n')
+''' % SRC_DIR
+
+def time_path(kind, target, args, repeats):
+    if kind == 'script':
+        target = os.path.join(REPO_DIR, target)
+    command = [sys.executable, '-c', PROBE, json.dumps([kind, target, args, HEAVY_MODULES])]
+    seconds = []
+    loaded = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = subprocess.run(command, capture_output=True, text=True, cwd=REPO_DIR)
+        seconds.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            raise RuntimeError(f"{target} failed to start:\n{result.stderr}")
+        loaded = json.loads(result.stderr.rsplit('LOADED ', 1)[1])
+    return statistics.median(seconds), loaded
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure interpreter startup and import time of the CLI and module code paths')
+    parser.add_argument('--repeats', type=int, default=5, help='Runs per path, the median is reported (default: 5)')
+    parser.add_argument('--json', metavar='results_file', type=str, help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    baseline, _ = time_path('module', 'log_config', [], args.repeats)
+    results = {'interpreter_ms': baseline * 1000, 'paths': {}}
+    print(f"{'path':>24} {'startup ms':>11}  heavy modules loaded")
+    print(f"{'bare interpreter':>24} {baseline * 1000:11.0f}")
+    for name, (kind, target, path_args) in STARTUP_PATHS.items():
+        seconds, loaded = time_path(kind, target, path_args, args.repeats)
+        results['paths'][name] = {'startup_ms': seconds * 1000, 'loaded': loaded}
+        print(f"{name:>24} {seconds * 1000:11.0f}  {', '.join(loaded) or '-'}")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == '__main__':
+    main()
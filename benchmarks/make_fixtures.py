@@ -0,0 +1,97 @@
+import os
+import json
+import argparse
+import datetime as date
+import numpy as np
+from osgeo import gdal, osr
+from pyproj import Transformer
+
+FIXTURES_FILE_NAME = 'fixtures.json'
+PIXEL_SIZE = 30
+#Upper left corner of the first scene, in UTM zone 11N near Los Angeles
+ORIGIN_X, ORIGIN_Y = 380000, 3790000
+
+#Smooth, field-like reflectance with sensor noise, in Landsat Collection 2 DN range
+def synthetic_band(size, seed, low, high):
+    rng = np.random.default_rng(seed)
+    coarse = rng.uniform(low, high, (size // 64 + 1, size // 64 + 1))
+    field = np.kron(coarse, np.ones((64, 64)))[:size, :size]
+    field += rng.normal(0, (high - low) * 0.02, (size, size))
+    return np.clip(field, 1, 65535).astype(np.uint16)
+
+#Landsat scenes are tilted inside their grid, so every row starts and ends with a run of 0 fill
+def add_fill_border(array, seed):
+    size = array.shape[0]
+    rng = np.random.default_rng(seed)
+    margin = size // 8
+    left = (np.linspace(margin, 0, size) + rng.integers(0, 4, size)).astype(int)
+    right = (np.linspace(size - 1, size - margin, size) - rng.integers(0, 4, size)).astype(int)
+    columns = np.arange(size)
+    array[(columns < left[:, np.newaxis]) | (columns > right[:, np.newaxis])] = 0
+    return array
+
+def write_band(path, array, epsg, origin_x, origin_y):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(epsg)
+    ds = gdal.GetDriverByName("GTiff").Create(path, array.shape[1], array.shape[0], 1, gdal.GDT_UInt16, options=["TILED=YES", "COMPRESS=DEFLATE"])
+    ds.SetGeoTransform((origin_x, PIXEL_SIZE, 0, origin_y, 0, -PIXEL_SIZE))
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).SetNoDataValue(0)
+    ds.GetRasterBand(1).WriteArray(array)
+    ds = None
+
+#Scenes are laid out on a grid with `overlap` of their width shared with each neighbour, like adjacent WRS-2 path/rows
+def scene_origins(scenes, size, overlap):
+    step = size * PIXEL_SIZE * (1 - overlap)
+    columns = int(np.ceil(np.sqrt(scenes)))
+    return [(ORIGIN_X + (i % columns) * step, ORIGIN_Y - (i // columns) * step) for i in range(scenes)]
+
+def make_fixtures(output_directory, scenes=4, dates=3, size=2048, overlap=0.2, epsg=32611, seed=0):
+    input_directory = os.path.join(output_directory, 'input')
+    to_lonlat = Transformer.from_crs(epsg, 4326, always_xy=True)
+    start = date.date(2020, 1, 1)
+    extent = size * PIXEL_SIZE
+
+    scene_list = []
+    for scene, (origin_x, origin_y) in enumerate(scene_origins(scenes, size, overlap)):
+        min_lon, min_lat = to_lonlat.transform(origin_x, origin_y - extent)
+        max_lon, max_lat = to_lonlat.transform(origin_x + extent, origin_y)
+        scene_list.append({'path_row': f'{40 + scene % 3:03d}{36 + scene // 3:03d}', 'origin': [origin_x, origin_y],
+                           'bounds': [min_lon, min_lat, max_lon, max_lat]})
+
+    date_list = []
+    for day in range(dates):
+        dir_name = str(start + date.timedelta(days=16 * day))
+        os.makedirs(os.path.join(input_directory, dir_name), exist_ok=True)
+        date_list.append(dir_name)
+        for scene, info in enumerate(scene_list):
+            base_name = f"LC08_L1TP_{info['path_row']}_{dir_name.replace('-', '')}_S{scene:03d}"
+            scene_seed = seed + 1000 * day + 10 * scene
+            red = add_fill_border(synthetic_band(size, scene_seed, 6000, 12000), scene_seed)
+            nir = synthetic_band(size, scene_seed + 1, 9000, 25000)
+            nir[red == 0] = 0
+            write_band(os.path.join(input_directory, dir_name, base_name + '_B4.TIF'), red, epsg, *info['origin'])
+            write_band(os.path.join(input_directory, dir_name, base_name + '_B5.TIF'), nir, epsg, *info['origin'])
+
+    fixtures = {'scenes': scenes, 'dates': date_list, 'size': size, 'overlap': overlap, 'epsg': epsg, 'seed': seed,
+                'input_directory': input_directory, 'scene_bounds': [info['bounds'] for info in scene_list]}
+    with open(os.path.join(output_directory, FIXTURES_FILE_NAME), 'w') as file:
+        json.dump(fixtures, file, indent=2)
+    return fixtures
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic Landsat-like B4/B5 scenes for the benchmarks')
+    parser.add_argument('-o', '--output', metavar='fixtures_directory', type=str, required=True, help='Directory to write the fixtures to')
+    parser.add_argument('--scenes', type=int, default=4, help='Scenes per date (default: 4)')
+    parser.add_argument('--dates', type=int, default=3, help='Number of date folders, 16 days apart (default: 3)')
+    parser.add_argument('--size', type=int, default=2048, help='Scene width and height in pixels (default: 2048)')
+    parser.add_argument('--overlap', type=float, default=0.2, help='Fraction of a scene shared with each neighbour (default: 0.2)')
+    parser.add_argument('--epsg', type=int, default=32611, help='UTM EPSG code of the scenes (default: 32611)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default: 0)')
+    args = parser.parse_args()
+
+    fixtures = make_fixtures(args.output, args.scenes, args.dates, args.size, args.overlap, args.epsg, args.seed)
+    print(f"Wrote {fixtures['scenes']} scenes x {len(fixtures['dates'])} dates of {args.size} x {args.size} pixels to {fixtures['input_directory']}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+import sys
+import os
+import time
+import json
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import datetime as date
+import multiprocessing as mp
+from glob import glob
+import numpy as np
+import pyarrow.parquet as pq
+from osgeo import gdal
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from make_fixtures import make_fixtures, FIXTURES_FILE_NAME
+from ndvi_image_functions import run_conversion_pool, stream_ndvi_image, NDVI_CODECS
+from extract_pixels import export_directory_pixels
+from time_series_functions import ndvi_timeseries_point, ndvi_timeseries_range
+from wkt_functions import bounds_to_wkt
+from resource_cache import clear_caches
+from log_config import console_handler
+
+RESULTS_VERSION = 1
+#Metrics compared against a baseline run, grouped by which direction is a regression
+LOWER_IS_BETTER = ['wall_s', 'latency_median_ms', 'latency_p95_ms', 'peak_rss_mb']
+HIGHER_IS_BETTER = ['scenes_per_s', 'input_mb_per_s', 'rows_per_s']
+FIXTURE_PARAMS = ['scenes', 'size', 'overlap', 'epsg', 'seed']
+
+#Peak RSS of this process and of its exited workers, whichever is larger. ru_maxrss is in kB on Linux and bytes on macOS.
+def peak_rss_mb():
+    scale = 1 if sys.platform == 'darwin' else 1024
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak * scale / 1e6
+
+def latency_summary(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        'count': int(latencies.size),
+        'latency_median_ms': float(np.median(latencies)),
+        'latency_p95_ms': float(np.percentile(latencies, 95)),
+        'latency_max_ms': float(latencies.max())
+    }
+
+def input_megabytes(input_directory):
+    return sum(os.path.getsize(path) for path in glob(os.path.join(input_directory, '*', '*.TIF'))) / 1e6
+
+#Random points inside the middle of random scenes, clear of the fill border along the scene edges
+def random_points(fixtures, count, seed):
+    rng = np.random.default_rng(seed)
+    points = []
+    for _ in range(count):
+        min_lon, min_lat, max_lon, max_lat = fixtures['scene_bounds'][rng.integers(len(fixtures['scene_bounds']))]
+        lon = min_lon + (max_lon - min_lon) * rng.uniform(0.25, 0.75)
+        lat = min_lat + (max_lat - min_lat) * rng.uniform(0.25, 0.75)
+        points.append((lat, lon))
+    return points
+
+#Square boxes of `fraction` of a scene width around random points, so some of them cross the scene overlaps
+def random_boxes(fixtures, count, fraction, seed):
+    min_lon, min_lat, max_lon, max_lat = fixtures['scene_bounds'][0]
+    half_width = (max_lon - min_lon) * fraction / 2
+    half_height = (max_lat - min_lat) * fraction / 2
+    return [(lon - half_width, lat - half_height, lon + half_width, lat + half_height) for lat, lon in random_points(fixtures, count, seed)]
+
+def bench_conversion(input_directory, output_directory, workers, codec, cog):
+    scenes = len(glob(os.path.join(input_directory, '*', '*_B4.TIF')))
+    start = time.perf_counter()
+    run_conversion_pool(input_directory, output_directory, num_workers=workers, codec=codec, cog=cog)
+    seconds = time.perf_counter() - start
+    return {'wall_s': seconds, 'scenes': scenes, 'scenes_per_s': scenes / seconds, 'input_mb_per_s': input_megabytes(input_directory) / seconds}
+
+#Converts scenes one at a time on a single core, for the latency of one scene without the pool around it
+def bench_scene_conversion(input_directory, work_directory, scenes, codec, cog):
+    latencies = []
+    input_mb = 0
+    for band4 in sorted(glob(os.path.join(input_directory, '*', '*_B4.TIF')))[:scenes]:
+        band5 = band4[:-len('_B4.TIF')] + '_B5.TIF'
+        input_mb += (os.path.getsize(band4) + os.path.getsize(band5)) / 1e6
+        start = time.perf_counter()
+        stream_ndvi_image(band4, band5, 'scene', work_directory, codec=codec, cog=cog)
+        latencies.append(time.perf_counter() - start)
+    return {'wall_s': sum(latencies), 'scenes_per_s': len(latencies) / sum(latencies), 'input_mb_per_s': input_mb / sum(latencies), **latency_summary(latencies)}
+
+#Runs the conversion again over a finished output, which should only check the manifests
+def bench_resume(input_directory, output_directory, workers, codec, cog):
+    start = time.perf_counter()
+    run_conversion_pool(input_directory, output_directory, num_workers=workers, codec=codec, cog=cog)
+    return {'wall_s': time.perf_counter() - start}
+
+def bench_pixel_export(output_directory, dates):
+    latencies = []
+    rows = 0
+    for dir_name in dates:
+        start = time.perf_counter()
+        partition_path = export_directory_pixels(output_directory, dir_name, overwrite=True)
+        latencies.append(time.perf_counter() - start)
+        rows += pq.ParquetFile(partition_path).metadata.num_rows
+    return {'wall_s': sum(latencies), 'rows': rows, 'rows_per_s': rows / sum(latencies), **latency_summary(latencies)}
+
+#Times every query cold, with empty caches, and then warm, returning one result per temperature
+def bench_queries(run_query, queries):
+    cold, warm = [], []
+    for query in queries:
+        clear_caches()
+        start = time.perf_counter()
+        run_query(query)
+        cold.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        run_query(query)
+        warm.append(time.perf_counter() - start)
+    return {'cold': {'wall_s': sum(cold), **latency_summary(cold)}, 'warm': {'wall_s': sum(warm), **latency_summary(warm)}}
+
+def bench_point_timeseries(output_directory, fixtures, count, seed):
+    start_date = date.datetime.strptime(fixtures['dates'][0], '%Y-%m-%d')
+    end_date = date.datetime.strptime(fixtures['dates'][-1], '%Y-%m-%d')
+    return bench_queries(lambda point: ndvi_timeseries_point(*point, start_date, end_date, output_directory), random_points(fixtures, count, seed))
+
+def bench_range_timeseries(output_directory, fixtures, count, fraction, seed):
+    start_date = date.datetime.strptime(fixtures['dates'][0], '%Y-%m-%d')
+    end_date = date.datetime.strptime(fixtures['dates'][-1], '%Y-%m-%d')
+    wkts = [bounds_to_wkt(*box) for box in random_boxes(fixtures, count, fraction, seed)]
+    return bench_queries(lambda wkt_string: ndvi_timeseries_range(wkt_string, start_date, end_date, output_directory), wkts)
+
+def stage_worker(connection, func, args):
+    console_handler.setLevel(logging.ERROR)
+    try:
+        result = func(*args)
+        result['peak_rss_mb'] = peak_rss_mb()
+        connection.send(result)
+    except Exception as e:
+        connection.send(e)
+    connection.close()
+
+#Runs one stage in a freshly spawned process, so its peak RSS and caches are its own
+def run_isolated(func, *args):
+    context = mp.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=stage_worker, args=(sender, func, args))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = RuntimeError(f"{func.__name__} exited with code {process.exitcode}")
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+def load_or_make_fixtures(fixtures_directory, args):
+    fixtures_path = os.path.join(fixtures_directory, FIXTURES_FILE_NAME)
+    if os.path.isfile(fixtures_path):
+        with open(fixtures_path) as file:
+            fixtures = json.load(file)
+        if all(fixtures[param] == getattr(args, param) for param in FIXTURE_PARAMS) and len(fixtures['dates']) == args.dates:
+            return fixtures
+        shutil.rmtree(fixtures['input_directory'])
+    return make_fixtures(fixtures_directory, args.scenes, args.dates, args.size, args.overlap, args.epsg, args.seed)
+
+def environment_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': date.datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'gdal': gdal.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+def run_benchmarks(work_directory, args):
+    fixtures = load_or_make_fixtures(os.path.join(work_directory, 'fixtures'), args)
+    input_directory = fixtures['input_directory']
+    output_directory = os.path.join(work_directory, 'output')
+    scratch_directory = os.path.join(work_directory, 'scratch')
+    for directory in (output_directory, scratch_directory):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+    stages = {}
+    stages['conversion'] = run_isolated(bench_conversion, input_directory, output_directory, args.workers, args.codec, args.cog)
+    stages['scene_conversion'] = run_isolated(bench_scene_conversion, input_directory, scratch_directory, args.scene_samples, args.codec, args.cog)
+    stages['resume'] = run_isolated(bench_resume, input_directory, output_directory, args.workers, args.codec, args.cog)
+    stages['pixel_export'] = run_isolated(bench_pixel_export, output_directory, fixtures['dates'])
+
+    for name, func, func_args in (('point', bench_point_timeseries, (output_directory, fixtures, args.queries, args.seed)),
+                                  ('range', bench_range_timeseries, (output_directory, fixtures, args.queries, args.range_fraction, args.seed))):
+        result = run_isolated(func, *func_args)
+        for temperature in ('cold', 'warm'):
+            stages[f'{name}_timeseries_{temperature}'] = {**result[temperature], 'peak_rss_mb': result['peak_rss_mb']}
+
+    fixture_info = {param: fixtures[param] for param in FIXTURE_PARAMS}
+    fixture_info['dates'] = len(fixtures['dates'])
+    fixture_info['input_mb'] = input_megabytes(input_directory)
+    settings = {'workers': args.workers, 'codec': args.codec, 'cog': args.cog, 'queries': args.queries, 'range_fraction': args.range_fraction}
+    return {'version': RESULTS_VERSION, 'environment': environment_info(), 'fixtures': fixture_info, 'settings': settings, 'stages': stages}
+
+#Returns a message for every metric that got worse than the baseline by more than tolerance
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for stage, metrics in results['stages'].items():
+        base_metrics = baseline['stages'].get(stage, {})
+        for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            if metric not in metrics or not base_metrics.get(metric):
+                continue
+            change = metrics[metric] / base_metrics[metric] - 1
+            if (metric in LOWER_IS_BETTER and change > tolerance) or (metric in HIGHER_IS_BETTER and change < -tolerance):
+                regressions.append(f"{stage} {metric}: {base_metrics[metric]:.3f} -> {metrics[metric]:.3f} ({change:+.0%})")
+    return regressions
+
+def print_results(results):
+    fixtures = results['fixtures']
+    print(f"{fixtures['scenes']} scenes x {fixtures['dates']} dates of {fixtures['size']} x {fixtures['size']} pixels, "
+          f"{fixtures['input_mb']:.0f} MB of input, {results['settings']['workers']} workers")
+    print(f"{'stage':>24} {'wall s':>8} {'median ms':>10} {'p95 ms':>8} {'throughput':>16} {'peak RSS MB':>12}")
+    for stage, metrics in results['stages'].items():
+        if 'input_mb_per_s' in metrics:
+            throughput = f"{metrics['input_mb_per_s']:.1f} MB/s"
+        elif 'rows_per_s' in metrics:
+            throughput = f"{metrics['rows_per_s'] / 1e6:.2f} Mrows/s"
+        else:
+            throughput = '-'
+        median = f"{metrics['latency_median_ms']:.1f}" if 'latency_median_ms' in metrics else '-'
+        p95 = f"{metrics['latency_p95_ms']:.1f}" if 'latency_p95_ms' in metrics else '-'
+        print(f"{stage:>24} {metrics['wall_s']:8.2f} {median:>10} {p95:>8} {throughput:>16} {metrics['peak_rss_mb']:12.0f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark conversion, time series queries and pixel export on synthetic Landsat-like scenes')
+    parser.add_argument('--work-dir', metavar='work_directory', type=str, help='Keep fixtures and output here, fixtures are reused while the fixture options match (default: a temporary directory)')
+    parser.add_argument('--scenes', type=int, default=4, help='Scenes per date (default: 4)')
+    parser.add_argument('--dates', type=int, default=3, help='Number of date folders (default: 3)')
+    parser.add_argument('--size', type=int, default=2048, help='Scene width and height in pixels (default: 2048)')
+    parser.add_argument('--overlap', type=float, default=0.2, help='Fraction of a scene shared with each neighbour (default: 0.2)')
+    parser.add_argument('--epsg', type=int, default=32611, help='UTM EPSG code of the scenes (default: 32611)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed of the fixtures and queries (default: 0)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='Conversion worker processes (default: number of CPUs)')
+    parser.add_argument('--codec', choices=NDVI_CODECS, default='JPEG', help='Codec of the NDVI images (default: JPEG)')
+    parser.add_argument('--cog', action='store_true', help='Write Cloud-Optimized GeoTIFFs')
+    parser.add_argument('--scene-samples', type=int, default=4, help='Scenes converted one at a time for the per-scene latency (default: 4)')
+    parser.add_argument('--queries', type=int, default=20, help='Random point and range queries each (default: 20)')
+    parser.add_argument('--range-fraction', type=float, default=0.1, help='Range query width as a fraction of a scene width (default: 0.1)')
+    parser.add_argument('--json', metavar='results_file', type=str, help='Write the results to this JSON file')
+    parser.add_argument('--baseline', metavar='baseline_file', type=str, help='Results file of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative change against the baseline reported as a regression (default: 0.2)')
+    args = parser.parse_args()
+
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = run_benchmarks(args.work_dir, args)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run_benchmarks(work_dir, args)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline['fixtures'] != results['fixtures'] or baseline['settings'] != results['settings']:
+            print('Warning: the baseline was run with other fixtures or settings')
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} beyond {args.tolerance:.0%}")
+
+if __name__ == '__main__':
+    main()
@@ -6,14 +6,43 @@ import logging
 # Add directories to sys.path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
 
-# Import functions
-from ndvi_image_functions import *
+# Import functions. xarray, pyarrow and numba are only imported by the stages that use them.
+from ndvi_image_functions import run_conversion_pool, run_queue_workers, NDVI_CODECS
+from ndvi_kernel_functions import NDVI_KERNEL_BACKENDS
+from rollup_functions import build_rollups, ROLLUP_LEVELS
+from metrics import enable_metrics, log_metrics_summary, profile_run, PROFILERS
 from log_config import logger, console_handler
 
+#With --queue every host reaches this point when the queue drains, and the first one to get the lease brings the
+#rollups up to date. A host arriving later finds them current, which costs a few stat calls.
+def build_queued_rollups(output_directory, args):
+    from job_queue_functions import JobQueue
+    with JobQueue(output_directory) as queue:
+        if not queue.try_lease('rollups'):
+            logger.info("Another worker is building the rollups")
+            return
+        build_rollups(output_directory, args.rollup_levels, args.workers)
+
 def main():
     parser = argparse.ArgumentParser(description='Convert satellite images to NDVI')
     parser.add_argument('-i', '--input', metavar='input_directory', type=str, required=True, help='Enter input directory of dataset')
     parser.add_argument('-o', '--output', metavar='output_directory', type=str, required=True, help='Enter output directory for NDVI images')
+    parser.add_argument('-w', '--workers', metavar='num_workers', type=int, default=os.cpu_count(), help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--max-in-flight', metavar='num_scenes', type=int, default=None, help='Maximum number of scene pairs queued on the workers at once (default: twice the workers)')
+    parser.add_argument('--kernel', choices=NDVI_KERNEL_BACKENDS, default='auto', help='NDVI kernel backend, auto uses numba when it is installed (default: auto)')
+    parser.add_argument('--codec', choices=NDVI_CODECS, default='JPEG', help='Compression of the NDVI images, DEFLATE, ZSTD and LZW are lossless (default: JPEG)')
+    parser.add_argument('--cog', action='store_true', help='Write tiled Cloud-Optimized GeoTIFFs with internal overviews')
+    parser.add_argument('--verify', action='store_true', help='Check every existing NDVI image against its manifest checksum and convert it again if it differs')
+    parser.add_argument('--queue', action='store_true', help='Convert as one of any number of cooperating workers, on this and other hosts, sharing a job queue in the output directory')
+    parser.add_argument('--datacube', metavar='store_path', type=str, help='Zarr store to append every finished date to as a time x y x x datacube')
+    parser.add_argument('--datacube-bounds', nargs=4, metavar=('min_x', 'min_y', 'max_x', 'max_y'), type=float, help='Bounds of a new datacube in --datacube-crs units')
+    parser.add_argument('--datacube-resolution', metavar='resolution', type=float, help='Pixel size of a new datacube in --datacube-crs units')
+    parser.add_argument('--datacube-crs', metavar='crs', type=str, default='EPSG:4326', help='CRS of a new datacube (default: EPSG:4326)')
+    parser.add_argument('--rollups', action='store_true', help='Bring the monthly, seasonal and yearly NDVI composites up to date after the conversion')
+    parser.add_argument('--rollup-levels', nargs='+', choices=ROLLUP_LEVELS, default=ROLLUP_LEVELS, help='Rollup levels built by --rollups (default: all)')
+    parser.add_argument('--metrics', metavar='metrics_file', type=str, help='Write per-stage timings, byte counts and pool utilization to this JSON-lines file')
+    parser.add_argument('--profile', metavar='profile_file', type=str, help='Profile the run and write the profile to this file')
+    parser.add_argument('--profiler', choices=PROFILERS, default='cprofile', help='Profiler used by --profile (default: cprofile)')
     parser.add_argument('-q', '--quiet', action='store_true', help='Turns off Messages until WARNING LEVEL')
 
     args = parser.parse_args()
@@ -29,10 +58,26 @@ def main():
     
     logger.addHandler(console_handler)
 
-    cpu_count = os.cpu_count()
-    dir_queue = initialize_queue(input_directory)
-    threads = create_and_start_threads(input_directory, output_directory, dir_queue, num_threads=cpu_count, quality='60')
-    wait_for_threads_to_complete(threads)
+    if args.datacube and not os.path.exists(args.datacube):
+        if args.datacube_bounds is None or args.datacube_resolution is None:
+            parser.error('--datacube-bounds and --datacube-resolution are required to create a new datacube')
+        from datacube_functions import create_datacube
+        create_datacube(args.datacube, args.datacube_bounds, args.datacube_resolution, args.datacube_crs)
+
+    if args.metrics:
+        enable_metrics(args.metrics)
+
+    with profile_run(args.profile, args.profiler):
+        if args.queue:
+            run_queue_workers(input_directory, output_directory, num_workers=args.workers, quality='60', kernel_backend=args.kernel, codec=args.codec, cog=args.cog, datacube=args.datacube, verify=args.verify)
+        else:
+            run_conversion_pool(input_directory, output_directory, num_workers=args.workers, quality='60', max_in_flight=args.max_in_flight, kernel_backend=args.kernel, codec=args.codec, cog=args.cog, datacube=args.datacube, verify=args.verify)
+        if args.rollups and args.queue:
+            build_queued_rollups(output_directory, args)
+        elif args.rollups:
+            build_rollups(output_directory, args.rollup_levels, args.workers)
+
+    log_metrics_summary()
 
 if __name__ == '__main__':
     main()
@@ -1,12 +1,12 @@
-import rasterio as rio
-from wkt_functions import *
+from wkt_functions import wkt_to_bounds, bounds_to_wkt
+from resource_cache import open_dataset, get_transformer
 #Returns bounding box in this order: min_lon, min_lat, max_lon, max_lat
 def get_boundingbox(raster_path, user_crs = 'EPSG:4326'):   
-    with rio.open(raster_path) as dataset:
+    with open_dataset(raster_path) as dataset:
         bounds = dataset.bounds
-        crs = dataset.crs
+        crs = dataset.crs.to_string()
     
-    transformer = Transformer.from_crs(crs, user_crs, always_xy=True)
+    transformer = get_transformer(crs, user_crs)
     
     # Convert the bounds
     min_lon, min_lat = transformer.transform(bounds.left, bounds.bottom)
@@ -14,9 +14,19 @@ def get_boundingbox(raster_path, user_crs = 'EPSG:4326'):
     
     return bounds_to_wkt(min_lon, min_lat, max_lon, max_lat)
 
+#Same MBR as get_boundingbox for a north-up image, from its geotransform, size and CRS without opening the file
+def boundingbox_from_geotransform(gt, xsize, ysize, crs, user_crs='EPSG:4326'):
+    left, top = gt[0], gt[3]
+    right, bottom = gt[0] + xsize * gt[1], gt[3] + ysize * gt[5]
+
+    transformer = get_transformer(crs, user_crs)
+    min_lon, min_lat = transformer.transform(left, bottom)
+    max_lon, max_lat = transformer.transform(right, top)
+
+    return bounds_to_wkt(min_lon, min_lat, max_lon, max_lat)
 
 def transform_coordinates(lat, lon, src_crs='EPSG:4326', dst_crs='EPSG:4326'):
-    transformer = rio.from_crs(src_crs, dst_crs, always_xy=True)
+    transformer = get_transformer(src_crs, dst_crs)
     x, y = transformer.transform(lon, lat)  
     return x, y
 
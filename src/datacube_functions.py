@@ -0,0 +1,171 @@
+import os
+from contextlib import ExitStack
+import numpy as np
+import pandas as pd
+import rasterio as rio
+import xarray as xr
+import zarr
+# Registers the .rio accessor on xarray objects, which create_datacube and the readers use
+import rioxarray  # noqa: F401
+from rasterio.transform import from_origin
+from rasterio.warp import reproject, transform_bounds, Resampling
+from affine import Affine
+from extract_pixels import list_directory_tifs
+from raster_index_functions import parse_date_directory
+from log_config import logger
+
+DATACUBE_VARIABLE = 'ndvi'
+#A pixel's history for up to DATACUBE_TIME_CHUNK dates is one chunk. Appending a date rewrites the partly filled
+#time chunk of every spatial chunk the date covers, so the chunk is kept short: 20 years of 16-day revisits are
+#15 chunk reads per pixel, and an append rewrites at most 32 dates' worth of each covered chunk.
+DATACUBE_TIME_CHUNK = 32
+DATACUBE_SPACE_CHUNK = 128
+#A date is warped and written this many pixels square at a time, whole spatial chunks, so memory does not grow
+#with the extent of the cube
+DATACUBE_WRITE_BLOCK = 8 * DATACUBE_SPACE_CHUNK
+#Whole days since the epoch, fixed when the store is created so appends can encode dates without xarray
+DATACUBE_TIME_ENCODING = {'units': 'days since 1970-01-01', 'calendar': 'proleptic_gregorian', 'dtype': 'int64'}
+
+def datacube_grid(bounds, resolution):
+    min_x, min_y, max_x, max_y = bounds
+    width = int(np.ceil((max_x - min_x) / resolution))
+    height = int(np.ceil((max_y - min_y) / resolution))
+    return from_origin(min_x, max_y, resolution, resolution), width, height
+
+#Creates an empty time x y x x datacube of uint8 NDVI codes (0 is nodata, as in the NDVI images) on a fixed grid.
+#Bounds and resolution are in units of crs.
+def create_datacube(store_path, bounds, resolution, crs='EPSG:4326'):
+    transform, width, height = datacube_grid(bounds, resolution)
+    x = transform.c + (np.arange(width) + 0.5) * transform.a
+    y = transform.f + (np.arange(height) + 0.5) * transform.e
+
+    cube = xr.Dataset(
+        {DATACUBE_VARIABLE: (('time', 'y', 'x'), np.zeros((0, height, width), dtype=np.uint8))},
+        coords={'time': pd.DatetimeIndex([]), 'y': y, 'x': x}
+    )
+    cube = cube.rio.write_crs(crs)
+    cube[DATACUBE_VARIABLE].encoding.update(chunks=(DATACUBE_TIME_CHUNK, DATACUBE_SPACE_CHUNK, DATACUBE_SPACE_CHUNK), _FillValue=0)
+    cube.to_zarr(store_path, mode='w', zarr_format=2, encoding={'time': DATACUBE_TIME_ENCODING})
+    logger.info(f"Created {width} x {height} datacube in {store_path}")
+
+#Opens the cube lazily with the raw codes, so reads only touch the chunks they need
+def open_datacube(store_path):
+    return xr.open_zarr(store_path, mask_and_scale=False, decode_coords='all')
+
+#Dates already in the cube, read once so a run can skip its unchanged dates without opening the store again
+def datacube_dates(store_path):
+    return set(open_datacube(store_path).indexes['time'])
+
+#Whether a date directory still has to be appended given datacube_dates. Names that are not dates are left to
+#append_datacube_date to report.
+def datacube_needs_date(cube_dates, dir_name):
+    try:
+        return pd.Timestamp(parse_date_directory(dir_name)) not in cube_dates
+    except ValueError:
+        return True
+
+#Window of the datacube grid covered by an image, as (row_start, row_stop, col_start, col_stop), or None
+def grid_window(src, crs, transform, width, height):
+    min_x, min_y, max_x, max_y = transform_bounds(src.crs, crs, *src.bounds)
+    col_start = max(int(np.floor((min_x - transform.c) / transform.a)), 0)
+    col_stop = min(int(np.ceil((max_x - transform.c) / transform.a)), width)
+    row_start = max(int(np.floor((max_y - transform.f) / transform.e)), 0)
+    row_stop = min(int(np.ceil((min_y - transform.f) / transform.e)), height)
+    if col_start >= col_stop or row_start >= row_stop:
+        return None
+    return row_start, row_stop, col_start, col_stop
+
+#Warps the images covering one block of the datacube grid into it. Only the part of the block covered by each
+#image is reprojected, and later files in sorted order win where images overlap.
+def warp_grid_block(sources, crs, transform, row_start, row_stop, col_start, col_stop):
+    block = np.zeros((row_stop - row_start, col_stop - col_start), dtype=np.uint8)
+    for src, (src_row_start, src_row_stop, src_col_start, src_col_stop) in sources:
+        top, bottom = max(row_start, src_row_start), min(row_stop, src_row_stop)
+        left, right = max(col_start, src_col_start), min(col_stop, src_col_stop)
+        if top >= bottom or left >= right:
+            continue
+        tile = np.zeros((bottom - top, right - left), dtype=np.uint8)
+        reproject(
+            rio.band(src, 1), tile,
+            src_nodata=0, dst_nodata=0,
+            dst_transform=transform * Affine.translation(left, top), dst_crs=crs,
+            resampling=Resampling.nearest
+        )
+        target = block[top - row_start:bottom - row_start, left - col_start:right - col_start]
+        np.copyto(target, tile, where=tile != 0)
+    return block
+
+#Warps every NDVI image of a date directory onto the datacube grid and writes it into time slice position of array,
+#one DATACUBE_WRITE_BLOCK block at a time. Blocks no image covers are left alone, unless clear=True, which zeroes
+#them so a rewritten slice keeps nothing of the old one.
+def write_directory_to_grid(directory_path, array, position, crs, transform, width, height, clear=False):
+    with ExitStack() as stack:
+        sources = []
+        for file in list_directory_tifs(directory_path):
+            src = stack.enter_context(rio.open(os.path.join(directory_path, file)))
+            window = grid_window(src, crs, transform, width, height)
+            if window is not None:
+                sources.append((src, window))
+
+        for row_start in range(0, height, DATACUBE_WRITE_BLOCK):
+            row_stop = min(row_start + DATACUBE_WRITE_BLOCK, height)
+            for col_start in range(0, width, DATACUBE_WRITE_BLOCK):
+                col_stop = min(col_start + DATACUBE_WRITE_BLOCK, width)
+                covering = [(src, window) for src, window in sources
+                            if window[0] < row_stop and row_start < window[1] and window[2] < col_stop and col_start < window[3]]
+                if not covering and not clear:
+                    continue
+                block = warp_grid_block(covering, crs, transform, row_start, row_stop, col_start, col_stop)
+                if clear or block.any():
+                    array[position, row_start:row_stop, col_start:col_stop] = block
+
+#Adds one date at the end of the time axis, encoded with DATACUBE_TIME_ENCODING. The new slice reads as nodata
+#until it is written.
+def append_time_slot(group, date):
+    array = group[DATACUBE_VARIABLE]
+    times = group['time']
+    if times.attrs.get('units') != DATACUBE_TIME_ENCODING['units']:
+        raise ValueError(f"Datacube time is encoded as {times.attrs.get('units')}, expected {DATACUBE_TIME_ENCODING['units']}; create the store again")
+    position = times.shape[0]
+    encoded, _, _ = xr.coding.times.encode_cf_datetime(np.array([date.to_datetime64()]), DATACUBE_TIME_ENCODING['units'],
+                                                       DATACUBE_TIME_ENCODING['calendar'])
+    array.resize((position + 1,) + tuple(array.shape[1:]))
+    times.resize((position + 1,))
+    times[position] = np.asarray(encoded).astype(DATACUBE_TIME_ENCODING['dtype'])[0]
+    return position
+
+#Appends one finished date directory to the datacube as a single time slice. Dates already in the cube are skipped,
+#so re-running the conversion does not duplicate slices, unless replace=True, which rewrites the slice in place.
+#Slices are appended in completion order, readers sort by time. The slice is written block by block straight into
+#the Zarr array, so only the chunks the date covers are written and memory stays bounded by the block size.
+#Appends to one store must not overlap: run_conversion_pool appends from its main process only, and queue workers
+#take the 'datacube' lease first.
+def append_datacube_date(store_path, output_directory, dir_name, replace=False):
+    try:
+        date = pd.Timestamp(parse_date_directory(dir_name))
+    except ValueError:
+        logger.warning(f"Directory {dir_name} is not in YYYY-MM-DD format, not adding it to the datacube")
+        return False
+
+    directory_path = os.path.join(output_directory, dir_name)
+    if not os.path.isdir(directory_path) or len(list_directory_tifs(directory_path)) == 0:
+        return False
+
+    cube = open_datacube(store_path)
+    existing = date in cube.indexes['time']
+    if existing and not replace:
+        logger.info(f"Date {dir_name} is already in the datacube, skipping.")
+        return False
+
+    group = zarr.open_group(store_path, mode='r+')
+    if existing:
+        position = cube.indexes['time'].get_loc(date)
+    else:
+        position = append_time_slot(group, date)
+    write_directory_to_grid(directory_path, group[DATACUBE_VARIABLE], position, cube.rio.crs, cube.rio.transform(),
+                            cube.sizes['x'], cube.sizes['y'], clear=existing)
+    # xarray reads the consolidated metadata, which still has the old shape
+    zarr.consolidate_metadata(store_path)
+
+    logger.info(f"Date {dir_name} written to the datacube in {store_path}")
+    return True
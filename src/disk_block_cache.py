@@ -0,0 +1,108 @@
+import os
+import glob
+import hashlib
+import threading
+import numpy as np
+from log_config import logger
+
+DISK_CACHE_DIR_ENV = 'NDVI_BLOCK_CACHE_DIR'
+DISK_CACHE_BYTES_ENV = 'NDVI_BLOCK_CACHE_BYTES'
+
+#On-disk cache of decoded blocks, one .npy file per block, shared by every process pointed at the same directory.
+#Hits are returned as read-only np.memmap views, so a warm block is never copied or decoded again. A block file's
+#mtime is its last use: hits touch it, and eviction deletes the least recently used files once the cache is over
+#max_bytes, down to 90% of it. Files are written to a temporary name and renamed, so readers never see partial blocks.
+class DiskBlockCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.total_bytes = sum(os.path.getsize(path) for path in self._block_files())
+
+    def _block_files(self):
+        return glob.glob(os.path.join(self.directory, '*', '*.npy'))
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + '.npy')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            block = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return block
+
+    def put(self, key, block):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as file:
+            np.save(file, np.ascontiguousarray(block))
+        os.replace(temp_path, path)
+
+        with self._lock:
+            self.total_bytes += os.path.getsize(path)
+            over_budget = self.total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def evict(self):
+        target = self.max_bytes * 0.9
+        files = []
+        for path in self._block_files():
+            try:
+                stat = os.stat(path)
+                files.append((stat.st_mtime_ns, stat.st_size, path))
+            except FileNotFoundError:
+                continue
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        evicted = 0
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                evicted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        with self._lock:
+            self.total_bytes = total
+            self.evictions += evicted
+        logger.debug(f"Evicted {evicted} blocks from the disk block cache in {self.directory}")
+
+    def stats(self):
+        with self._lock:
+            return {'cache': 'disk_blocks', 'entries': None, 'bytes': self.total_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+_disk_block_cache = None
+
+#Turns the disk cache on for this process and, through the environment, for any worker processes it starts
+def enable_disk_block_cache(directory, max_bytes):
+    global _disk_block_cache
+    _disk_block_cache = DiskBlockCache(directory, max_bytes)
+    os.environ[DISK_CACHE_DIR_ENV] = directory
+    os.environ[DISK_CACHE_BYTES_ENV] = str(int(max_bytes))
+    logger.info(f"Disk block cache in {directory} with a budget of {max_bytes / 1e6:.0f} MB")
+    return _disk_block_cache
+
+def get_disk_block_cache():
+    return _disk_block_cache
+
+if os.environ.get(DISK_CACHE_DIR_ENV):
+    _disk_block_cache = DiskBlockCache(os.environ[DISK_CACHE_DIR_ENV], int(os.environ.get(DISK_CACHE_BYTES_ENV, 1 << 30)))
@@ -2,47 +2,73 @@ import pandas as pd
 import rasterio
 import numpy as np
 import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+from rasterio.windows import Window
+from mosaic_functions import list_date_mosaics
+from metrics import stage_timer
+from log_config import logger
 
-def extract_pixel_coords(input_tif_path, band_id=1, dire_name=''):
+PIXEL_PARTITION_DIRECTORY = 'pixels'
+
+PIXEL_CHUNK_ROWS = 256
+PARQUET_ROW_GROUP_SIZE = 1 << 20
+
+#Yields (x, y, values) for the valid pixels of an image, one chunk of whole block rows at a time.
+#Nodata pixels are dropped before any coordinates are computed, and pixel centres come straight from
+#the affine transform, so no full-size index grids are ever built.
+def iter_pixel_chunks(input_tif_path, band_id=1, nodata=0):
     with rasterio.open(input_tif_path) as src:
-        band_arr = src.read(band_id)
+        transform = src.transform
+        block_rows = src.block_shapes[band_id - 1][0]
+        chunk_rows = block_rows * -(-PIXEL_CHUNK_ROWS // block_rows)
 
-        left, bottom, right, top = src.bounds
-        nrows, ncols = band_arr.shape
+        for row_off in range(0, src.height, chunk_rows):
+            window = Window(0, row_off, src.width, min(chunk_rows, src.height - row_off))
+            band_arr = src.read(band_id, window=window)
 
-        pixel_width = (right - left) / ncols
-        pixel_height = (top - bottom) / nrows
+            rows, cols = np.nonzero(band_arr != nodata)
+            if rows.size == 0:
+                continue
+            values = band_arr[rows, cols]
 
-        rows, cols = np.indices(band_arr.shape)
+            rows = rows + (row_off + 0.5)
+            cols = cols + 0.5
+            x = transform.c + cols * transform.a + rows * transform.b
+            y = transform.f + cols * transform.d + rows * transform.e
+            yield x, y, values
 
-        lons = left + cols * pixel_width + (pixel_width / 2)
-        lats = top - rows * pixel_height - (pixel_height / 2)
+def extract_pixel_coords(input_tif_path, band_id=1, dire_name=''):
+    chunks = list(iter_pixel_chunks(input_tif_path, band_id))
+    if not chunks:
+        with rasterio.open(input_tif_path) as src:
+            dtype = src.dtypes[band_id - 1]
+        return np.empty(0), np.empty(0), np.empty(0, dtype=dtype)
 
-        x = lons.ravel()
-        y = lats.ravel()
-        values = band_arr.ravel()
+    x, y, values = (np.concatenate(column) for column in zip(*chunks))
+    return x, y, values
 
-        return x, y, values
+def list_directory_tifs(directory_path):
+    return sorted(f for f in os.listdir(directory_path) if f.lower().endswith('.tif') and not f.startswith('.'))
+
+#Yields per-file pixel chunks for every image in a directory
+def iter_directory_pixel_chunks(directory_path, band_id=1):
+    for tif_file in list_directory_tifs(directory_path):
+        yield from iter_pixel_chunks(os.path.join(directory_path, tif_file), band_id)
 
 def get_directory_pixel_values(directory_path, band_id=1):
-    tif_files = [f for f in os.listdir(directory_path) if f.lower().endswith('.tif')]
-    if len(tif_files) != 0:
+    if len(list_directory_tifs(directory_path)) != 0:
         dir_name = os.path.basename(directory_path)
-        all_lons = []
-        all_lats = []
-        all_values = []
-
-        for tif_file in tif_files:
-            input_tif_path = os.path.join(directory_path, tif_file)
-            lons, lats, values = extract_pixel_coords(input_tif_path, band_id)
-            all_lons.extend(lons)
-            all_lats.extend(lats)
-            all_values.extend(values)
+        chunks = list(iter_directory_pixel_chunks(directory_path, band_id))
+        if chunks:
+            lons, lats, values = (np.concatenate(column) for column in zip(*chunks))
+        else:
+            lons, lats, values = np.empty(0), np.empty(0), np.empty(0, dtype=np.uint8)
 
         df = pd.DataFrame({
-            'longitude': all_lons,
-            'latitude': all_lats,
-            dir_name + ' values': all_values
+            'longitude': lons,
+            'latitude': lats,
+            dir_name + ' values': values
         })
         return df
     return None
@@ -52,14 +78,60 @@ def combine_directories_to_csv(main_directory, output_csv, band_id=1):
     for subdir, dirs, files in os.walk(main_directory):
         if subdir == main_directory:  
             continue
-        df = get_directory_pixel_values(subdir, band_id=band_id)
+        with stage_timer('pixel_extract', directory=os.path.basename(subdir)):
+            df = get_directory_pixel_values(subdir, band_id=band_id)
         if df is not None:
             all_data.append(df)
 
     if all_data:
         combined_df = pd.concat(all_data, ignore_index=True)
-        combined_df = combined_df.replace(r'^\s*$', np.nan, regex=True)
 
-        combined_df.to_csv(os.path.join(main_directory,output_csv), index=False)
+        with stage_timer('combine_csv'):
+            combined_df.to_csv(os.path.join(main_directory,output_csv), index=False)
         # print(f"Data saved to {output_csv}")
 
+def pixel_partition_path(output_directory, dir_name):
+    return os.path.join(output_directory, PIXEL_PARTITION_DIRECTORY, f'date={dir_name}', 'part-0.parquet')
+
+#Writes the pixels of one finished date directory as its own Parquet partition (pixels/date=YYYY-MM-DD).
+#Pixel chunks are streamed into row groups, and partitions are written through a temporary file and a rename.
+#An existing partition is only replaced with overwrite=True, after images of the date were converted again.
+def export_directory_pixels(output_directory, dir_name, band_id=1, overwrite=False):
+    partition_path = pixel_partition_path(output_directory, dir_name)
+    if os.path.isfile(partition_path) and not overwrite:
+        logger.info(f"Pixel partition for {dir_name} already exists, skipping.")
+        return partition_path
+
+    directory_path = os.path.join(output_directory, dir_name)
+    if len(list_directory_tifs(directory_path)) == 0:
+        return None
+
+    # The date's mosaics hold every pixel once, where the images would repeat the pixels they share
+    mosaics = list_date_mosaics(directory_path)
+    if mosaics:
+        chunks = (chunk for mosaic_path in mosaics for chunk in iter_pixel_chunks(mosaic_path, band_id))
+    else:
+        chunks = iter_directory_pixel_chunks(directory_path, band_id)
+
+    os.makedirs(os.path.dirname(partition_path), exist_ok=True)
+    temp_path = os.path.join(os.path.dirname(partition_path), '.part-0.parquet.tmp')
+    schema = pa.schema([('longitude', pa.float32()), ('latitude', pa.float32()), ('value', pa.uint8())])
+
+    pending, pending_rows = [], 0
+    with pq.ParquetWriter(temp_path, schema) as writer:
+        for x, y, values in chunks:
+            pending.append(pa.table([x.astype(np.float32), y.astype(np.float32), values.astype(np.uint8)], schema=schema))
+            pending_rows += values.size
+            if pending_rows >= PARQUET_ROW_GROUP_SIZE:
+                writer.write_table(pa.concat_tables(pending))
+                pending, pending_rows = [], 0
+        if pending:
+            writer.write_table(pa.concat_tables(pending))
+
+    os.replace(temp_path, partition_path)
+    logger.info(f"Pixel partition for {dir_name} written to {partition_path}")
+    return partition_path
+
+#Reads the pixel partitions back as one table with a date column
+def read_pixel_partitions(output_directory, columns=None):
+    return pd.read_parquet(os.path.join(output_directory, PIXEL_PARTITION_DIRECTORY), columns=columns)
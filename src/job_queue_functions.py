@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from log_config import logger
+
+JOB_QUEUE_FILE = 'conversion_jobs.sqlite'
+
+#A lease not renewed for LEASE_SECONDS is taken to belong to a worker that died, and its job is handed out again
+LEASE_SECONDS = 120
+HEARTBEAT_SECONDS = 20
+#A scene whose conversion failed or whose worker died this many times, and a directory whose finalizing failed this
+#many times, is left as failed until the next scan
+MAX_ATTEMPTS = 3
+POLL_SECONDS = 2
+
+# Scene-level job queue shared by every worker of a conversion run, kept next to the output in one SQLite file, so
+# any number of processes on any number of hosts that mount the output directory can join or leave the run.
+# The file needs a filesystem with working POSIX locks (local disks, NFSv4, Lustre, CephFS), and the hosts'
+# clocks must agree to well within LEASE_SECONDS.
+#   jobs:        one row per scene pair to convert, pending -> leased -> done or failed, with the manifest record
+#                of a done scene kept until its directory is finalized
+#   directories: finalized = 0 while a directory has jobs whose records are not yet in its manifest and index,
+#                failed = 1 once finalizing it failed MAX_ATTEMPTS times
+#   leases:      named leases held by one worker at a time (the input scan, finalizing a directory, the datacube)
+#   workers:     the workers in the run and their last heartbeat
+QUEUE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    dir TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    band4 TEXT NOT NULL,
+    band5 TEXT NOT NULL,
+    adopt INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    record TEXT,
+    error TEXT,
+    UNIQUE (dir, file_name));
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires);
+CREATE TABLE IF NOT EXISTS directories (
+    dir TEXT PRIMARY KEY,
+    finalized INTEGER NOT NULL DEFAULT 1,
+    finalize_attempts INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    error TEXT);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    worker TEXT NOT NULL,
+    expires REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS workers (
+    worker TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL,
+    scenes INTEGER NOT NULL DEFAULT 0);
+'''
+
+class JobQueue:
+    def __init__(self, output_directory, worker_id=None):
+        self.path = os.path.join(output_directory, JOB_QUEUE_FILE)
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._stop = threading.Event()
+        self._heartbeat_thread = None
+        connection = sqlite3.connect(self.path, timeout=60)
+        try:
+            connection.executescript(QUEUE_SCHEMA)
+        finally:
+            connection.close()
+
+    #Every call takes the write lock up front, so a claim never races another worker's claim
+    @contextmanager
+    def _transaction(self):
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+    def __enter__(self):
+        with self._transaction() as connection:
+            connection.execute('INSERT OR REPLACE INTO workers (worker, heartbeat) VALUES (?, ?)', (self.worker_id, time.time()))
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name='job-queue-heartbeat', daemon=True)
+        self._heartbeat_thread.start()
+        logger.info(f"Worker {self.worker_id} joined the job queue in {self.path}")
+        return self
+
+    #Leaving hands the worker's leased jobs and leases straight back instead of waiting for them to expire
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        self._heartbeat_thread.join()
+        with self._transaction() as connection:
+            connection.execute('''UPDATE jobs SET status = 'pending', worker = NULL, lease_expires = NULL
+                                  WHERE worker = ? AND status = 'leased' ''', (self.worker_id,))
+            connection.execute('DELETE FROM leases WHERE worker = ?', (self.worker_id,))
+            connection.execute('DELETE FROM workers WHERE worker = ?', (self.worker_id,))
+        logger.info(f"Worker {self.worker_id} left the job queue")
+        return False
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(HEARTBEAT_SECONDS):
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                logger.warning(f"Job queue heartbeat failed: {e}")
+
+    #Extends every job and named lease this worker holds
+    def renew(self):
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute("UPDATE jobs SET lease_expires = ? WHERE worker = ? AND status = 'leased'", (now + LEASE_SECONDS, self.worker_id))
+            connection.execute('UPDATE leases SET expires = ? WHERE worker = ?', (now + LEASE_SECONDS, self.worker_id))
+            connection.execute('UPDATE workers SET heartbeat = ? WHERE worker = ?', (now, self.worker_id))
+
+    def try_lease(self, name):
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute('SELECT worker, expires FROM leases WHERE name = ?', (name,)).fetchone()
+            if row is not None and row[0] != self.worker_id and row[1] > now:
+                return False
+            connection.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?)', (name, self.worker_id, now + LEASE_SECONDS))
+            return True
+
+    def wait_for_lease(self, name):
+        while not self.try_lease(name):
+            time.sleep(POLL_SECONDS)
+
+    def release(self, name):
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM leases WHERE name = ? AND worker = ?', (name, self.worker_id))
+
+    #Whether another live worker holds the lease
+    def lease_held(self, name):
+        with self._transaction() as connection:
+            row = connection.execute('SELECT worker, expires FROM leases WHERE name = ?', (name,)).fetchone()
+        return row is not None and row[0] != self.worker_id and row[1] > time.time()
+
+    def directory_in_progress(self, dir_name):
+        with self._transaction() as connection:
+            row = connection.execute('SELECT finalized, failed FROM directories WHERE dir = ?', (dir_name,)).fetchone()
+        return row is not None and row[0] == 0 and row[1] == 0
+
+    #Queues the scene pairs of a directory, as (band4, band5, file_name, adopt). Pairs and directories queued in an
+    #earlier run start over.
+    def enqueue_directory(self, dir_name, scene_pairs):
+        with self._transaction() as connection:
+            connection.executemany('''INSERT INTO jobs (dir, file_name, band4, band5, adopt) VALUES (?, ?, ?, ?, ?)
+                                      ON CONFLICT (dir, file_name) DO UPDATE SET band4 = excluded.band4, band5 = excluded.band5, adopt = excluded.adopt,
+                                          status = 'pending', attempts = 0, worker = NULL, lease_expires = NULL, record = NULL, error = NULL''',
+                                   [(dir_name, file_name, band4, band5, int(adopt)) for band4, band5, file_name, adopt in scene_pairs])
+            connection.execute('INSERT OR REPLACE INTO directories (dir, finalized) VALUES (?, ?)', (dir_name, 0 if scene_pairs else 1))
+
+    #Leases the next pending job, or one whose worker stopped renewing it. Returns (job_id, dir, band4, band5,
+    #file_name, adopt) or None when nothing is claimable.
+    def claim(self):
+        now = time.time()
+        with self._transaction() as connection:
+            connection.execute('''UPDATE jobs SET status = 'failed', worker = NULL, error = 'lease expired'
+                                  WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?''', (now, MAX_ATTEMPTS))
+            row = connection.execute('''SELECT id, dir, band4, band5, file_name, adopt FROM jobs
+                                        WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?)
+                                        ORDER BY id LIMIT 1''', (now,)).fetchone()
+            if row is None:
+                return None
+            connection.execute('''UPDATE jobs SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1
+                                  WHERE id = ?''', (self.worker_id, now + LEASE_SECONDS, row[0]))
+        return row
+
+    #A job whose lease was lost meanwhile is left to the worker that took it over; both write the same image
+    def complete(self, job_id, record):
+        with self._transaction() as connection:
+            cursor = connection.execute('''UPDATE jobs SET status = 'done', record = ?, error = NULL, worker = NULL, lease_expires = NULL
+                                           WHERE id = ? AND worker = ?''', (json.dumps(record), job_id, self.worker_id))
+            if cursor.rowcount == 0:
+                return False
+            connection.execute('UPDATE workers SET scenes = scenes + 1 WHERE worker = ?', (self.worker_id,))
+        return True
+
+    def fail(self, job_id, error):
+        with self._transaction() as connection:
+            connection.execute('''UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                                      error = ?, worker = NULL, lease_expires = NULL
+                                  WHERE id = ? AND worker = ?''', (MAX_ATTEMPTS, str(error), job_id, self.worker_id))
+
+    #Directories not yet finalized or given up on whose jobs have all finished
+    def finishable_directories(self):
+        with self._transaction() as connection:
+            rows = connection.execute('''SELECT dir FROM directories d WHERE finalized = 0 AND failed = 0 AND NOT EXISTS (
+                                             SELECT 1 FROM jobs j WHERE j.dir = d.dir AND j.status IN ('pending', 'leased'))
+                                         ORDER BY dir''').fetchall()
+        return [row[0] for row in rows]
+
+    #Manifest records of the directory's done scenes
+    def directory_records(self, dir_name):
+        with self._transaction() as connection:
+            rows = connection.execute("SELECT file_name, record FROM jobs WHERE dir = ? AND status = 'done'", (dir_name,)).fetchall()
+        return {file_name: json.loads(record) for file_name, record in rows}
+
+    #Done jobs are dropped once their records are in the manifest; failed ones stay for inspection
+    def mark_finalized(self, dir_name):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM jobs WHERE dir = ? AND status = 'done'", (dir_name,))
+            connection.execute('UPDATE directories SET finalized = 1, error = NULL WHERE dir = ?', (dir_name,))
+
+    #Counts a failed attempt at finalizing a directory and returns True once it is given up on
+    def fail_finalize(self, dir_name, error):
+        with self._transaction() as connection:
+            connection.execute('''UPDATE directories SET finalize_attempts = finalize_attempts + 1, error = ?,
+                                      failed = CASE WHEN finalize_attempts + 1 >= ? THEN 1 ELSE 0 END
+                                  WHERE dir = ?''', (str(error), MAX_ATTEMPTS, dir_name))
+            row = connection.execute('SELECT failed FROM directories WHERE dir = ?', (dir_name,)).fetchone()
+        return row is not None and row[0] == 1
+
+    #Jobs per status, directories still to finalize or given up on, and live workers
+    def counts(self):
+        now = time.time()
+        with self._transaction() as connection:
+            counts = dict(connection.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+            counts['unfinalized'] = connection.execute('SELECT COUNT(*) FROM directories WHERE finalized = 0 AND failed = 0').fetchone()[0]
+            counts['failed_directories'] = connection.execute('SELECT COUNT(*) FROM directories WHERE failed = 1').fetchone()[0]
+            counts['workers'] = connection.execute('SELECT COUNT(*) FROM workers WHERE heartbeat > ?', (now - LEASE_SECONDS,)).fetchone()[0]
+        return {status: counts.get(status, 0) for status in ('pending', 'leased', 'done', 'failed', 'unfinalized', 'failed_directories', 'workers')}
+
+    #Nothing left to convert or finalize, and nobody is still scanning the input for more. Failed jobs and
+    #directories count as finished.
+    def is_drained(self):
+        counts = self.counts()
+        return counts['pending'] == 0 and counts['leased'] == 0 and counts['unfinalized'] == 0 and not self.lease_held('scan')
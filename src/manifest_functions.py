@@ -0,0 +1,111 @@
+import os
+import json
+import hashlib
+from log_config import logger
+
+MANIFEST_FILE_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+HASH_CHUNK_SIZE = 1 << 20
+#Completed scenes are committed to the manifest at least this often, so a crash only loses this much work
+MANIFEST_FLUSH_SCENES = 64
+
+#Each output date directory has a manifest.json recording, per scene, the size, mtime and blake2b hash of both
+#input bands, the size and hash of the NDVI image, the MBR and the processing parameters it was made with.
+#The input directory's mtime and scene pairs are stored as well, so an unchanged directory is never listed again.
+
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_stat_record(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def file_record(path):
+    record = file_stat_record(path)
+    record['name'] = os.path.basename(path)
+    record['blake2b'] = file_hash(path)
+    return record
+
+def conversion_params(quality='60', codec='JPEG', cog=False):
+    return {'quality': str(quality), 'codec': codec, 'cog': bool(cog)}
+
+def manifest_path(output_directory, dir_name):
+    return os.path.join(output_directory, dir_name, MANIFEST_FILE_NAME)
+
+def empty_manifest():
+    return {'version': MANIFEST_VERSION, 'input_mtime_ns': None, 'input_pairs': [], 'scenes': {}}
+
+def load_manifest(output_directory, dir_name):
+    path = manifest_path(output_directory, dir_name)
+    if not os.path.isfile(path):
+        return empty_manifest()
+    try:
+        with open(path, 'r') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Manifest {path} could not be read, rebuilding it: {e}")
+        return empty_manifest()
+    if manifest.get('version') != MANIFEST_VERSION:
+        logger.warning(f"Manifest {path} has version {manifest.get('version')}, rebuilding it")
+        return empty_manifest()
+    return manifest
+
+#Writes the manifest to a temporary file and renames it over the old one, so a crash leaves either the old or the new manifest
+def save_manifest(output_directory, dir_name, manifest):
+    path = manifest_path(output_directory, dir_name)
+    temp_path = os.path.join(os.path.dirname(path), f'.{MANIFEST_FILE_NAME}.{os.getpid()}.tmp')
+    with open(temp_path, 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+def scene_record(band4, band5, output_path, params, mbr):
+    return {
+        'inputs': {'B4': file_record(band4), 'B5': file_record(band5)},
+        'output': file_record(output_path),
+        'params': params,
+        'mbr': mbr
+    }
+
+#Checks a scene against its manifest record and returns (current, refreshed). Unchanged sizes and mtimes are
+#trusted without reading the files. An input with a new mtime but the same size is hashed, and if its content
+#is unchanged the record takes the new mtime (refreshed) instead of the scene being converted again.
+#With verify=True the output is hashed as well.
+def scene_is_current(record, band4, band5, output_path, params, verify=False):
+    if record is None or record.get('params') != params:
+        return False, False
+    try:
+        output_stat = file_stat_record(output_path)
+    except FileNotFoundError:
+        return False, False
+    if output_stat['size'] != record['output']['size']:
+        return False, False
+    if verify and file_hash(output_path) != record['output']['blake2b']:
+        logger.warning(f"Output {output_path} does not match its manifest checksum")
+        return False, False
+
+    refreshed = False
+    for band, path in (('B4', band4), ('B5', band5)):
+        saved = record['inputs'][band]
+        try:
+            current = file_stat_record(path)
+        except FileNotFoundError:
+            return False, False
+        if saved['name'] != os.path.basename(path) or current['size'] != saved['size']:
+            return False, False
+        if current['mtime_ns'] != saved['mtime_ns']:
+            if file_hash(path) != saved['blake2b']:
+                return False, False
+            saved['mtime_ns'] = current['mtime_ns']
+            refreshed = True
+    return True, refreshed
+
+#FileName and MBR columns of raster_index.csv for every scene in the manifest
+def manifest_raster_dict(manifest):
+    names = sorted(manifest['scenes'])
+    return {'FileName': names, 'MBR': [manifest['scenes'][name]['mbr'] for name in names]}
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import cProfile
+import threading
+from contextlib import contextmanager
+from log_config import logger
+
+METRICS_FILE_ENV = 'NDVI_METRICS_FILE'
+PROFILERS = ['cprofile', 'pyinstrument']
+
+#Appends one JSON line per timed stage or gauge sample to a metrics file shared by every process pointed at it.
+#Lines are short and the file is opened in append mode, so lines from worker processes never interleave.
+class MetricsRecorder:
+    def __init__(self, path, truncate=False):
+        self.path = path
+        self._lock = threading.Lock()
+        if truncate:
+            open(path, 'w').close()
+        self._open()
+
+    #Every process appends, so lines written by workers are never overwritten by the parent's file position
+    def _open(self):
+        self._file = open(self.path, 'a', buffering=1)
+
+    def _write(self, event):
+        line = json.dumps(event, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+
+    def record(self, stage, seconds, nbytes=0, **fields):
+        self._write({'event': 'stage', 'stage': stage, 'seconds': seconds, 'bytes': nbytes,
+                     'pid': os.getpid(), 'thread': threading.get_ident(), 'time': time.time(), **fields})
+
+    def gauge(self, name, **values):
+        self._write({'event': 'gauge', 'gauge': name, 'pid': os.getpid(), 'time': time.time(), **values})
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def reopen_after_fork(self):
+        self._lock = threading.Lock()
+        self._open()
+
+#Times one stage and records it on exit. Bytes can be given up front or added while the stage runs.
+class StageTimer:
+    __slots__ = ('recorder', 'stage', 'nbytes', 'fields', 'start')
+
+    def __init__(self, recorder, stage, nbytes, fields):
+        self.recorder = recorder
+        self.stage = stage
+        self.nbytes = nbytes
+        self.fields = fields
+
+    def add_bytes(self, nbytes):
+        self.nbytes += nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.recorder.record(self.stage, time.perf_counter() - self.start, self.nbytes, **self.fields)
+        return False
+
+#Stand-in returned while metrics are off, so an instrumented stage only costs a global lookup and two no-op calls
+class NullTimer:
+    __slots__ = ()
+
+    def add_bytes(self, nbytes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_timer = NullTimer()
+_recorder = None
+
+#Turns metrics on for this process and, through the environment, for any worker processes it starts
+def enable_metrics(path):
+    global _recorder
+    _recorder = MetricsRecorder(path, truncate=True)
+    os.environ[METRICS_FILE_ENV] = path
+    logger.info(f"Writing stage metrics to {path}")
+    return _recorder
+
+def metrics_enabled():
+    return _recorder is not None
+
+def stage_timer(stage, nbytes=0, **fields):
+    if _recorder is None:
+        return _null_timer
+    return StageTimer(_recorder, stage, nbytes, fields)
+
+def record_stage(stage, seconds, nbytes=0, **fields):
+    if _recorder is not None:
+        _recorder.record(stage, seconds, nbytes, **fields)
+
+def record_gauge(name, **values):
+    if _recorder is not None:
+        _recorder.gauge(name, **values)
+
+#Runs func(*args) and returns its result with its run time, recording it as a stage named after func
+def timed_call(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    record_stage(func.__name__, seconds)
+    return result, seconds
+
+#Records how busy a pool was: the worker seconds spent on tasks over the worker seconds available
+def record_pool_utilization(name, busy_seconds, wall_seconds, workers, **values):
+    if _recorder is not None and wall_seconds > 0:
+        _recorder.gauge(name, workers=workers, wall_seconds=wall_seconds, busy_seconds=busy_seconds,
+                        utilization=busy_seconds / (wall_seconds * workers), **values)
+
+#Totals per stage over every process that wrote to the metrics file: count, seconds, bytes and MB/s
+def summarize_metrics(path):
+    totals = {}
+    with open(path) as file:
+        for line in file:
+            event = json.loads(line)
+            if event['event'] != 'stage':
+                continue
+            total = totals.setdefault(event['stage'], {'count': 0, 'seconds': 0.0, 'bytes': 0})
+            total['count'] += 1
+            total['seconds'] += event['seconds']
+            total['bytes'] += event['bytes']
+    for total in totals.values():
+        total['mb_per_s'] = total['bytes'] / 1e6 / total['seconds'] if total['bytes'] and total['seconds'] > 0 else None
+    return totals
+
+def log_metrics_summary():
+    if _recorder is None:
+        return
+    for stage, total in sorted(summarize_metrics(_recorder.path).items(), key=lambda item: -item[1]['seconds']):
+        throughput = f", {total['mb_per_s']:.1f} MB/s" if total['mb_per_s'] is not None else ''
+        logger.info(f"Stage {stage}: {total['count']} calls, {total['seconds']:.3f} s{throughput}")
+
+#Profiles the with block with cProfile (a .prof file for pstats or snakeviz) or pyinstrument (an HTML report
+#when path ends in .html, text otherwise). Worker processes are not profiled, their stages are in the metrics file.
+@contextmanager
+def profile_run(path=None, profiler='cprofile'):
+    if path is None:
+        yield
+        return
+
+    if profiler == 'pyinstrument':
+        try:
+            import pyinstrument
+        except ImportError:
+            logger.warning("pyinstrument is not installed, profiling with cProfile instead")
+        else:
+            session = pyinstrument.Profiler()
+            session.start()
+            try:
+                yield
+            finally:
+                session.stop()
+                with open(path, 'w') as file:
+                    file.write(session.output_html() if path.endswith('.html') else session.output_text())
+                logger.info(f"Profile written to {path}")
+            return
+
+    session = cProfile.Profile()
+    session.enable()
+    try:
+        yield
+    finally:
+        session.disable()
+        session.dump_stats(path)
+        logger.info(f"Profile written to {path}")
+
+def _reopen_after_fork():
+    if _recorder is not None:
+        _recorder.reopen_after_fork()
+
+os.register_at_fork(after_in_child=_reopen_after_fork)
+
+if os.environ.get(METRICS_FILE_ENV):
+    _recorder = MetricsRecorder(os.environ[METRICS_FILE_ENV])
@@ -0,0 +1,77 @@
+import os
+import hashlib
+from glob import glob
+from osgeo import gdal, osr
+from wkt_functions import wkt_to_bounds
+from raster_index_functions import set_date_mosaics
+from log_config import logger
+
+MOSAIC_NODATA = 0
+MOSAIC_PREFIX = 'mosaic_'
+
+#Per-date virtual mosaics. The NDVI images of a date that share a CRS are combined into one VRT, mosaic_<crs>.vrt,
+#in the date directory. Images are listed in sorted file name order and 0 is nodata, so where images overlap the
+#later file wins wherever it has data, the same rule as the datacube. A date normally has one mosaic; images in
+#other UTM zones get a mosaic of their own, since a VRT cannot mix projections.
+
+#Mosaics of a date directory, sorted by name
+def list_date_mosaics(directory_path):
+    return sorted(glob(os.path.join(directory_path, MOSAIC_PREFIX + '*.vrt')))
+
+#Short name for a CRS: EPSG_<code> when it has one, otherwise a hash of its WKT
+def crs_tag(projection_wkt):
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(projection_wkt)
+    srs.AutoIdentifyEPSG()
+    code = srs.GetAuthorityCode(None)
+    if code is not None:
+        return f'EPSG_{code}'
+    return 'WKT_' + hashlib.sha1(projection_wkt.encode()).hexdigest()[:12]
+
+#Builds the mosaics of a date directory from its raster_dict (FileName and MBR) and records them in the raster
+#index with the union of their images' MBRs. Mosaics of CRSs no longer in the directory are removed.
+def build_date_mosaics(output_directory, dir_name, raster_dict):
+    directory_path = os.path.join(output_directory, dir_name)
+    groups = {}
+    for file_name, mbr in sorted(zip(raster_dict['FileName'], raster_dict['MBR'])):
+        path = os.path.join(directory_path, file_name + '.tif')
+        dataset = gdal.Open(path)
+        if dataset is None:
+            logger.warning(f"Cannot open {path}, leaving it out of the mosaic")
+            continue
+        tag = crs_tag(dataset.GetProjection())
+        dataset = None
+        group = groups.setdefault(tag, {'sources': [], 'bounds': []})
+        group['sources'].append(path)
+        group['bounds'].append(wkt_to_bounds(mbr))
+
+    mosaics = []
+    for tag, group in groups.items():
+        mosaic_name = f'{MOSAIC_PREFIX}{tag}.vrt'
+        temp_path = os.path.join(directory_path, f'.{mosaic_name}.tmp')
+        options = gdal.BuildVRTOptions(resolution='highest', srcNodata=MOSAIC_NODATA, VRTNodata=MOSAIC_NODATA)
+        # Sources next to the VRT are written relative to it, so the output tree can be moved
+        vrt = gdal.BuildVRT(temp_path, group['sources'], options=options)
+        if vrt is None:
+            raise ValueError(f"GDAL could not build {mosaic_name}")
+        vrt = None
+        os.replace(temp_path, os.path.join(directory_path, mosaic_name))
+
+        bounds = group['bounds']
+        mbr = [min(b[0] for b in bounds), min(b[1] for b in bounds), max(b[2] for b in bounds), max(b[3] for b in bounds)]
+        mosaics.append((mosaic_name, mbr))
+
+    built = {name for name, _ in mosaics}
+    for path in list_date_mosaics(directory_path):
+        if os.path.basename(path) not in built:
+            os.remove(path)
+
+    set_date_mosaics(output_directory, dir_name, mosaics)
+    logger.debug(f"Built {len(mosaics)} mosaics for {dir_name}")
+    return [os.path.join(directory_path, name) for name, _ in mosaics]
+
+#Removes the mosaics of a date, so its queries and pixel export go back to reading the images
+def drop_date_mosaics(output_directory, dir_name):
+    for path in list_date_mosaics(os.path.join(output_directory, dir_name)):
+        os.remove(path)
+    set_date_mosaics(output_directory, dir_name, [])
@@ -1,44 +1,239 @@
-import rasterio as rio
 import numpy as np
-from pyproj import Transformer
-import rioxarray as rxr
-from wkt_functions import load_wkt_as_geodataframe
-import geopandas
+import hashlib
+from rasterio.windows import Window
+from rasterio.windows import transform as window_transform
+from rasterio.transform import rowcol
+from rasterio.features import geometry_mask, rasterize
+from shapely import STRtree
+from shapely.ops import transform as shapely_transform
+from disk_block_cache import get_disk_block_cache
+from metrics import stage_timer
+from resource_cache import get_transformer, load_wkt, open_dataset, dataset_key, block_cache, mask_cache, geometry_cache
 def get_ndvi_value_from_latlon(latitude, longitude, file_path, src_crs='EPSG:4326', dst_crs=None):
-    with rio.open(file_path) as dataset:
-        if dst_crs is None:
-            dst_crs = dataset.crs.to_string()
-
-        transformer = Transformer.from_crs(src_crs, dst_crs, always_xy=True)
-        x, y = transformer.transform(longitude, latitude)
-
-        try:
-            row, col = dataset.index(x, y)
-            if (0 <= row < dataset.height) and (0 <= col < dataset.width):
-                pixel_value = dataset.read(1)[row, col]
-                return pixel_value
-            else:
-                print(f"Coordinates ({latitude}, {longitude}) are out of bounds for this image.")
-                return 0
-        except IndexError as e:
-            print(f"Coordinates ({latitude}, {longitude}) caused an index error: {e}")
-            return 0
+    values, inside = sample_ndvi_values([latitude], [longitude], file_path, src_crs, dst_crs)
+    if not inside[0]:
+        print(f"Coordinates ({latitude}, {longitude}) are out of bounds for this image.")
+    return values[0]
+
+#Samples many points from one image. Only the blocks that contain a point are read and decoded,
+#each of them once. Returns the values (0 outside the image) and a mask of the points inside the image.
+def sample_ndvi_values(latitudes, longitudes, file_path, src_crs='EPSG:4326', dst_crs=None):
+    with open_dataset(file_path) as dataset:
+        return sample_dataset_values(dataset, latitudes, longitudes, src_crs, dst_crs)
+
+def sample_dataset_values(dataset, latitudes, longitudes, src_crs='EPSG:4326', dst_crs=None, band_id=1):
+    latitudes = np.atleast_1d(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.atleast_1d(np.asarray(longitudes, dtype=np.float64))
+    if dst_crs is None:
+        dst_crs = dataset.crs.to_string()
+
+    transformer = get_transformer(src_crs, dst_crs)
+    xs, ys = transformer.transform(longitudes, latitudes)
+
+    rows, cols = rowcol(dataset.transform, xs, ys)
+    rows = np.atleast_1d(np.asarray(rows, dtype=np.int64))
+    cols = np.atleast_1d(np.asarray(cols, dtype=np.int64))
+
+    values = np.zeros(latitudes.shape, dtype=dataset.dtypes[band_id - 1])
+    inside = (rows >= 0) & (rows < dataset.height) & (cols >= 0) & (cols < dataset.width)
+    if not inside.any():
+        return values, inside
+
+    block_height, block_width = dataset.block_shapes[band_id - 1]
+    blocks_per_row = (dataset.width + block_width - 1) // block_width
+    point_index = np.flatnonzero(inside)
+    block_ids = (rows[point_index] // block_height) * blocks_per_row + cols[point_index] // block_width
+    order = np.argsort(block_ids, kind='stable')
+    unique_ids, starts = np.unique(block_ids[order], return_index=True)
+    ends = np.append(starts[1:], order.size)
+
+    key = dataset_key(dataset.name)
+    for block_id, start, end in zip(unique_ids, starts, ends):
+        block_row, block_col = divmod(int(block_id), blocks_per_row)
+        row_off, col_off = block_row * block_height, block_col * block_width
+        block = read_block(dataset, key, band_id, block_row, block_col)
+
+        selected = point_index[order[start:end]]
+        values[selected] = block[rows[selected] - row_off, cols[selected] - col_off]
+
+    return values, inside
+
+ZONAL_CHUNK_ROWS = 512
+
+#Decoded blocks are cached per file version, band and block index, in memory and, when enabled, on disk
+def read_block(dataset, key, band_id, block_row, block_col):
+    block_key = key + (band_id, block_row, block_col)
+    block = block_cache.get(block_key)
+    if block is not None:
+        return block
+
+    disk_cache = get_disk_block_cache()
+    if disk_cache is not None:
+        with stage_timer('disk_block_read'):
+            block = disk_cache.get(block_key)
+    if block is None:
+        block_height, block_width = dataset.block_shapes[band_id - 1]
+        row_off, col_off = block_row * block_height, block_col * block_width
+        window = Window(col_off, row_off, min(block_width, dataset.width - col_off), min(block_height, dataset.height - row_off))
+        with stage_timer('block_decode') as timer:
+            block = dataset.read(band_id, window=window)
+            timer.add_bytes(block.nbytes)
+        block.setflags(write=False)
+        if disk_cache is not None:
+            with stage_timer('disk_block_write', block.nbytes):
+                disk_cache.put(block_key, block)
+    block_cache.put(block_key, block)
+    return block
+
+#Reads a window by assembling it from cached blocks. A window inside a single block is returned as a read-only
+#view of that block, which for a warm disk cache is a view of the memory-mapped block file.
+def read_window(dataset, window, band_id=1):
+    key = dataset_key(dataset.name)
+    block_height, block_width = dataset.block_shapes[band_id - 1]
+    row_start, col_start = int(window.row_off), int(window.col_off)
+    row_stop, col_stop = row_start + int(window.height), col_start + int(window.width)
+
+    first_block_row, first_block_col = row_start // block_height, col_start // block_width
+    if (row_stop - 1) // block_height == first_block_row and (col_stop - 1) // block_width == first_block_col:
+        block = read_block(dataset, key, band_id, first_block_row, first_block_col)
+        top, left = row_start - first_block_row * block_height, col_start - first_block_col * block_width
+        return block[top:top + row_stop - row_start, left:left + col_stop - col_start]
+
+    out = np.empty((row_stop - row_start, col_stop - col_start), dtype=dataset.dtypes[band_id - 1])
+
+    for block_row in range(row_start // block_height, (row_stop - 1) // block_height + 1):
+        for block_col in range(col_start // block_width, (col_stop - 1) // block_width + 1):
+            block = read_block(dataset, key, band_id, block_row, block_col)
+            block_top, block_left = block_row * block_height, block_col * block_width
+            top, bottom = max(row_start, block_top), min(row_stop, block_top + block.shape[0])
+            left, right = max(col_start, block_left), min(col_stop, block_left + block.shape[1])
+            out[top - row_start:bottom - row_start, left - col_start:right - col_start] = \
+                block[top - block_top:bottom - block_top, left - block_left:right - block_left]
+    return out
+
+def geometry_key(geometry):
+    return hashlib.sha1(geometry.wkb).hexdigest()
+
+def project_geometry(geometry, src_crs, dst_crs, key=None):
+    if src_crs == dst_crs:
+        return geometry
+    project = lambda: shapely_transform(get_transformer(src_crs, dst_crs).transform, geometry)
+    if key is None:
+        return project()
+    return geometry_cache.get_or_create(('projected', key, src_crs, dst_crs), project)
+
+#Pixel window covering bounds, rounded outwards and cut to the dataset, or None if they do not overlap
+def bounds_window(dataset, bounds):
+    min_x, min_y, max_x, max_y = bounds
+    rows, cols = rowcol(dataset.transform, [min_x, max_x, min_x, max_x], [min_y, min_y, max_y, max_y])
+    row_start, row_stop = max(min(rows), 0), min(max(rows) + 1, dataset.height)
+    col_start, col_stop = max(min(cols), 0), min(max(cols) + 1, dataset.width)
+    if row_start >= row_stop or col_start >= col_stop:
+        return None
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+#Masks are cached per geometry and tile grid, so every date that shares a grid rasterizes the polygon only once
+def cached_geometry_mask(key, geometry, window_transform, shape):
+    cache_key = (key, tuple(window_transform)[:6], shape)
+    return mask_cache.get_or_create(cache_key, lambda: geometry_mask([geometry], out_shape=shape, transform=window_transform, invert=True))
+
+#256-bin histogram of the NDVI codes inside geometry (given in crs). Only the geometry's bounding window is read,
+#a chunk of rows at a time, so memory stays constant however large the polygon is. Bin 0 (nodata) is always empty.
+def dataset_zonal_histogram(dataset, geometry, crs='EPSG:4326', band_id=1, key=None):
+    if dataset.dtypes[band_id - 1] != 'uint8':
+        raise ValueError(f"{dataset.name} is not a uint8 NDVI image")
+
+    histogram = np.zeros(256, dtype=np.int64)
+    dst_crs = dataset.crs.to_string()
+    key = key or geometry_key(geometry)
+    raster_geometry = project_geometry(geometry, crs, dst_crs, key)
+    window = bounds_window(dataset, raster_geometry.bounds)
+    if window is None:
+        return histogram
+
+    key = (key, crs, dst_crs)
+    for row_off in range(window.row_off, window.row_off + window.height, ZONAL_CHUNK_ROWS):
+        chunk = Window(window.col_off, row_off, window.width, min(ZONAL_CHUNK_ROWS, window.row_off + window.height - row_off))
+        mask = cached_geometry_mask(key, raster_geometry, window_transform(chunk, dataset.transform), (chunk.height, chunk.width))
+        if not mask.any():
+            continue
+        codes = read_window(dataset, chunk, band_id)
+        histogram += np.bincount(codes[mask], minlength=256)
+
+    histogram[0] = 0
+    return histogram
+
+def zonal_histogram(geometry, raster_path, crs='EPSG:4326', key=None):
+    with open_dataset(raster_path) as dataset:
+        return dataset_zonal_histogram(dataset, geometry, crs, key=key)
+
+#Splits geometries into layers whose members do not overlap, so each layer can be burned into one label raster.
+#Neighbouring parcels that only share an edge stay in the same layer.
+def non_overlapping_layers(geometries):
+    tree = STRtree(geometries)
+    layer_of = [-1] * len(geometries)
+    layers = []
+    for i, geometry in enumerate(geometries):
+        taken = {layer_of[j] for j in tree.query(geometry, predicate='intersects')
+                 if j < i and not geometry.touches(geometries[j])}
+        layer = next((l for l in range(len(layers)) if l not in taken), len(layers))
+        if layer == len(layers):
+            layers.append([])
+        layers[layer].append(i)
+        layer_of[i] = layer
+    return layers
+
+#256-bin code histograms for many geometries (given in crs) from one image. The window covering all of them is
+#decoded once per chunk of rows, and every layer of non-overlapping geometries is burned into a feature-ID label
+#raster that splits the chunk between them in a single bincount. Returns an array of shape (len(geometries), 256).
+def dataset_label_histograms(dataset, geometries, crs='EPSG:4326', band_id=1):
+    if dataset.dtypes[band_id - 1] != 'uint8':
+        raise ValueError(f"{dataset.name} is not a uint8 NDVI image")
+
+    histograms = np.zeros((len(geometries), 256), dtype=np.int64)
+    dst_crs = dataset.crs.to_string()
+    raster_geometries = [project_geometry(geometry, crs, dst_crs) for geometry in geometries]
+    geometry_bounds = np.array([geometry.bounds for geometry in raster_geometries])
+    window = bounds_window(dataset, (geometry_bounds[:, 0].min(), geometry_bounds[:, 1].min(),
+                                     geometry_bounds[:, 2].max(), geometry_bounds[:, 3].max()))
+    if window is None:
+        return histograms
+
+    layers = non_overlapping_layers(raster_geometries)
+    for row_off in range(window.row_off, window.row_off + window.height, ZONAL_CHUNK_ROWS):
+        chunk = Window(window.col_off, row_off, window.width, min(ZONAL_CHUNK_ROWS, window.row_off + window.height - row_off))
+        chunk_transform = window_transform(chunk, dataset.transform)
+        chunk_left, chunk_top = chunk_transform * (0, 0)
+        chunk_right, chunk_bottom = chunk_transform * (chunk.width, chunk.height)
+        in_chunk = ((geometry_bounds[:, 0] <= max(chunk_left, chunk_right)) & (geometry_bounds[:, 2] >= min(chunk_left, chunk_right))
+                    & (geometry_bounds[:, 1] <= max(chunk_top, chunk_bottom)) & (geometry_bounds[:, 3] >= min(chunk_top, chunk_bottom)))
+
+        codes = None
+        for layer in layers:
+            shapes = [(raster_geometries[i], i + 1) for i in layer if in_chunk[i]]
+            if not shapes:
+                continue
+            labels = rasterize(shapes, out_shape=(chunk.height, chunk.width), transform=chunk_transform, fill=0, dtype='int32')
+            inside = labels > 0
+            if not inside.any():
+                continue
+            if codes is None:
+                codes = read_window(dataset, chunk, band_id)
+            counts = np.bincount(labels[inside].astype(np.int64) * 256 + codes[inside], minlength=(len(geometries) + 1) * 256)
+            histograms += counts.reshape(len(geometries) + 1, 256)[1:]
+
+    histograms[:, 0] = 0
+    return histograms
 
 def get_ndvi_from_range(wkt_string, raster_path='', crs='EPSG:4326'):
-    aoi_gdf = load_wkt_as_geodataframe(wkt_string, crs)
     integer_array = []
     
     try:
-        ndvi_image = rxr.open_rasterio(raster_path)
-        aoi_gdf = aoi_gdf.to_crs(ndvi_image.rio.crs.to_string())
-        clipped_band = ndvi_image.rio.clip(aoi_gdf.geometry, from_disk=True)
-        masked_band_values = clipped_band.where(clipped_band > 0, np.nan).values
-
-        cleaned_array = masked_band_values[~np.isnan(masked_band_values)]
-        integer_array = cleaned_array.astype(int)
+        histogram = zonal_histogram(load_wkt(wkt_string), raster_path, crs)
+        integer_array = np.repeat(np.arange(256), histogram)
 
     except Exception as e:
         print(f"An error occurred: {e} with file {raster_path}. NOT AN NDVI IMAGE")
         pass
 
-    return integer_array
\ No newline at end of file
+    return integer_array
@@ -1,101 +1,230 @@
 import os
-import pandas as pd
 from glob import glob
 from queue import Queue
 import threading as th
-from osgeo import gdal
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from osgeo import gdal, gdal_array
 import numpy as np
-from bounding_box_functions import get_boundingbox
+from bounding_box_functions import get_boundingbox, boundingbox_from_geotransform
+from ndvi_kernel_functions import make_ndvi_kernel
+from raster_index_functions import add_rasters_to_index
+from manifest_functions import (MANIFEST_FLUSH_SCENES, conversion_params, load_manifest, save_manifest, scene_record,
+                                scene_is_current, manifest_raster_dict)
+from metrics import stage_timer, record_gauge, record_pool_utilization
 from log_config import logger
-import unittest
-from extract_pixels import *
 np.seterr(divide='ignore', invalid='ignore')
 
-def import_red_nir_bands(red_file_path, nir_file_path):
-    try:
-        red = gdal.Open(red_file_path)
-        nir = gdal.Open(nir_file_path)
-
-        if red is None or nir is None:
-            raise FileNotFoundError(f"Cannot open one of the files: {red_file_path} or {nir_file_path}")
-
-        red_gt = red.GetGeoTransform()
-        red_proj = red.GetProjection()
-        nir_gt = nir.GetGeoTransform()
-        nir_proj = nir.GetProjection()
-
-        if not np.allclose(red_gt, nir_gt, atol=1e-6) or red_proj != nir_proj:
-            raise ValueError("Geotransform or projection of the bands do not match!")
-
-        red_band = red.GetRasterBand(1)
-        red_array = red_band.ReadAsArray() / 10000.0
-
-        nir_band = nir.GetRasterBand(1)
-        nir_array = nir_band.ReadAsArray() / 10000.0
-
-        if red_array is None or nir_array is None:
-            raise ValueError("Failed to read one of the arrays")
-
-        return red_array, nir_array, red_gt, red_proj
-
-    except FileExistsError as f:
-        logger.error(f"File exists error: {f}")
-        return None, None, None, None
-    except ValueError as v:
-        logger.error(v)
-        return None, None, None, None
-    except Exception as e:
-        logger.error(f"Error in import_red_nir_bands: Unable to process bands. {e}")
-        return None, None, None, None
+def open_red_nir_bands(red_file_path, nir_file_path):
+    red = gdal.Open(red_file_path)
+    nir = gdal.Open(nir_file_path)
+
+    if red is None or nir is None:
+        raise FileNotFoundError(f"Cannot open one of the files: {red_file_path} or {nir_file_path}")
+
+    red_gt = red.GetGeoTransform()
+    red_proj = red.GetProjection()
+    nir_gt = nir.GetGeoTransform()
+    nir_proj = nir.GetProjection()
+
+    if not np.allclose(red_gt, nir_gt, atol=1e-6) or red_proj != nir_proj:
+        raise ValueError("Geotransform or projection of the bands do not match!")
+    if (red.RasterXSize, red.RasterYSize) != (nir.RasterXSize, nir.RasterYSize):
+        raise ValueError("Size of the bands do not match!")
+
+    return red, nir, red_gt, red_proj
+
+#Rows per chunk: whole input blocks, at least min_rows tall, and a multiple of the output strip height
+#so every compressed output strip is written exactly once
+def chunk_rows_for(in_block_rows, out_block_rows, min_rows=256):
+    rows = in_block_rows * -(-min_rows // in_block_rows)
+    return out_block_rows * -(-rows // out_block_rows)
+
+NDVI_CODECS = ['JPEG', 'DEFLATE', 'ZSTD', 'LZW', 'NONE']
+COG_BLOCK_SIZE = 512
+
+#GTiff creation options for an NDVI image. JPEG is lossy and small; DEFLATE, ZSTD and LZW are lossless and use
+#a horizontal predictor, which suits the smooth NDVI codes
+def ndvi_creation_options(codec='JPEG', quality='60', tiled=False):
+    options = ["COMPRESS=" + codec]
+    if codec == 'JPEG':
+        options.append("JPEG_QUALITY=" + str(quality))
+    elif codec != 'NONE':
+        options.append("PREDICTOR=2")
+    if tiled:
+        options += ["TILED=YES", f"BLOCKXSIZE={COG_BLOCK_SIZE}", f"BLOCKYSIZE={COG_BLOCK_SIZE}"]
+    return options
+
+def cog_creation_options(codec='JPEG', quality='60'):
+    options = ["COMPRESS=" + codec, f"BLOCKSIZE={COG_BLOCK_SIZE}", "OVERVIEWS=AUTO", "RESAMPLING=AVERAGE"]
+    if codec == 'JPEG':
+        options.append("QUALITY=" + str(quality))
+    elif codec != 'NONE':
+        options.append("PREDICTOR=YES")
+    return options
+
+#Chunks in flight between the stages of a scene's pipeline, and the number of reusable buffers of each kind
+PIPELINE_DEPTH = 3
+
+#Runs the chunks of a scene through three stages: a reader thread fills PIPELINE_DEPTH reusable red/NIR buffer
+#pairs ahead of the kernel, the calling thread computes the codes, and a writer thread compresses and writes them.
+#GDAL I/O, compression and the kernels release the GIL, so reading, computing and encoding overlap. The queues
+#are bounded by the buffers. A conversion_pipeline gauge records the mean queue depth in front of the kernel and
+#the encoder and how long the kernel waited on each side, which shows the bottleneck stage.
+def run_chunk_pipeline(red_band, nir_band, outband, xsize, ysize, chunk_rows, ndvi_kernel):
+    red_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(red_band.DataType)
+    nir_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(nir_band.DataType)
+    read_buffers = [(np.empty((chunk_rows, xsize), dtype=red_dtype), np.empty((chunk_rows, xsize), dtype=nir_dtype)) for _ in range(PIPELINE_DEPTH)]
+    code_buffers = [np.empty((chunk_rows, xsize), dtype=np.uint8) for _ in range(PIPELINE_DEPTH)]
+    free_reads, free_codes, read_queue, encode_queue = Queue(), Queue(), Queue(), Queue()
+    for slot in range(PIPELINE_DEPTH):
+        free_reads.put(slot)
+        free_codes.put(slot)
+    stop = th.Event()
+    writer_errors = []
+
+    def reader():
+        try:
+            for yoff in range(0, ysize, chunk_rows):
+                slot = free_reads.get()
+                if stop.is_set():
+                    return
+                rows = min(chunk_rows, ysize - yoff)
+                red_buffer, nir_buffer = read_buffers[slot]
+                with stage_timer('band_read') as timer:
+                    red_chunk = red_band.ReadAsArray(0, yoff, xsize, rows, buf_obj=red_buffer[:rows])
+                    nir_chunk = nir_band.ReadAsArray(0, yoff, xsize, rows, buf_obj=nir_buffer[:rows])
+                    if red_chunk is None or nir_chunk is None:
+                        raise ValueError(f"Failed to read rows {yoff} to {yoff + rows}")
+                    timer.add_bytes(red_chunk.nbytes + nir_chunk.nbytes)
+                read_queue.put((yoff, rows, slot))
+            read_queue.put(None)
+        except Exception as e:
+            read_queue.put(e)
+
+    def writer():
+        while True:
+            item = encode_queue.get()
+            if item is None:
+                return
+            yoff, rows, slot = item
+            try:
+                if not writer_errors:
+                    codes = code_buffers[slot][:rows]
+                    with stage_timer('encode', codes.nbytes):
+                        outband.WriteArray(codes, 0, yoff)
+            except Exception as e:
+                writer_errors.append(e)
+            free_codes.put(slot)
+
+    threads = [th.Thread(target=reader, name='ndvi-reader', daemon=True), th.Thread(target=writer, name='ndvi-writer', daemon=True)]
+    for thread in threads:
+        thread.start()
 
-def calculate_ndvi(red, nir):
+    chunks = 0
+    read_depth = encode_depth = 0
+    read_wait = encode_wait = 0.0
     try:
-        ndvi = (nir - red) / (nir + red)
-        ndvi = np.clip(ndvi, -1, 1)
-        return ndvi
-    except Exception:
-        logger.error("Error in calculate_ndvi: Calculation failed")
-        return np.full(red.shape, np.nan)
-
-def normalize_ndvi(ndvi):
-    ndvi_min = -1
-    ndvi_max = 1
-    ndvi_normalized = 1 + ((ndvi - ndvi_min) * (255 - 1)) / (ndvi_max - ndvi_min)
-    return np.round(ndvi_normalized).astype(int)
-
-def denormalize_ndvi(ndvi_normalized):
-    ndvi_min = -1
-    ndvi_max = 1
-    ndvi = ndvi_min + ((ndvi_normalized - 1) / (255 - 1)) * (ndvi_max - ndvi_min)
-    return ndvi
-
-def export_ndvi_image(ndvi, gt, proj, file_name, file_path='', quality='60'):
+        while True:
+            wait_start = time.perf_counter()
+            item = read_queue.get()
+            read_wait += time.perf_counter() - wait_start
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            if writer_errors:
+                break
+            yoff, rows, slot = item
+            read_depth += read_queue.qsize()
+            encode_depth += encode_queue.qsize()
+
+            wait_start = time.perf_counter()
+            code_slot = free_codes.get()
+            encode_wait += time.perf_counter() - wait_start
+            red_chunk, nir_chunk = (buffer[:rows] for buffer in read_buffers[slot])
+            with stage_timer('ndvi_kernel', red_chunk.nbytes + nir_chunk.nbytes):
+                ndvi_kernel(red_chunk, nir_chunk, code_buffers[code_slot][:rows])
+            free_reads.put(slot)
+            encode_queue.put((yoff, rows, code_slot))
+            chunks += 1
+    finally:
+        stop.set()
+        for _ in range(PIPELINE_DEPTH):
+            free_reads.put(None)
+        encode_queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    if writer_errors:
+        raise writer_errors[0]
+    if chunks:
+        record_gauge('conversion_pipeline', chunks=chunks, read_queue=read_depth / chunks, encode_queue=encode_depth / chunks,
+                     read_wait_seconds=read_wait, encode_wait_seconds=encode_wait)
+
+#Streams a scene through NDVI a chunk of native blocks at a time, writing each chunk straight to the output GTiff
+#through run_chunk_pipeline. Bands are read in their own data type and converted by the fused kernel, so peak
+#memory is a few chunk buffers no matter how big the scene is, and the codes match the original calculate_ndvi
+#and normalize_ndvi chain exactly. Returns the MBR of the image, taken from the input geotransform, or None if it could not be written.
+#With cog=True the chunks go to a lossless tiled temporary file that is then copied into a Cloud-Optimized GeoTIFF
+#with internal overviews, so JPEG is only ever applied once.
+#The image is written under a hidden partial name and renamed into place once it is complete, so an interrupted
+#run never leaves a truncated image behind.
+def stream_ndvi_image(red_file_path, nir_file_path, file_name, file_path='', quality='60', kernel_backend='auto', codec='JPEG', cog=False):
+    temp_file_name = None
+    partial_file_name = None
     try:
-        ndvi_normalized = normalize_ndvi(ndvi)
-        binmask = np.where(ndvi_normalized > 0, 1, 0)
-        clipped_data = np.where(binmask != 0, ndvi_normalized, np.nan)
-        nodata_value = 0
-        clipped_data[np.isnan(clipped_data)] = nodata_value
+        red, nir, gt, proj = open_red_nir_bands(red_file_path, nir_file_path)
+        red_band = red.GetRasterBand(1)
+        nir_band = nir.GetRasterBand(1)
+        xsize, ysize = red.RasterXSize, red.RasterYSize
 
         driver = gdal.GetDriverByName("GTiff")
         if ".tif" not in file_name:
             file_name += ".tif"
         file_name = os.path.join(file_path, file_name)
+        partial_file_name = os.path.join(file_path, '.' + os.path.basename(file_name) + '.partial.tif')
+
+        if cog:
+            temp_file_name = os.path.join(file_path, '.' + os.path.basename(file_name) + '.tmp.tif')
+            write_name, options = temp_file_name, ndvi_creation_options('DEFLATE', tiled=True)
+        else:
+            write_name, options = partial_file_name, ndvi_creation_options(codec, quality)
 
-        outds = driver.Create(file_name, xsize=ndvi_normalized.shape[1], ysize=ndvi_normalized.shape[0], bands=1, eType=gdal.GDT_Byte, options=["COMPRESS=JPEG", "JPEG_QUALITY=" + str(quality)])
+        nodata_value = 0
+        outds = driver.Create(write_name, xsize=xsize, ysize=ysize, bands=1, eType=gdal.GDT_Byte, options=options)
         outds.SetGeoTransform(gt)
         outds.SetProjection(proj)
-
         outband = outds.GetRasterBand(1)
-        outband.WriteArray(ndvi_normalized)
         outband.SetNoDataValue(nodata_value)
 
-        outband.FlushCache()
-        outband = None
+        chunk_rows = chunk_rows_for(red_band.GetBlockSize()[1], outband.GetBlockSize()[1])
+        ndvi_kernel = make_ndvi_kernel((chunk_rows, xsize), kernel_backend)
+        run_chunk_pipeline(red_band, nir_band, outband, xsize, ysize, chunk_rows, ndvi_kernel)
+
+        with stage_timer('encode'):
+            outband.FlushCache()
+            outband = None
+
+        if cog:
+            with stage_timer('cog_copy', xsize * ysize):
+                cogds = gdal.GetDriverByName("COG").CreateCopy(partial_file_name, outds, options=cog_creation_options(codec, quality))
+                if cogds is None:
+                    raise ValueError(f"COG driver could not write {file_name}")
+                cogds = None
         outds = None
+        os.replace(partial_file_name, file_name)
+        with stage_timer('bounding_box'):
+            return boundingbox_from_geotransform(gt, xsize, ysize, proj)
 
     except Exception as e:
-        logger.error(f"Error in export_ndvi_image: Unable to save NDVI image. {e}")
+        logger.error(f"Error in stream_ndvi_image: Unable to create NDVI image {file_name}. {e}")
+        return None
+    finally:
+        for leftover in (temp_file_name, partial_file_name):
+            if leftover is not None and os.path.exists(leftover):
+                os.remove(leftover)
 
 def initialize_queue(main_dir):
     sub_directories = [d for d in os.listdir(main_dir) if os.path.isdir(os.path.join(main_dir, d))]
@@ -105,27 +234,21 @@ def initialize_queue(main_dir):
         logger.info(f"Queued directory: {dir}")
     return dir_queue
 
-def process_directory(main_dir, output_directory, dir_queue, quality='60'):
+def process_directory(main_dir, output_directory, dir_queue, quality='60', codec='JPEG', cog=False):
+    from extract_pixels import export_directory_pixels
     while not dir_queue.empty():
         dir = dir_queue.get()
         try:
-            process_single_directory(main_dir, output_directory, dir, quality)
-            combine_directories_to_csv(output_directory, 'pixel_output.csv')
+            if process_single_directory(main_dir, output_directory, dir, quality, codec, cog):
+                export_directory_pixels(output_directory, dir, overwrite=True)
 
         except Exception:
             logger.error(f"Error processing directory {dir}")
         finally:
             dir_queue.task_done()
 
-def process_single_directory(main_dir, output_directory, dir, quality='60'):
-    full_path = os.path.join(output_directory, dir)
-    os.makedirs(full_path, exist_ok=True)
-
-    curr_files = os.listdir(full_path)
-    curr_files = [file.split('.')[0] for file in curr_files]
-
+def find_scene_pairs(main_dir, dir):
     band_4_files = glob(os.path.join(main_dir, dir, "*_B4.[tT][iI][fF]"))
-    band_5_files = glob(os.path.join(main_dir, dir, "*_B5.[tT][iI][fF]"))
 
     valid_file_pairs = []
     for band4 in band_4_files:
@@ -139,37 +262,370 @@ def process_single_directory(main_dir, output_directory, dir, quality='60'):
             valid_file_pairs.append((band4, band5, base_name))
         else:
             logger.error(f"Band 5 missing for {base_name}, skipping this pair.")
+    return valid_file_pairs
+
+#Converts one B4/B5 pair and returns the MBR of the new NDVI image, or None if the bands could not be read
+def convert_scene(band4, band5, file_name, full_path, quality='60', kernel_backend='auto', codec='JPEG', cog=False):
+    MBR = stream_ndvi_image(band4, band5, file_name, full_path, quality, kernel_backend, codec, cog)
+    if MBR is None:
+        logger.error(f"Skipping file {file_name} due to errors reading bands.")
+        return None
+
+    logger.info(f"File {file_name} has been created in {full_path}")
+    return MBR
+
+#Asks the kernel to start reading files into the page cache. Scenes waiting in the pool's queue get their bands
+#prefetched this way, so a worker picking one up finds them in memory. Does nothing without posix_fadvise.
+def prefetch_files(paths):
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.debug(f"Cannot prefetch {path}: {e}")
+
+#Converts one pair and returns its manifest record. The files are hashed right after the conversion, while they
+#are still in the page cache. With adopt=True an existing NDVI image is taken over instead when it can be.
+def convert_and_record_scene(band4, band5, file_name, full_path, params, kernel_backend='auto', adopt=False):
+    if adopt:
+        with stage_timer('manifest_hash'):
+            record = adopt_existing_output(band4, band5, os.path.join(full_path, file_name + '.tif'), params)
+        if record is not None:
+            return record
+    with stage_timer('scene', os.path.getsize(band4) + os.path.getsize(band5)):
+        MBR = convert_scene(band4, band5, file_name, full_path, params['quality'], kernel_backend, params['codec'], params['cog'])
+        if MBR is None:
+            return None
+        with stage_timer('manifest_hash'):
+            return scene_record(band4, band5, os.path.join(full_path, file_name + '.tif'), params, MBR)
+
+#Rewrites raster_index.csv with every raster of the directory, adds them all to the SQLite index and rebuilds the
+#date's mosaics
+def write_directory_index(output_directory, dir, raster_dict):
+    import pandas as pd
+    from mosaic_functions import build_date_mosaics, drop_date_mosaics
+    with stage_timer('directory_index', directory=dir):
+        full_path = os.path.join(output_directory, dir)
+        add_rasters_to_index(output_directory, dir, list(zip(raster_dict['FileName'], raster_dict['MBR'])))
+
+        raster_index_path = os.path.join(full_path, 'raster_index.csv')
+        temp_path = os.path.join(full_path, '.raster_index.csv.tmp')
+        pd.DataFrame(raster_dict).to_csv(temp_path)
+        os.replace(temp_path, raster_index_path)
+
+    with stage_timer('mosaic', directory=dir):
+        try:
+            build_date_mosaics(output_directory, dir, raster_dict)
+        except Exception as e:
+            logger.error(f"Error building the mosaic of {dir}, its images will be read one by one: {e}")
+            drop_date_mosaics(output_directory, dir)
+
+#Quality every NDVI image was written with before the manifests recorded it
+LEGACY_JPEG_QUALITY = '60'
+
+#Processing parameters an existing NDVI image was written with, read from its GTiff tags. GDAL reports the JPEG
+#quality it estimates from the quantization tables; the quality of lossless images does not matter and is taken
+#from params.
+def output_params(output_path, params):
+    dataset = gdal.Open(output_path)
+    if dataset is None:
+        raise ValueError(f"GDAL cannot open {output_path}")
+    structure = dataset.GetMetadata('IMAGE_STRUCTURE') or {}
+    dataset = None
+    codec = structure.get('COMPRESSION', 'NONE').upper()
+    if codec.endswith('JPEG'):
+        return conversion_params(structure.get('JPEG_QUALITY', LEGACY_JPEG_QUALITY), 'JPEG', structure.get('LAYOUT') == 'COG')
+    return conversion_params(params['quality'], codec, structure.get('LAYOUT') == 'COG')
+
+#Takes over an NDVI image written before manifests existed, so upgrading does not convert the whole archive again.
+#Images that cannot be opened, such as ones cut short by a crash, and images written with other parameters than
+#params are converted again.
+def adopt_existing_output(band4, band5, output_path, params):
+    if not os.path.isfile(output_path):
+        return None
+    try:
+        existing_params = output_params(output_path, params)
+        MBR = get_boundingbox(output_path)
+    except Exception as e:
+        logger.warning(f"Cannot read existing {os.path.basename(output_path)}, converting it again: {e}")
+        return None
+    if existing_params != params:
+        logger.info(f"Existing {os.path.basename(output_path)} was written with {existing_params}, converting it again")
+        return None
+    logger.info(f"Adding existing {os.path.basename(output_path)} to the manifest")
+    return scene_record(band4, band5, output_path, existing_params, MBR)
+
+#Returns the scene pairs of dir that need converting, as (band4, band5, file_name, adopt), and whether the manifest
+#changed. A pair is skipped when its manifest record matches the inputs, the output and params. A pair with no
+#record whose NDVI image exists gets adopt=True, so the worker converting it hashes and takes over the image
+#instead when it can. While the input directory's mtime is unchanged the pairs come from the manifest, so the
+#directory is not listed again.
+def pending_scene_pairs(main_dir, output_directory, dir, manifest, params, verify=False):
+    full_path = os.path.join(output_directory, dir)
+    os.makedirs(full_path, exist_ok=True)
 
-    raster_dict = {'FileName': [], 'MBR': []}
-
-    for band4, band5, file_name in valid_file_pairs:
-        if file_name not in curr_files:
-            red, nir, gt, proj = import_red_nir_bands(band4, band5)
-            
-            if red is not None and nir is not None:
-                ndvi = calculate_ndvi(red, nir)
-                export_ndvi_image(ndvi, gt, proj, file_name, full_path, quality)
-                logger.info(f"File {file_name} has been created in {full_path}")
-
-                raster_path = os.path.join(full_path, file_name)
-                MBR = get_boundingbox(raster_path + '.TIF')
-                raster_dict['FileName'].append(file_name)
-                raster_dict['MBR'].append(MBR)
-            else:
-                logger.error(f"Skipping file {file_name} due to errors reading bands.")
+    changed = False
+    input_mtime_ns = os.stat(os.path.join(main_dir, dir)).st_mtime_ns
+    if manifest['input_mtime_ns'] == input_mtime_ns:
+        scene_pairs = [(os.path.join(main_dir, dir, band4), os.path.join(main_dir, dir, band5), file_name) for band4, band5, file_name in manifest['input_pairs']]
+    else:
+        scene_pairs = find_scene_pairs(main_dir, dir)
+        manifest['input_mtime_ns'] = input_mtime_ns
+        manifest['input_pairs'] = sorted([os.path.basename(band4), os.path.basename(band5), file_name] for band4, band5, file_name in scene_pairs)
+        changed = True
+
+    pending_pairs = []
+    for band4, band5, file_name in scene_pairs:
+        output_path = os.path.join(full_path, file_name + '.tif')
+        record = manifest['scenes'].get(file_name)
+        if record is None:
+            pending_pairs.append((band4, band5, file_name, os.path.isfile(output_path)))
+            continue
+
+        current, refreshed = scene_is_current(record, band4, band5, output_path, params, verify)
+        changed = changed or refreshed
+        if current:
+            logger.debug(f"File {file_name} is up to date, skipping.")
         else:
-            logger.info(f"File {file_name} already exists, skipping.")
-
-    raster_index_path = os.path.join(full_path, 'raster_index.csv')
-    if not os.path.isfile(raster_index_path): 
-        raster_index = pd.DataFrame(raster_dict)
-        raster_index.to_csv(raster_index_path)
-
+            pending_pairs.append((band4, band5, file_name, False))
+    return pending_pairs, changed
 
-def create_and_start_threads(main_dir, output_directory, dir_queue, num_threads=4, quality='60'):
+def process_single_directory(main_dir, output_directory, dir, quality='60', codec='JPEG', cog=False):
+    full_path = os.path.join(output_directory, dir)
+    params = conversion_params(quality, codec, cog)
+    manifest = load_manifest(output_directory, dir)
+    pending_pairs, changed = pending_scene_pairs(main_dir, output_directory, dir, manifest, params)
+
+    for band4, band5, file_name, adopt in pending_pairs:
+        record = convert_and_record_scene(band4, band5, file_name, full_path, params, adopt=adopt)
+        if record is not None:
+            manifest['scenes'][file_name] = record
+
+    if pending_pairs or changed:
+        save_manifest(output_directory, dir, manifest)
+    write_directory_index(output_directory, dir, manifest_raster_dict(manifest))
+    return len(pending_pairs) > 0
+
+#Writes the index, pixel partition and datacube slice of a directory after some of its scenes were converted.
+#The pixel partition and datacube slice are rebuilt, since they cover every image of the date. pyarrow and xarray
+#are imported here, so the conversion workers never load them.
+def finish_directory(output_directory, dir, manifest, datacube=None):
+    from extract_pixels import export_directory_pixels
+    save_manifest(output_directory, dir, manifest)
+    write_directory_index(output_directory, dir, manifest_raster_dict(manifest))
+    with stage_timer('pixel_export', directory=dir):
+        export_directory_pixels(output_directory, dir, overwrite=True)
+    if datacube:
+        from datacube_functions import append_datacube_date
+        with stage_timer('datacube_append', directory=dir):
+            append_datacube_date(datacube, output_directory, dir, replace=True)
+    logger.info(f"Directory {dir} is complete")
+
+#Converts every scene pair under main_dir on a process pool. Work is scheduled per scene pair, so a large date
+#directory is spread over all workers, and at most max_in_flight pairs are submitted at a time to bound memory.
+#Only pairs whose manifest record is missing or out of date are converted. Index and pixel output for a directory
+#are written by this process once all of its pairs are done, and the directory is appended to the datacube store
+#at datacube when one is given. With verify=True every existing output is checked against its manifest checksum.
+def run_conversion_pool(main_dir, output_directory, num_workers=None, quality='60', max_in_flight=None, kernel_backend='auto', codec='JPEG', cog=False, datacube=None, verify=False):
+    num_workers = num_workers or os.cpu_count()
+    max_in_flight = max_in_flight or num_workers * 2
+    params = conversion_params(quality, codec, cog)
+
+    tasks = []
+    remaining = {}
+    manifests = {}
+    unsaved = {}
+    if datacube:
+        from datacube_functions import append_datacube_date, datacube_dates, datacube_needs_date
+        cube_dates = datacube_dates(datacube)
+    sub_directories = sorted(d for d in os.listdir(main_dir) if os.path.isdir(os.path.join(main_dir, d)))
+    for dir in sub_directories:
+        manifests[dir] = load_manifest(output_directory, dir)
+        with stage_timer('manifest_check', directory=dir):
+            pending_pairs, changed = pending_scene_pairs(main_dir, output_directory, dir, manifests[dir], params, verify)
+        remaining[dir] = len(pending_pairs)
+        unsaved[dir] = 0
+        if not pending_pairs:
+            if changed:
+                save_manifest(output_directory, dir, manifests[dir])
+                write_directory_index(output_directory, dir, manifest_raster_dict(manifests[dir]))
+            if datacube and datacube_needs_date(cube_dates, dir):
+                append_datacube_date(datacube, output_directory, dir)
+        for band4, band5, file_name, adopt in pending_pairs:
+            tasks.append((dir, band4, band5, file_name, adopt))
+    logger.info(f"Queued {len(tasks)} scene pairs from {len(sub_directories)} directories on {num_workers} workers")
+
+    task_iter = iter(tasks)
+    in_flight = {}
+    submitted = 0
+    # Busy worker seconds are estimated from the number of scenes in flight during each round, capped at the pool size
+    busy_seconds = 0.0
+    pool_start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        while True:
+            for dir, band4, band5, file_name, adopt in islice(task_iter, max_in_flight - len(in_flight)):
+                future = executor.submit(convert_and_record_scene, band4, band5, file_name, os.path.join(output_directory, dir), params, kernel_backend, adopt)
+                if submitted >= num_workers:
+                    prefetch_files((band4, band5))
+                in_flight[future] = (dir, file_name)
+                submitted += 1
+            if not in_flight:
+                break
+
+            round_start, round_in_flight = time.perf_counter(), len(in_flight)
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            record_gauge('conversion_queue', in_flight=round_in_flight - len(done), queued=len(tasks) - submitted, done=len(done))
+            for future in done:
+                dir, file_name = in_flight.pop(future)
+                try:
+                    record = future.result()
+                except Exception as e:
+                    logger.error(f"Error converting {file_name} in {dir}: {e}")
+                    record = None
+
+                if record is not None:
+                    manifests[dir]['scenes'][file_name] = record
+                    unsaved[dir] += 1
+                remaining[dir] -= 1
+                if remaining[dir] == 0:
+                    try:
+                        finish_directory(output_directory, dir, manifests[dir], datacube)
+                    except Exception as e:
+                        logger.error(f"Error finishing directory {dir}: {e}")
+                elif unsaved[dir] >= MANIFEST_FLUSH_SCENES:
+                    save_manifest(output_directory, dir, manifests[dir])
+                    unsaved[dir] = 0
+            busy_seconds += min(round_in_flight, num_workers) * (time.perf_counter() - round_start)
+    record_pool_utilization('conversion_pool', busy_seconds, time.perf_counter() - pool_start, num_workers, scenes=len(tasks))
+
+#Scans the input for scenes to convert and queues them on the shared job queue. One worker scans at a time, the
+#others start on the jobs already queued. Directories with jobs still being converted or finalized are left alone,
+#since their manifests are not final yet.
+def enqueue_conversion_jobs(main_dir, output_directory, queue, params, datacube=None, verify=False):
+    if not queue.try_lease('scan'):
+        logger.info("Another worker is scanning the input, starting on the queued scenes")
+        return False
+    try:
+        queued = 0
+        if datacube:
+            from datacube_functions import append_datacube_date, datacube_dates, datacube_needs_date
+            cube_dates = datacube_dates(datacube)
+        for dir in sorted(d for d in os.listdir(main_dir) if os.path.isdir(os.path.join(main_dir, d))):
+            if queue.directory_in_progress(dir):
+                continue
+            manifest = load_manifest(output_directory, dir)
+            with stage_timer('manifest_check', directory=dir):
+                pending_pairs, changed = pending_scene_pairs(main_dir, output_directory, dir, manifest, params, verify)
+            if changed:
+                save_manifest(output_directory, dir, manifest)
+            # Also clears a directory given up on by an earlier run
+            queue.enqueue_directory(dir, pending_pairs)
+            if pending_pairs:
+                queued += len(pending_pairs)
+                continue
+            if changed:
+                write_directory_index(output_directory, dir, manifest_raster_dict(manifest))
+            if datacube and datacube_needs_date(cube_dates, dir):
+                queue.wait_for_lease('datacube')
+                try:
+                    append_datacube_date(datacube, output_directory, dir)
+                finally:
+                    queue.release('datacube')
+        logger.info(f"Queued {queued} scene pairs")
+    finally:
+        queue.release('scan')
+    return True
+
+#Merges the records of a directory's converted scenes into its manifest and writes its index, mosaics, pixel
+#partition and datacube slice, once all of its jobs have finished. Only one worker finalizes a directory, so
+#raster_index.csv and the manifest have a single writer, and datacube appends from different hosts take turns.
+#A directory that fails to finalize MAX_ATTEMPTS times is given up on until the next run scans it again.
+def finalize_queued_directory(output_directory, queue, dir, datacube=None):
+    if not queue.try_lease(f'finalize:{dir}'):
+        return
+    try:
+        if dir not in queue.finishable_directories():
+            return
+        manifest = load_manifest(output_directory, dir)
+        manifest['scenes'].update(queue.directory_records(dir))
+        if datacube:
+            queue.wait_for_lease('datacube')
+        try:
+            finish_directory(output_directory, dir, manifest, datacube)
+        finally:
+            if datacube:
+                queue.release('datacube')
+        queue.mark_finalized(dir)
+    except Exception as e:
+        logger.error(f"Error finishing directory {dir}: {e}")
+        if queue.fail_finalize(dir, e):
+            logger.error(f"Giving up on finishing directory {dir}")
+    finally:
+        queue.release(f'finalize:{dir}')
+
+#One worker of a cooperative conversion run. Any number of these, on any number of hosts sharing the output
+#directory, can join or leave at any time: each converts one leased scene at a time, finalizes the directories it
+#finds complete, and returns once nothing is left to convert or finalize. A worker that dies loses its leases after
+#LEASE_SECONDS and its scene is converted again by another.
+def run_queue_worker(main_dir, output_directory, quality='60', kernel_backend='auto', codec='JPEG', cog=False, datacube=None, verify=False):
+    from job_queue_functions import JobQueue, POLL_SECONDS
+    params = conversion_params(quality, codec, cog)
+    os.makedirs(output_directory, exist_ok=True)
+    converted = 0
+    with JobQueue(output_directory) as queue:
+        enqueue_conversion_jobs(main_dir, output_directory, queue, params, datacube, verify)
+        while True:
+            with stage_timer('queue_claim'):
+                job = queue.claim()
+            if job is not None:
+                job_id, dir, band4, band5, file_name, adopt = job
+                full_path = os.path.join(output_directory, dir)
+                try:
+                    os.makedirs(full_path, exist_ok=True)
+                    record = convert_and_record_scene(band4, band5, file_name, full_path, params, kernel_backend, adopt)
+                except Exception as e:
+                    logger.error(f"Error converting {file_name} in {dir}: {e}")
+                    record = None
+                if record is None:
+                    queue.fail(job_id, f"Conversion of {file_name} failed")
+                    continue
+                if queue.complete(job_id, record):
+                    converted += 1
+                continue
+
+            for dir in queue.finishable_directories():
+                finalize_queued_directory(output_directory, queue, dir, datacube)
+            counts = queue.counts()
+            record_gauge('job_queue', **counts)
+            if queue.is_drained():
+                break
+            time.sleep(POLL_SECONDS)
+    if counts['failed']:
+        logger.warning(f"{counts['failed']} scenes failed, they are queued again by the next run")
+    if counts['failed_directories']:
+        logger.warning(f"{counts['failed_directories']} directories could not be finished, they are scanned again by the next run")
+    logger.info(f"Converted {converted} scenes, the job queue is drained")
+    return converted
+
+#Starts num_workers queue workers on this host and waits for the queue to drain
+def run_queue_workers(main_dir, output_directory, num_workers=None, quality='60', kernel_backend='auto', codec='JPEG', cog=False, datacube=None, verify=False):
+    num_workers = num_workers or os.cpu_count()
+    if num_workers == 1:
+        return run_queue_worker(main_dir, output_directory, quality, kernel_backend, codec, cog, datacube, verify)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(run_queue_worker, main_dir, output_directory, quality, kernel_backend, codec, cog, datacube, verify)
+                   for _ in range(num_workers)]
+    return sum(future.result() for future in futures)
+
+def create_and_start_threads(main_dir, output_directory, dir_queue, num_threads=4, quality='60', codec='JPEG', cog=False):
     threads = []
     for _ in range(num_threads):
-        thread = th.Thread(target=process_directory, args=(main_dir, output_directory, dir_queue, quality))
+        thread = th.Thread(target=process_directory, args=(main_dir, output_directory, dir_queue, quality, codec, cog))
         thread.start()
         threads.append(thread)
     return threads
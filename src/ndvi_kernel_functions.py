@@ -0,0 +1,79 @@
+import importlib.util
+import numpy as np
+from log_config import logger
+
+#numba takes a good part of a second to import, so it is only checked for here and imported by the first numba kernel
+NUMBA_AVAILABLE = importlib.util.find_spec('numba') is not None
+
+NDVI_KERNEL_BACKENDS = ['auto', 'numpy', 'numba']
+
+def calculate_ndvi(red, nir):
+    try:
+        ndvi = (nir - red) / (nir + red)
+        ndvi = np.clip(ndvi, -1, 1)
+        return ndvi
+    except Exception:
+        logger.error("Error in calculate_ndvi: Calculation failed")
+        return np.full(red.shape, np.nan)
+
+def normalize_ndvi(ndvi):
+    ndvi_min = -1
+    ndvi_max = 1
+    ndvi_normalized = 1 + ((ndvi - ndvi_min) * (255 - 1)) / (ndvi_max - ndvi_min)
+    return np.round(ndvi_normalized).astype(int)
+
+def denormalize_ndvi(ndvi_normalized):
+    ndvi_min = -1
+    ndvi_max = 1
+    ndvi = ndvi_min + ((ndvi_normalized - 1) / (255 - 1)) * (ndvi_max - ndvi_min)
+    return ndvi
+
+# The chain the fused kernels replace: scaling the bands by 10000, calculate_ndvi and normalize_ndvi, ending in the
+# Byte cast GDAL did on write (NaN -> 0). Kept as the reference the kernels are checked against.
+def ndvi_codes_reference(red, nir):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ndvi = calculate_ndvi(red / 10000.0, nir / 10000.0)
+        ndvi_normalized = normalize_ndvi(ndvi)
+    return np.clip(ndvi_normalized, 0, 255).astype(np.uint8)
+
+# Fused raw DN -> uint8 NDVI code kernels. Both backends run the exact float64 operation sequence of the original
+# chain, scaling by 10000 then calculate_ndvi and normalize_ndvi (scale, divide, clip, normalize, round half to
+# even), so the codes are bit-identical to it. NaN (0/0) becomes the nodata code 0.
+def ndvi_codes_numpy(red, nir, codes, scratch):
+    red_scaled, nir_scaled, ndvi = scratch
+    np.divide(red, 10000.0, out=red_scaled)
+    np.divide(nir, 10000.0, out=nir_scaled)
+    np.subtract(nir_scaled, red_scaled, out=ndvi)
+    np.add(nir_scaled, red_scaled, out=nir_scaled)
+    np.divide(ndvi, nir_scaled, out=ndvi)
+    np.clip(ndvi, -1, 1, out=ndvi)
+    np.add(ndvi, 1, out=ndvi)
+    np.multiply(ndvi, 254, out=ndvi)
+    np.divide(ndvi, 2, out=ndvi)
+    np.add(ndvi, 1, out=ndvi)
+    np.rint(ndvi, out=ndvi)
+    np.nan_to_num(ndvi, copy=False, nan=0)
+    np.copyto(codes, ndvi, casting='unsafe')
+    return codes
+
+def ndvi_codes_numba(red, nir, codes, scratch=None):
+    from ndvi_numba_kernel import ndvi_codes_jit
+    return ndvi_codes_jit(red, nir, codes)
+
+#Returns kernel(red, nir, codes) for chunks of at most chunk_shape, with its float64 scratch buffers preallocated
+def make_ndvi_kernel(chunk_shape, backend='auto'):
+    if backend == 'auto':
+        backend = 'numba' if NUMBA_AVAILABLE else 'numpy'
+    if backend == 'numba' and not NUMBA_AVAILABLE:
+        logger.warning("Numba is not installed, using the numpy NDVI kernel")
+        backend = 'numpy'
+
+    if backend == 'numba':
+        from ndvi_numba_kernel import ndvi_codes_jit
+        return ndvi_codes_jit
+
+    scratch = [np.empty(chunk_shape, dtype=np.float64) for _ in range(3)]
+    def kernel(red, nir, codes):
+        rows, cols = codes.shape
+        return ndvi_codes_numpy(red, nir, codes, [buffer[:rows, :cols] for buffer in scratch])
+    return kernel
@@ -0,0 +1,17 @@
+import numba
+import numpy as np
+
+#Compiled form of ndvi_codes_numpy. It lives in its own module so numba is only imported by the first numba kernel.
+@numba.njit(cache=True, nogil=True, error_model='numpy')
+def ndvi_codes_jit(red, nir, codes):
+    for i in range(codes.shape[0]):
+        for j in range(codes.shape[1]):
+            red_scaled = red[i, j] / 10000.0
+            nir_scaled = nir[i, j] / 10000.0
+            ndvi = (nir_scaled - red_scaled) / (nir_scaled + red_scaled)
+            if ndvi != ndvi:
+                codes[i, j] = 0
+                continue
+            ndvi = min(max(ndvi, -1.0), 1.0)
+            codes[i, j] = np.uint8(np.rint(1 + ((ndvi + 1) * 254) / 2))
+    return codes
@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import threading
+import datetime as date
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor, Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+import numpy as np
+import pandas as pd
+from time_series_functions import ndvi_timeseries_range, ndvi_timeseries_points, POINT_COLUMNS
+from raster_index_functions import ensure_raster_index, open_raster_index
+from resource_cache import get_cache_stats
+from metrics import stage_timer
+from log_config import logger
+
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+
+def parse_request_date(value):
+    return date.datetime.strptime(value, '%Y-%m-%d')
+
+#Rows of a time series table as JSON-ready dicts, with dates written like the CLI's CSV files and NaN as null
+def frame_to_records(df):
+    df = df.copy()
+    if len(df) > 0:
+        df['Date'] = pd.to_datetime(df['Date']).dt.strftime('%Y-%m-%d')
+    return json.loads(df.to_json(orient='records'))
+
+#Collects point requests arriving within batch_window seconds of each other and answers them with one
+#ndvi_timeseries_points call per date range, so concurrent clients share every image open and block decode.
+#A point's rows are the same as ndvi_timeseries_point gives for it alone.
+class PointBatcher:
+    def __init__(self, search_dir, executor, batch_window=0.005, max_batch=1024):
+        self.search_dir = search_dir
+        self.executor = executor
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._requests = Queue()
+        self._thread = threading.Thread(target=self._run, name='point-batcher', daemon=True)
+        self._thread.start()
+
+    def submit(self, latitude, longitude, start_date, end_date):
+        future = Future()
+        self._requests.put((latitude, longitude, start_date, end_date, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self._requests.get()]
+        deadline = time.perf_counter() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._requests.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            by_range = {}
+            for request in batch:
+                by_range.setdefault((request[2], request[3]), []).append(request)
+            for (start_date, end_date), requests in by_range.items():
+                self._answer(start_date, end_date, requests)
+
+    def _answer(self, start_date, end_date, requests):
+        try:
+            points_df = pd.DataFrame({
+                'ID': np.arange(len(requests)),
+                'Latitude': [request[0] for request in requests],
+                'Longitude': [request[1] for request in requests]
+            })
+            with stage_timer('server_point_batch', points=len(requests)):
+                time_series = ndvi_timeseries_points(points_df, start_date, end_date, self.search_dir, executor=self.executor)
+            rows_by_id = dict(iter(time_series.groupby('ID', sort=False)))
+            for i, request in enumerate(requests):
+                rows = rows_by_id.get(i, pd.DataFrame(columns=time_series.columns))
+                request[4].set_result(rows[POINT_COLUMNS].sort_values('Date', kind='stable', ignore_index=True))
+        except Exception as e:
+            for request in requests:
+                if not request[4].done():
+                    request[4].set_exception(e)
+
+#Answers point and range time series for one NDVI directory. The raster index, dataset handles, decoded blocks,
+#transformers and geometries stay warm between requests, and dates run on one shared thread pool. The range
+#queries of /batch requests run on a second fixed-size pool, since they wait on the date pool themselves.
+class TimeseriesService:
+    def __init__(self, search_dir, workers=4, batch_window=0.005):
+        self.search_dir = search_dir
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='timeseries')
+        self.query_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch-query')
+        self.batcher = PointBatcher(search_dir, self.executor, batch_window)
+
+    #Builds the index if needed and reads it once, so its pages are cached before the first request
+    def warm_up(self):
+        ensure_raster_index(self.search_dir)
+        connection = open_raster_index(self.search_dir)
+        try:
+            rasters, dates = connection.execute('SELECT COUNT(*), COUNT(DISTINCT date) FROM rasters').fetchone()
+        finally:
+            connection.close()
+        logger.info(f"Serving {rasters} images over {dates} dates from {self.search_dir}")
+
+    def submit_point(self, query):
+        return self.batcher.submit(float(query['latitude']), float(query['longitude']), parse_request_date(query['start']), parse_request_date(query['end']))
+
+    def point(self, query):
+        return {'rows': frame_to_records(self.submit_point(query).result())}
+
+    def range(self, query):
+        time_series = ndvi_timeseries_range(query['wkt'], parse_request_date(query['start']), parse_request_date(query['end']), self.search_dir, executor=self.executor)
+        return {'rows': frame_to_records(time_series)}
+
+    def handle(self, kind, query):
+        if kind == 'point':
+            return self.point(query)
+        if kind == 'range':
+            return self.range(query)
+        raise ValueError(f"Unknown query kind {kind}")
+
+    #Runs a list of queries at once. The points among them go to the point batcher together, the ranges to the
+    #fixed-size query pool, so the number of threads does not depend on the request.
+    def batch(self, queries):
+        futures = []
+        for query in queries:
+            try:
+                if query.get('kind') == 'point':
+                    futures.append(('point', self.submit_point(query)))
+                else:
+                    futures.append(('query', self.query_executor.submit(self.handle, query.get('kind'), query)))
+            except Exception as e:
+                futures.append(('error', e))
+        results = []
+        for kind, future in futures:
+            if kind == 'error':
+                results.append({'error': str(future)})
+                continue
+            try:
+                result = future.result()
+                results.append({'rows': frame_to_records(result)} if kind == 'point' else result)
+            except Exception as e:
+                results.append({'error': str(e)})
+        return {'results': results}
+
+class TimeseriesRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else 'unix'
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        elif self.path == '/stats':
+            self.send_json(200, {'caches': get_cache_stats()})
+        else:
+            self.send_json(404, {'error': f"Unknown path {self.path}"})
+
+    #Body length from Content-Length, or None when it is missing a number, negative or above MAX_REQUEST_BYTES
+    def request_length(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            return None
+        if length < 0 or length > MAX_REQUEST_BYTES:
+            return None
+        return length
+
+    def do_POST(self):
+        service = self.server.service
+        length = self.request_length()
+        if length is None:
+            # The body is not read, so the connection cannot be reused
+            self.close_connection = True
+            self.send_json(400, {'error': f"Bad request: Content-Length must be a number from 0 to {MAX_REQUEST_BYTES}"})
+            return
+        try:
+            query = json.loads(self.rfile.read(length) or b'{}')
+            with stage_timer('server_request', path=self.path):
+                if self.path in ('/point', '/range'):
+                    body = service.handle(self.path[1:], query)
+                elif self.path == '/batch':
+                    body = service.batch(query['queries'])
+                else:
+                    self.send_json(404, {'error': f"Unknown path {self.path}"})
+                    return
+        except (KeyError, ValueError, TypeError) as e:
+            self.send_json(400, {'error': f"Bad request: {e}"})
+            return
+        except Exception as e:
+            logger.error(f"Error answering {self.path}: {e}")
+            self.send_json(500, {'error': str(e)})
+            return
+        self.send_json(200, body)
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        UnixStreamServer.server_bind(self)
+
+def serve_timeseries(search_dir, host='127.0.0.1', port=8765, socket_path=None, workers=4, batch_window=0.005):
+    service = TimeseriesService(search_dir, workers, batch_window)
+    service.warm_up()
+
+    if socket_path:
+        server = ThreadingUnixHTTPServer(socket_path, TimeseriesRequestHandler)
+        where = socket_path
+    else:
+        server = ThreadingHTTPServer((host, port), TimeseriesRequestHandler)
+        where = f"http://{host}:{port}"
+    server.service = service
+    logger.info(f"Time series server listening on {where}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down the time series server")
+    finally:
+        server.server_close()
+        service.executor.shutdown(wait=False)
+        service.query_executor.shutdown(wait=False)
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,287 @@
+import os
+import sqlite3
+import datetime as date
+from wkt_functions import wkt_to_bounds
+from metrics import stage_timer
+from log_config import logger
+
+RASTER_INDEX_FILE = 'raster_index.sqlite'
+
+# One index for the whole output tree: an R*Tree over (date, lon, lat) plus a table holding the exact MBRs.
+# The R*Tree stores 32-bit floats and rounds outwards, so candidates are re-checked against the exact MBR.
+def open_raster_index(index_directory):
+    connection = sqlite3.connect(os.path.join(index_directory, RASTER_INDEX_FILE), timeout=60)
+    connection.execute('''CREATE TABLE IF NOT EXISTS rasters (
+                              id INTEGER PRIMARY KEY,
+                              date TEXT NOT NULL,
+                              file_name TEXT NOT NULL,
+                              path TEXT NOT NULL,
+                              mbr TEXT NOT NULL,
+                              min_lon REAL, min_lat REAL, max_lon REAL, max_lat REAL,
+                              UNIQUE (date, file_name))''')
+    connection.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS raster_rtree USING rtree(
+                              id, min_day, max_day, min_lon, max_lon, min_lat, max_lat)''')
+    connection.execute('''CREATE TABLE IF NOT EXISTS mosaics (
+                              date TEXT NOT NULL,
+                              file_name TEXT NOT NULL,
+                              path TEXT NOT NULL,
+                              min_lon REAL, min_lat REAL, max_lon REAL, max_lat REAL,
+                              PRIMARY KEY (date, file_name))''')
+    connection.execute('''CREATE TABLE IF NOT EXISTS rollups (
+                              level TEXT NOT NULL,
+                              period TEXT NOT NULL,
+                              file_name TEXT NOT NULL,
+                              path TEXT NOT NULL,
+                              count_path TEXT NOT NULL,
+                              start_date TEXT NOT NULL,
+                              end_date TEXT NOT NULL,
+                              dates INTEGER NOT NULL,
+                              signature TEXT NOT NULL,
+                              min_lon REAL, min_lat REAL, max_lon REAL, max_lat REAL,
+                              PRIMARY KEY (level, period, file_name))''')
+    # Signature of every period built, including periods whose dates have no mosaics and so no rollups
+    connection.execute('''CREATE TABLE IF NOT EXISTS rollup_periods (
+                              level TEXT NOT NULL,
+                              period TEXT NOT NULL,
+                              signature TEXT NOT NULL,
+                              PRIMARY KEY (level, period))''')
+    return connection
+
+def date_to_day(curr_date):
+    return curr_date.toordinal()
+
+def parse_date_directory(dir_name):
+    year, month, day = dir_name.split('-')
+    return date.datetime(int(year), int(month), int(day))
+
+#Takes rasters as a list of (file_name, mbr_wkt) for a single date directory
+def add_rasters_to_index(index_directory, dir_name, rasters):
+    if not rasters:
+        return
+    try:
+        day = date_to_day(parse_date_directory(dir_name))
+    except ValueError:
+        logger.warning(f"Directory {dir_name} is not in YYYY-MM-DD format, not adding it to the raster index")
+        return
+    connection = open_raster_index(index_directory)
+    try:
+        with connection:
+            for file_name, mbr in rasters:
+                min_lon, min_lat, max_lon, max_lat = wkt_to_bounds(mbr)
+                path = os.path.join(dir_name, file_name + '.tif')
+                row = connection.execute('SELECT id FROM rasters WHERE date = ? AND file_name = ?', (dir_name, file_name)).fetchone()
+                if row is None:
+                    cursor = connection.execute('''INSERT INTO rasters (date, file_name, path, mbr, min_lon, min_lat, max_lon, max_lat)
+                                                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                                                (dir_name, file_name, path, mbr, min_lon, min_lat, max_lon, max_lat))
+                    raster_id = cursor.lastrowid
+                else:
+                    raster_id = row[0]
+                    connection.execute('''UPDATE rasters SET path = ?, mbr = ?, min_lon = ?, min_lat = ?, max_lon = ?, max_lat = ?
+                                          WHERE id = ?''',
+                                       (path, mbr, min_lon, min_lat, max_lon, max_lat, raster_id))
+                connection.execute('INSERT OR REPLACE INTO raster_rtree VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   (raster_id, day, day, min_lon, max_lon, min_lat, max_lat))
+    finally:
+        connection.close()
+    logger.debug(f"Indexed {len(rasters)} rasters for {dir_name}")
+
+#Replaces the mosaics recorded for a date directory. Takes mosaics as a list of (file_name, [min_lon, min_lat, max_lon, max_lat])
+def set_date_mosaics(index_directory, dir_name, mosaics):
+    connection = open_raster_index(index_directory)
+    try:
+        with connection:
+            connection.execute('DELETE FROM mosaics WHERE date = ?', (dir_name,))
+            connection.executemany('INSERT INTO mosaics VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   [(dir_name, file_name, os.path.join(dir_name, file_name), *mbr) for file_name, mbr in mosaics])
+    finally:
+        connection.close()
+
+#Returns {date directory: (raster paths, mosaics)} for every indexed date, with each mosaic as (file_name, path, mbr).
+#Raster paths are relative to index_directory, mosaic paths are absolute.
+def query_date_sources(index_directory):
+    connection = open_raster_index(index_directory)
+    try:
+        rasters = connection.execute('SELECT date, path FROM rasters ORDER BY date, file_name').fetchall()
+        mosaics = connection.execute('''SELECT date, file_name, path, min_lon, min_lat, max_lon, max_lat FROM mosaics
+                                        ORDER BY date, file_name''').fetchall()
+    finally:
+        connection.close()
+
+    sources = {}
+    for dir_name, path in rasters:
+        sources.setdefault(dir_name, ([], []))[0].append(path)
+    for dir_name, file_name, path, *mbr in mosaics:
+        sources.setdefault(dir_name, ([], []))[1].append((file_name, os.path.join(index_directory, path), mbr))
+    return sources
+
+def query_dates_without_mosaics(index_directory):
+    connection = open_raster_index(index_directory)
+    try:
+        rows = connection.execute('''SELECT DISTINCT date FROM rasters WHERE date NOT IN (SELECT date FROM mosaics)
+                                     ORDER BY date''').fetchall()
+    finally:
+        connection.close()
+    return [row[0] for row in rows]
+
+#Replaces the rollups recorded for one period of a level. Takes rollups as a list of
+#(file_name, path, count_path, dates, [min_lon, min_lat, max_lon, max_lat]) with paths relative to index_directory.
+def set_period_rollups(index_directory, level, period, start_date, end_date, signature, rollups):
+    connection = open_raster_index(index_directory)
+    try:
+        with connection:
+            connection.execute('DELETE FROM rollups WHERE level = ? AND period = ?', (level, period))
+            connection.executemany('INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   [(level, period, file_name, path, count_path, start_date.strftime('%Y-%m-%d'),
+                                     end_date.strftime('%Y-%m-%d'), dates, signature, *mbr)
+                                    for file_name, path, count_path, dates, mbr in rollups])
+            connection.execute('INSERT OR REPLACE INTO rollup_periods VALUES (?, ?, ?)', (level, period, signature))
+    finally:
+        connection.close()
+
+def delete_period_rollups(index_directory, level, period):
+    connection = open_raster_index(index_directory)
+    try:
+        with connection:
+            connection.execute('DELETE FROM rollups WHERE level = ? AND period = ?', (level, period))
+            connection.execute('DELETE FROM rollup_periods WHERE level = ? AND period = ?', (level, period))
+    finally:
+        connection.close()
+
+#Returns {period: signature} for every period of a level that was built, with or without rollups. Indexes written
+#before rollup_periods existed have their signatures only in rollups.
+def query_rollup_signatures(index_directory, level):
+    connection = open_raster_index(index_directory)
+    try:
+        rows = connection.execute('''SELECT DISTINCT period, signature FROM rollups WHERE level = ?
+                                     UNION SELECT period, signature FROM rollup_periods WHERE level = ?''', (level, level)).fetchall()
+    finally:
+        connection.close()
+    return dict(rows)
+
+#Returns (period start, period, file_name, path, count_path, mbr) for every rollup of level intersecting bounds whose
+#period lies entirely between start_date and end_date, ordered by period then file name
+def query_rollup_index(index_directory, level, bounds, start_date, end_date):
+    ensure_raster_index(index_directory)
+    min_lon, min_lat, max_lon, max_lat = bounds
+    connection = open_raster_index(index_directory)
+    try:
+        with stage_timer('rollup_query', level=level):
+            rows = connection.execute('''SELECT start_date, period, file_name, path, count_path, min_lon, min_lat, max_lon, max_lat
+                                         FROM rollups
+                                         WHERE level = ? AND start_date >= ? AND end_date <= ?
+                                           AND max_lon >= ? AND min_lon <= ? AND max_lat >= ? AND min_lat <= ?
+                                         ORDER BY start_date, file_name''',
+                                      (level, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'),
+                                       min_lon, max_lon, min_lat, max_lat)).fetchall()
+    finally:
+        connection.close()
+    return [(parse_date_directory(period_start), period, file_name, os.path.join(index_directory, path),
+             os.path.join(index_directory, count_path), [r_min_lon, r_min_lat, r_max_lon, r_max_lat])
+            for period_start, period, file_name, path, count_path, r_min_lon, r_min_lat, r_max_lon, r_max_lat in rows]
+
+#Returns (period start, period) for every period of level with rollups lying entirely between start_date and end_date
+def query_rollup_periods(index_directory, level, start_date, end_date):
+    ensure_raster_index(index_directory)
+    connection = open_raster_index(index_directory)
+    try:
+        rows = connection.execute('''SELECT DISTINCT start_date, period FROM rollups
+                                     WHERE level = ? AND start_date >= ? AND end_date <= ? ORDER BY start_date''',
+                                  (level, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))).fetchall()
+    finally:
+        connection.close()
+    return [(parse_date_directory(period_start), period) for period_start, period in rows]
+
+#Backfills the global index from the per-directory raster_index.csv files of an existing output tree. Dates that
+#already have rasters in the index are left alone.
+def build_raster_index(index_directory):
+    connection = open_raster_index(index_directory)
+    try:
+        indexed = {row[0] for row in connection.execute('SELECT DISTINCT date FROM rasters')}
+    finally:
+        connection.close()
+    added = 0
+    for dir_name in sorted(os.listdir(index_directory)):
+        csv_path = os.path.join(index_directory, dir_name, 'raster_index.csv')
+        if dir_name in indexed or not os.path.isfile(csv_path):
+            continue
+        try:
+            import pandas as pd
+            parse_date_directory(dir_name)
+            raster_df = pd.read_csv(csv_path)
+            add_rasters_to_index(index_directory, dir_name, list(zip(raster_df['FileName'], raster_df['MBR'])))
+            added += 1
+        except Exception as e:
+            logger.warning(f"Error indexing directory {dir_name}: {e}")
+    if added:
+        logger.info(f"Added {added} date folders to the raster index from their raster_index.csv files")
+
+#Index directories backfilled by this process. Dates written later are indexed as they are converted.
+_backfilled_directories = set()
+
+#Indexes every date folder whose raster_index.csv is not in the index yet, such as ones written before the index
+#existed, once per process
+def ensure_raster_index(index_directory):
+    key = os.path.abspath(index_directory)
+    if key in _backfilled_directories:
+        return
+    build_raster_index(index_directory)
+    _backfilled_directories.add(key)
+
+#Returns (date, file_name, path, mbr) for every raster intersecting bounds, ordered by date then file name
+#takes bounds as: [min_lon, min_lat, max_lon, max_lat]
+def query_raster_index(index_directory, bounds, start_date, end_date):
+    ensure_raster_index(index_directory)
+    min_lon, min_lat, max_lon, max_lat = bounds
+    connection = open_raster_index(index_directory)
+    try:
+        with stage_timer('index_query'):
+            rows = connection.execute('''SELECT r.date, r.file_name, r.path, r.min_lon, r.min_lat, r.max_lon, r.max_lat
+                                         FROM raster_rtree t JOIN rasters r ON r.id = t.id
+                                         WHERE t.max_day >= ? AND t.min_day <= ?
+                                           AND t.max_lon >= ? AND t.min_lon <= ?
+                                           AND t.max_lat >= ? AND t.min_lat <= ?
+                                         ORDER BY t.min_day, r.file_name''',
+                                      (date_to_day(start_date), date_to_day(end_date),
+                                       min_lon, max_lon, min_lat, max_lat)).fetchall()
+    finally:
+        connection.close()
+
+    candidates = []
+    for dir_name, file_name, path, r_min_lon, r_min_lat, r_max_lon, r_max_lat in rows:
+        if r_min_lon <= max_lon and min_lon <= r_max_lon and r_min_lat <= max_lat and min_lat <= r_max_lat:
+            mbr = [r_min_lon, r_min_lat, r_max_lon, r_max_lat]
+            candidates.append((parse_date_directory(dir_name), file_name, os.path.join(index_directory, path), mbr))
+    return candidates
+
+#Date directories are matched on their ordinal day in the R*Tree rather than on their names, since a name such as
+#2023-1-5 does not sort with the zero-padded ones
+DATES_BETWEEN = 'SELECT r.date FROM raster_rtree t JOIN rasters r ON r.id = t.id WHERE t.max_day >= ? AND t.min_day <= ?'
+
+#Returns (date, file_name, path, mbr) for every date mosaic intersecting bounds, like query_raster_index.
+#Dates without mosaics, such as ones converted before mosaics existed, are not returned.
+def query_mosaic_index(index_directory, bounds, start_date, end_date):
+    ensure_raster_index(index_directory)
+    min_lon, min_lat, max_lon, max_lat = bounds
+    connection = open_raster_index(index_directory)
+    try:
+        with stage_timer('mosaic_query'):
+            rows = connection.execute(f'''SELECT date, file_name, path, min_lon, min_lat, max_lon, max_lat FROM mosaics
+                                          WHERE date IN ({DATES_BETWEEN})
+                                            AND max_lon >= ? AND min_lon <= ? AND max_lat >= ? AND min_lat <= ?''',
+                                      (date_to_day(start_date), date_to_day(end_date),
+                                       min_lon, max_lon, min_lat, max_lat)).fetchall()
+    finally:
+        connection.close()
+    return sorted((parse_date_directory(dir_name), file_name, os.path.join(index_directory, path), [r_min_lon, r_min_lat, r_max_lon, r_max_lat])
+                  for dir_name, file_name, path, r_min_lon, r_min_lat, r_max_lon, r_max_lat in rows)
+
+#Returns every indexed date between start_date and end_date, so dates without a matching raster still show up
+def query_index_dates(index_directory, start_date, end_date):
+    ensure_raster_index(index_directory)
+    connection = open_raster_index(index_directory)
+    try:
+        rows = connection.execute(f'SELECT DISTINCT date FROM ({DATES_BETWEEN})', (date_to_day(start_date), date_to_day(end_date))).fetchall()
+    finally:
+        connection.close()
+    return sorted(parse_date_directory(row[0]) for row in rows)
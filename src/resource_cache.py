@@ -0,0 +1,159 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import rasterio as rio
+from pyproj import Transformer
+from shapely import wkt
+from disk_block_cache import get_disk_block_cache
+from log_config import logger
+
+#Thread-safe LRU cache bounded by entry count and/or total size. sizeof gives the size of a value and
+#on_evict is called with every value that leaves the cache.
+class LRUCache:
+    def __init__(self, name, max_entries=None, max_bytes=None, sizeof=None, on_evict=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        evicted = []
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.total_bytes -= self.sizeof(previous)
+                evicted.append(previous)
+            self._entries[key] = value
+            self.total_bytes += self.sizeof(value)
+            while self._entries and ((self.max_entries is not None and len(self._entries) > self.max_entries)
+                                     or (self.max_bytes is not None and self.total_bytes > self.max_bytes)):
+                _, old_value = self._entries.popitem(last=False)
+                self.total_bytes -= self.sizeof(old_value)
+                self.evictions += 1
+                evicted.append(old_value)
+        self._evict(evicted)
+        return value
+
+    #Returns the cached value or builds it with factory. factory runs outside the lock, so two threads can race
+    #to build the same value; the first one stored wins and the other is evicted straight away.
+    def get_or_create(self, key, factory):
+        value = self.get(key)
+        if value is not None:
+            return value
+        value = factory()
+        with self._lock:
+            existing = self._entries.get(key)
+        if existing is not None:
+            self._evict([value])
+            return existing
+        return self.put(key, value)
+
+    def clear(self):
+        with self._lock:
+            evicted = list(self._entries.values())
+            self._entries.clear()
+            self.total_bytes = 0
+        self._evict(evicted)
+
+    #Drops every entry without calling on_evict, for use in a forked child that must not touch the parent's handles
+    def forget(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'cache': self.name, 'entries': len(self._entries), 'bytes': self.total_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _evict(self, values):
+        if self.on_evict is None:
+            return
+        for value in values:
+            try:
+                self.on_evict(value)
+            except Exception as e:
+                logger.warning(f"Error evicting from {self.name} cache: {e}")
+
+#A rasterio dataset handle shared between threads. Handles are not safe for concurrent reads,
+#so users hold the lock while reading, and eviction takes the same lock before closing.
+class CachedDataset:
+    def __init__(self, path):
+        self.dataset = rio.open(path)
+        self.lock = threading.RLock()
+        self.closed = False
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.dataset.close()
+
+dataset_cache = LRUCache('datasets', max_entries=64, on_evict=CachedDataset.close)
+block_cache = LRUCache('blocks', max_bytes=256 * 1024 * 1024, sizeof=lambda block: block.nbytes)
+mask_cache = LRUCache('masks', max_bytes=256 * 1024 * 1024, sizeof=lambda mask: mask.nbytes)
+transformer_cache = LRUCache('transformers', max_entries=64)
+geometry_cache = LRUCache('geometries', max_entries=1024)
+RESOURCE_CACHES = [dataset_cache, block_cache, mask_cache, transformer_cache, geometry_cache]
+
+#Handles are keyed on the file's mtime too, so a rewritten image is never read through a stale handle
+def dataset_key(path):
+    return (os.path.abspath(path), os.stat(path).st_mtime_ns)
+
+#Yields an open dataset for path from the cache, holding its lock for the duration of the with block
+@contextmanager
+def open_dataset(path):
+    entry = dataset_cache.get_or_create(dataset_key(path), lambda: CachedDataset(path))
+    with entry.lock:
+        if not entry.closed:
+            yield entry.dataset
+            return
+    # Evicted between the lookup and the lock, use a private handle this time
+    with rio.open(path) as dataset:
+        yield dataset
+
+#Building a Transformer costs far more than using one, so they are shared per CRS pair
+def get_transformer(src_crs, dst_crs):
+    return transformer_cache.get_or_create((str(src_crs), str(dst_crs)), lambda: Transformer.from_crs(src_crs, dst_crs, always_xy=True))
+
+def load_wkt(wkt_string):
+    return geometry_cache.get_or_create(('wkt', wkt_string), lambda: wkt.loads(wkt_string))
+
+def get_cache_stats():
+    stats = [cache.stats() for cache in RESOURCE_CACHES]
+    disk_cache = get_disk_block_cache()
+    if disk_cache is not None:
+        stats.append(disk_cache.stats())
+    return stats
+
+def log_cache_stats():
+    for stats in get_cache_stats():
+        logger.info(f"Cache {stats['cache']}: {stats['entries'] if stats['entries'] is not None else 'n/a'} entries, {stats['bytes']} bytes, "
+                    f"{stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions")
+
+def clear_caches():
+    for cache in RESOURCE_CACHES:
+        cache.clear()
+
+def _forget_caches_after_fork():
+    for cache in RESOURCE_CACHES:
+        cache.forget()
+
+os.register_at_fork(after_in_child=_forget_caches_after_fork)
@@ -0,0 +1,263 @@
+import os
+import shutil
+import hashlib
+import datetime as date
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from raster_index_functions import (ensure_raster_index, parse_date_directory, query_date_sources, query_dates_without_mosaics,
+                                   set_period_rollups, delete_period_rollups, query_rollup_signatures, query_rollup_periods)
+from metrics import stage_timer
+from log_config import logger
+
+# Temporal rollups. For every month, season (DJF, MAM, JJA, SON, December counting towards the next year's DJF) and
+# year, the date mosaics of each CRS are composited per pixel into rollups/<level>/<period>/composite_<crs>.tif,
+# with the max, mean and median NDVI code as bands 1 to 3, in the uint8 encoding of normalize_ndvi with 0 as
+# nodata, and count_<crs>.tif with the number of valid observations behind each pixel.
+ROLLUP_DIRECTORY = 'rollups'
+ROLLUP_LEVELS = ['month', 'season', 'year']
+ROLLUP_BANDS = {'max': 1, 'mean': 2, 'median': 3}
+SEASONS = ['DJF', 'MAM', 'JJA', 'SON']
+
+#Composites are computed a square block at a time, so memory is bounded by the block size times the dates
+ROLLUP_BLOCK_SIZE = 512
+
+#--resolution auto takes the coarsest level giving at least this many whole periods
+AUTO_MIN_PERIODS = 12
+
+def add_months(curr_date, months):
+    year, month = divmod(curr_date.month - 1 + months, 12)
+    return date.datetime(curr_date.year + year, month + 1, 1)
+
+#Returns (period, first day, last day) of the period of level holding curr_date
+def rollup_period(level, curr_date):
+    if level == 'month':
+        start = date.datetime(curr_date.year, curr_date.month, 1)
+        return f'{curr_date.year}-{curr_date.month:02d}', start, add_months(start, 1) - date.timedelta(days=1)
+    if level == 'season':
+        season = (curr_date.month % 12) // 3
+        year = curr_date.year + (curr_date.month == 12)
+        start = date.datetime(year - 1, 12, 1) if season == 0 else date.datetime(year, 3 * season, 1)
+        return f'{year}-{SEASONS[season]}', start, add_months(start, 3) - date.timedelta(days=1)
+    if level == 'year':
+        return f'{curr_date.year}', date.datetime(curr_date.year, 1, 1), date.datetime(curr_date.year, 12, 31)
+    raise ValueError(f"Unknown rollup level {level}")
+
+#Periods of level lying entirely between start_date and end_date
+def whole_periods(level, start_date, end_date):
+    periods = []
+    period = rollup_period(level, start_date)
+    if period[1] < start_date:
+        period = rollup_period(level, period[2] + date.timedelta(days=1))
+    while period[2] <= end_date:
+        periods.append(period)
+        period = rollup_period(level, period[2] + date.timedelta(days=1))
+    return periods
+
+#The coarsest level that still splits the range into AUTO_MIN_PERIODS whole periods and has rollups in the range
+#under index_directory, or 'day' for short ranges and levels that were never built
+def choose_rollup_level(start_date, end_date, index_directory):
+    for level in reversed(ROLLUP_LEVELS):
+        if len(whole_periods(level, start_date, end_date)) < AUTO_MIN_PERIODS:
+            continue
+        if query_rollup_periods(index_directory, level, start_date, end_date):
+            return level
+        logger.info(f"No {level} rollups between {start_date.date()} and {end_date.date()}, run process_ndvi.py --rollups to build them")
+    return 'day'
+
+#Per-pixel max, mean and median code and valid count of a (dates, rows, cols) stack of NDVI codes. The median
+#picks the middle valid codes like histogram_statistics does: sorting puts the nodata zeros first and the two
+#middle valid codes are averaged. Codes are an affine map of NDVI, so the mean and median codes encode the mean
+#and median NDVI, but both are rounded to a whole code, up to half a code step (about 0.004 NDVI) from the exact
+#value histogram_statistics would give for the pixel.
+def composite_codes(stack):
+    counts = np.count_nonzero(stack, axis=0)
+    max_codes = stack.max(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_codes = np.rint(stack.sum(axis=0, dtype=np.uint32) / counts)
+    mean_codes = np.nan_to_num(mean_codes, nan=0).astype(np.uint8)
+
+    ordered = np.sort(stack, axis=0)
+    first = len(stack) - counts
+    lower = np.take_along_axis(ordered, (first + (counts - 1) // 2)[np.newaxis], axis=0)[0]
+    upper = np.take_along_axis(ordered, (first + counts // 2)[np.newaxis] % len(stack), axis=0)[0]
+    median_codes = np.rint((lower.astype(np.uint16) + upper) / 2).astype(np.uint8)
+    return max_codes, mean_codes, median_codes, counts.astype(np.uint16)
+
+#Composites the date mosaics of one CRS over a period onto the union of their footprints at the finest resolution.
+#Returns the composite and count file names and the number of dates. rasterio is imported here, so the CLIs can read
+#the rollup levels without loading it.
+def build_period_composite(output_directory, level, period, tag, mosaic_paths):
+    import rasterio as rio
+    from rasterio.enums import Resampling
+    from rasterio.transform import from_origin
+    from rasterio.vrt import WarpedVRT
+    from rasterio.windows import Window
+    period_directory = os.path.join(output_directory, ROLLUP_DIRECTORY, level, period)
+    os.makedirs(period_directory, exist_ok=True)
+    file_name = f'composite_{tag}.tif'
+    count_file_name = f'count_{tag}.tif'
+    temp_path = os.path.join(period_directory, f'.{file_name}.tmp')
+    temp_count_path = os.path.join(period_directory, f'.{count_file_name}.tmp')
+
+    with stage_timer('rollup_composite', level=level, period=period, dates=len(mosaic_paths)), ExitStack() as stack:
+        sources = [stack.enter_context(rio.open(path)) for path in mosaic_paths]
+        crs = sources[0].crs
+        resolution = min(min(abs(source.res[0]), abs(source.res[1])) for source in sources)
+        min_x = min(source.bounds.left for source in sources)
+        max_y = max(source.bounds.top for source in sources)
+        width = int(np.ceil((max(source.bounds.right for source in sources) - min_x) / resolution))
+        height = int(np.ceil((max_y - min(source.bounds.bottom for source in sources)) / resolution))
+        transform = from_origin(min_x, max_y, resolution, resolution)
+
+        # Every mosaic is warped onto the period grid, and only read for the blocks its footprint covers
+        readers = []
+        for source in sources:
+            vrt = stack.enter_context(WarpedVRT(source, crs=crs, transform=transform, width=width, height=height,
+                                                resampling=Resampling.nearest, src_nodata=0, nodata=0))
+            col_start = int(np.floor((source.bounds.left - min_x) / resolution))
+            col_stop = int(np.ceil((source.bounds.right - min_x) / resolution))
+            row_start = int(np.floor((max_y - source.bounds.top) / resolution))
+            row_stop = int(np.ceil((max_y - source.bounds.bottom) / resolution))
+            readers.append((vrt, row_start, row_stop, col_start, col_stop))
+
+        profile = {'driver': 'GTiff', 'width': width, 'height': height, 'crs': crs, 'transform': transform, 'nodata': 0,
+                   'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'DEFLATE'}
+        with rio.open(temp_path, 'w', count=3, dtype='uint8', **profile) as composite, \
+             rio.open(temp_count_path, 'w', count=1, dtype='uint16', **profile) as count:
+            for row_off in range(0, height, ROLLUP_BLOCK_SIZE):
+                for col_off in range(0, width, ROLLUP_BLOCK_SIZE):
+                    window = Window(col_off, row_off, min(ROLLUP_BLOCK_SIZE, width - col_off), min(ROLLUP_BLOCK_SIZE, height - row_off))
+                    covering = [vrt for vrt, row_start, row_stop, col_start, col_stop in readers
+                                if row_start < row_off + window.height and row_stop > row_off
+                                and col_start < col_off + window.width and col_stop > col_off]
+                    if not covering:
+                        continue
+                    codes = np.stack([vrt.read(1, window=window) for vrt in covering])
+                    max_codes, mean_codes, median_codes, counts = composite_codes(codes)
+                    composite.write(np.stack([max_codes, mean_codes, median_codes]), window=window)
+                    count.write(counts, 1, window=window)
+
+    os.replace(temp_path, os.path.join(period_directory, file_name))
+    os.replace(temp_count_path, os.path.join(period_directory, count_file_name))
+    return file_name, count_file_name, len(mosaic_paths)
+
+#Changes whenever an image of the date is added, removed or rewritten
+def date_signature(output_directory, dir_name, raster_paths):
+    parts = [dir_name]
+    for path in raster_paths:
+        try:
+            stat = os.stat(os.path.join(output_directory, path))
+            parts.append(f'{path}:{stat.st_mtime_ns}:{stat.st_size}')
+        except FileNotFoundError:
+            parts.append(f'{path}:missing')
+    return '\n'.join(parts)
+
+#Dates converted before mosaics existed get them from their raster_index.csv, since rollups are built from mosaics
+def backfill_date_mosaics(output_directory):
+    import pandas as pd
+    from mosaic_functions import build_date_mosaics
+    for dir_name in query_dates_without_mosaics(output_directory):
+        try:
+            raster_df = pd.read_csv(os.path.join(output_directory, dir_name, 'raster_index.csv'))
+            build_date_mosaics(output_directory, dir_name, {'FileName': list(raster_df['FileName']), 'MBR': list(raster_df['MBR'])})
+        except Exception as e:
+            logger.warning(f"Error building the mosaic of {dir_name}, leaving it out of the rollups: {e}")
+
+def remove_period_rollups(output_directory, level, period):
+    shutil.rmtree(os.path.join(output_directory, ROLLUP_DIRECTORY, level, period), ignore_errors=True)
+    delete_period_rollups(output_directory, level, period)
+    logger.info(f"Removed the {level} rollup of {period}, it has no dates left")
+
+#Runs build_period_composite for every task, yielding (task, result, error) as they finish
+def run_composite_tasks(output_directory, tasks, workers):
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(build_period_composite, output_directory, *task): task for task in tasks}
+            for future in as_completed(futures):
+                error = future.exception()
+                yield futures[future], None if error else future.result(), error
+        return
+
+    for task in tasks:
+        try:
+            result, error = build_period_composite(output_directory, *task), None
+        except Exception as e:
+            result, error = None, e
+        yield task, result, error
+
+#Brings the rollups of an output tree up to date. A period is rebuilt only when an image of one of its dates was
+#added, removed or rewritten since its rollups were built, and periods without dates are removed, so adding a date
+#rebuilds one month, one season and one year. Composites of different periods run on a process pool.
+def build_rollups(output_directory, levels=None, workers=1):
+    levels = levels or ROLLUP_LEVELS
+    ensure_raster_index(output_directory)
+    backfill_date_mosaics(output_directory)
+    sources = {}
+    for dir_name, date_sources in query_date_sources(output_directory).items():
+        try:
+            sources[dir_name] = (parse_date_directory(dir_name), *date_sources)
+        except ValueError:
+            continue
+    signatures = {dir_name: date_signature(output_directory, dir_name, raster_paths) for dir_name, (_, raster_paths, _) in sources.items()}
+
+    tasks = []
+    pending = {}
+    for level in levels:
+        periods = {}
+        for dir_name, (curr_date, _, _) in sorted(sources.items()):
+            periods.setdefault(rollup_period(level, curr_date), []).append(dir_name)
+
+        recorded = query_rollup_signatures(output_directory, level)
+        for (period, start, end), dir_names in periods.items():
+            signature = hashlib.sha1('\n'.join(signatures[dir_name] for dir_name in dir_names).encode()).hexdigest()
+            if recorded.get(period) == signature:
+                continue
+            by_tag = {}
+            for dir_name in dir_names:
+                for file_name, path, mbr in sources[dir_name][2]:
+                    by_tag.setdefault(os.path.splitext(file_name)[0].split('_', 1)[1], []).append((path, mbr))
+            pending[(level, period)] = {'start': start, 'end': end, 'signature': signature, 'remaining': len(by_tag),
+                                        'failed': False, 'rollups': [], 'mbrs': {}}
+            for tag, items in by_tag.items():
+                pending[(level, period)]['mbrs'][tag] = [min(m[0] for _, m in items), min(m[1] for _, m in items),
+                                                         max(m[2] for _, m in items), max(m[3] for _, m in items)]
+                tasks.append((level, period, tag, [path for path, _ in items]))
+
+        for period in recorded.keys() - {period for period, _, _ in periods}:
+            remove_period_rollups(output_directory, level, period)
+
+    for key, info in pending.items():
+        if info['remaining'] == 0:
+            finish_period_rollups(output_directory, *key, info)
+
+    logger.info(f"Building {len(tasks)} composites for {len(pending)} rollup periods")
+    for (level, period, tag, _), result, error in run_composite_tasks(output_directory, tasks, workers):
+        info = pending[(level, period)]
+        info['remaining'] -= 1
+        if error is not None:
+            logger.error(f"Error building the {level} rollup of {period} for {tag}: {error}")
+            info['failed'] = True
+        else:
+            file_name, count_file_name, dates = result
+            info['rollups'].append((file_name, count_file_name, dates, info['mbrs'][tag]))
+        if info['remaining'] == 0 and not info['failed']:
+            finish_period_rollups(output_directory, level, period, info)
+    return len(tasks)
+
+#Records a rebuilt period in the raster index and removes composites of CRSs it no longer has. A period whose
+#dates have no mosaics is recorded with its signature and no rollups, so it is not rebuilt by every run.
+def finish_period_rollups(output_directory, level, period, info):
+    relative_directory = os.path.join(ROLLUP_DIRECTORY, level, period)
+    period_directory = os.path.join(output_directory, relative_directory)
+    kept = set()
+    rollups = []
+    for file_name, count_file_name, dates, mbr in sorted(info['rollups']):
+        kept.update([file_name, count_file_name])
+        rollups.append((file_name, os.path.join(relative_directory, file_name), os.path.join(relative_directory, count_file_name), dates, mbr))
+    if os.path.isdir(period_directory):
+        for file_name in os.listdir(period_directory):
+            if file_name not in kept:
+                os.remove(os.path.join(period_directory, file_name))
+    set_period_rollups(output_directory, level, period, info['start'], info['end'], info['signature'], rollups)
+    logger.debug(f"Rollup {level} {period}: {len(rollups)} composites")
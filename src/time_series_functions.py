@@ -1,112 +1,417 @@
 import os
-import datetime as date
-from bounding_box_functions import *
-from ndvi_extraction_functions import *
+import time
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
 import pandas as pd
-from ndvi_image_functions import denormalize_ndvi
+from rasterio.transform import rowcol
+from ndvi_extraction_functions import (get_ndvi_value_from_latlon, sample_ndvi_values, sample_dataset_values, zonal_histogram,
+                                       dataset_zonal_histogram, dataset_label_histograms, geometry_key)
+from ndvi_kernel_functions import denormalize_ndvi
+from raster_index_functions import query_raster_index, query_mosaic_index, query_index_dates, query_rollup_index, query_rollup_periods
+from rollup_functions import ROLLUP_BANDS
+from resource_cache import get_transformer, load_wkt, open_dataset
+from wkt_functions import wkt_to_bounds
+from metrics import stage_timer, timed_call, metrics_enabled, record_pool_utilization
 from log_config import logger
 
-def ndvi_timeseries_point(latitude, longitude, start_date, end_date, search_dir):
-    search_files = os.listdir(search_dir)
-    time_series = []
+POINT_COLUMNS = ['Date', 'File', 'PixelValue']
+POINTS_COLUMNS = ['ID', 'Date', 'File', 'PixelValue']
+RANGE_COLUMNS = ['Date', 'NDVI_MIN', 'NDVI_MAX', 'NDVI_MEDIAN', 'NDVI_MEAN']
+FEATURES_COLUMNS = ['ID', 'Date', 'NDVI_MIN', 'NDVI_MAX', 'NDVI_MEDIAN', 'NDVI_MEAN']
+DATACUBE_POINT_COLUMNS = ['Date', 'PixelValue']
+ROLLUP_POINT_COLUMNS = ['Date', 'Period', 'File', 'NDVI_MAX', 'NDVI_MEAN', 'NDVI_MEDIAN', 'VALID_COUNT']
+ROLLUP_RANGE_COLUMNS = ['Date', 'Period', 'NDVI_MIN', 'NDVI_MAX', 'NDVI_MEDIAN', 'NDVI_MEAN']
+
+# Every query is planned as (date_function, date_args, assemble): one call of date_function per date does all the
+# file work for that date, and assemble turns the results, in date order, into the final table. Date functions
+# are module level so they can run on thread or process pools.
+def group_candidates_by_date(candidates):
+    images_by_date = {}
+    for curr_date, image, path, curr_mbr in candidates:
+        images_by_date.setdefault(curr_date, []).append((image, path, curr_mbr))
+    return images_by_date
+
+#Like group_candidates_by_date over the images intersecting bounds, but a date with a mosaic reads its mosaic
+#instead, one windowed read where its images overlap. Only for queries that add up every image of a date: point
+#queries take the first image with data and keep reading the images.
+def mosaic_candidates_by_date(search_dir, bounds, start_date, end_date):
+    images_by_date = group_candidates_by_date(query_raster_index(search_dir, bounds, start_date, end_date))
+    images_by_date.update(group_candidates_by_date(query_mosaic_index(search_dir, bounds, start_date, end_date)))
+    return images_by_date
+
+#With metrics on, every date is timed where it runs and the pool's utilization is recorded
+def run_timeseries(plan, workers=1, executor=None, use_processes=False):
+    date_function, date_args, assemble = plan
+    timed = metrics_enabled()
+    if timed:
+        date_function = partial(timed_call, date_function)
+        start = time.perf_counter()
+
+    if executor is not None:
+        results = list(executor.map(date_function, *zip(*date_args))) if date_args else []
+        workers = getattr(executor, '_max_workers', workers)
+    elif workers > 1 and len(date_args) > 1:
+        pool_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with pool_class(max_workers=workers) as pool:
+            results = list(pool.map(date_function, *zip(*date_args)))
+    else:
+        results = [date_function(*args) for args in date_args]
+        workers = 1
+
+    if timed:
+        record_pool_utilization('timeseries_pool', sum(seconds for _, seconds in results), time.perf_counter() - start, workers, dates=len(date_args))
+        results = [result for result, _ in results]
+    with stage_timer('assemble'):
+        return assemble(results)
+
+#Runs a planned query with its dates fanned out on a shared executor (None uses the loop's default one),
+#so a service can run several queries at once on one pool
+async def run_timeseries_async(plan, executor=None):
+    date_function, date_args, assemble = plan
+    timed = metrics_enabled()
+    if timed:
+        date_function = partial(timed_call, date_function)
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*(loop.run_in_executor(executor, date_function, *args) for args in date_args))
+    if timed:
+        results = [result for result, _ in results]
+    with stage_timer('assemble'):
+        return assemble(results)
+
+async def ndvi_timeseries_async(kind, *args, executor=None):
+    loop = asyncio.get_running_loop()
+    plan = await loop.run_in_executor(executor, TIMESERIES_PLANNERS[kind], *args)
+    return await run_timeseries_async(plan, executor)
+
+def point_value_for_date(latitude, longitude, curr_date, images):
+    for image, path, curr_mbr in images:
+        try:
+            pixel_val = get_ndvi_value_from_latlon(latitude, longitude, path)
+            denormalize_pixel_val = denormalize_ndvi(pixel_val)
+
+            if pixel_val != 0:
+                logger.info(f"Date: {curr_date}: {pixel_val}")
+                return {
+                    'Date': curr_date,
+                    'File': os.path.basename(path),
+                    'PixelValue': denormalize_pixel_val
+                }
+        except Exception as e:
+            logger.warning(f"Error processing image {image}: {e}")
+    return None
+
+def assemble_point_rows(rows):
+    return pd.DataFrame([row for row in rows if row is not None], columns=POINT_COLUMNS)
+
+def plan_point_timeseries(latitude, longitude, start_date, end_date, search_dir):
+    candidates = query_raster_index(search_dir, [longitude, latitude, longitude, latitude], start_date, end_date)
+    date_args = [(latitude, longitude, curr_date, images) for curr_date, images in group_candidates_by_date(candidates).items()]
+    return point_value_for_date, date_args, assemble_point_rows
+
+def ndvi_timeseries_point(latitude, longitude, start_date, end_date, search_dir, workers=1, executor=None, use_processes=False):
+    return run_timeseries(plan_point_timeseries(latitude, longitude, start_date, end_date, search_dir), workers, executor, use_processes)
+
+#Exact min, max, median and mean of the denormalized values behind a 256-bin code histogram.
+#The median averages the two middle values for an even count, like np.nanmedian.
+def histogram_statistics(histogram):
+    count = histogram.sum()
+    if count == 0:
+        return np.nan, np.nan, np.nan, np.nan
+
+    ndvi_values = denormalize_ndvi(np.arange(256))
+    codes = np.flatnonzero(histogram)
+    cumulative = np.cumsum(histogram)
+    lower = np.searchsorted(cumulative, (count - 1) // 2, side='right')
+    upper = np.searchsorted(cumulative, count // 2, side='right')
+
+    min_val = ndvi_values[codes[0]]
+    max_val = ndvi_values[codes[-1]]
+    median_val = (ndvi_values[lower] + ndvi_values[upper]) / 2
+    mean_val = np.dot(histogram, ndvi_values) / count
+    return min_val, max_val, median_val, mean_val
+
+def range_statistics_for_date(geometry, key, curr_date, images):
+    histogram = np.zeros(256, dtype=np.int64)
+    for image, path, curr_mbr in images:
+        try:
+            histogram += zonal_histogram(geometry, path, key=key)
+        except Exception as e:
+            logger.warning(f"Error processing image {image}: {e}")
+
+    min_val, max_val, median_val, mean_val = histogram_statistics(histogram)
+    return {
+        'Date': curr_date,
+        'NDVI_MIN': min_val,
+        'NDVI_MAX': max_val,
+        'NDVI_MEDIAN': median_val,
+        'NDVI_MEAN': mean_val,
+    }
+
+def assemble_range_rows(rows):
+    return pd.DataFrame(rows, columns=RANGE_COLUMNS)
+
+def plan_range_timeseries(wkt_string, start_date, end_date, search_dir):
+    geometry = load_wkt(wkt_string)
+    key = geometry_key(geometry)
+    images_by_date = mosaic_candidates_by_date(search_dir, wkt_to_bounds(wkt_string), start_date, end_date)
+
+    date_args = [(geometry, key, curr_date, images_by_date.get(curr_date, []))
+                 for curr_date in query_index_dates(search_dir, start_date, end_date)]
+    return range_statistics_for_date, date_args, assemble_range_rows
+
+def ndvi_timeseries_range(wkt_string, start_date, end_date, search_dir, workers=1, executor=None, use_processes=False):
+    return run_timeseries(plan_range_timeseries(wkt_string, start_date, end_date, search_dir), workers, executor, use_processes)
+
+#Reads a CSV or Parquet table of points and returns it with ID, Latitude and Longitude columns
+def read_points_table(points_path):
+    if points_path.lower().endswith('.parquet'):
+        points_df = pd.read_parquet(points_path)
+    else:
+        points_df = pd.read_csv(points_path)
+
+    column_names = {'id': 'ID', 'lat': 'Latitude', 'latitude': 'Latitude', 'lon': 'Longitude', 'longitude': 'Longitude'}
+    points_df = points_df.rename(columns={column: column_names[column.lower()] for column in points_df.columns if column.lower() in column_names})
 
-    for file in search_files:
+    missing = {'ID', 'Latitude', 'Longitude'} - set(points_df.columns)
+    if missing:
+        raise ValueError(f"Points table {points_path} is missing the columns {sorted(missing)}")
+    return points_df[['ID', 'Latitude', 'Longitude']]
+
+#Samples every point inside an image's MBR from that image; the first image with a valid value wins for a point
+def points_values_for_date(ids, latitudes, longitudes, curr_date, images):
+    found = np.zeros(len(ids), dtype=bool)
+    time_series = []
+    for image, path, curr_mbr in images:
+        min_lon, min_lat, max_lon, max_lat = curr_mbr
+        point_index = np.flatnonzero(~found & (min_lon <= longitudes) & (longitudes <= max_lon)
+                                     & (min_lat <= latitudes) & (latitudes <= max_lat))
+        if point_index.size == 0:
+            continue
         try:
-            year, month, day = file.split('-')
-            year, month, day = int(year), int(month), int(day)
-            curr_date = date.datetime(year, month, day)
-
-            if start_date <= curr_date <= end_date:
-                curr_dir = os.path.join(search_dir, file)
-                curr_list = os.listdir(curr_dir)
-                curr_list = [f for f in curr_list if f.endswith('.tif')]
-
-                point_found = False
-
-                for image in curr_list:
-                    try:
-                        raster_path = os.path.join(curr_dir, 'raster_index.csv')
-                        raster_df = pd.read_csv(raster_path)
-                        curr_mbr = wkt_to_bounds(raster_df.loc[raster_df['FileName'] == image.split('.')[0], 'MBR'].iloc[0])
-                        
-                        if inBoundingBox_point(latitude, longitude, curr_mbr):
-                            path = os.path.join(curr_dir, image)
-                            pixel_val = get_ndvi_value_from_latlon(latitude, longitude, path)
-                            denormalize_pixel_val = denormalize_ndvi(pixel_val)
-                            
-                            if pixel_val != 0:
-                                time_series.append({
-                                    'Date': curr_date,
-                                    'File': image,
-                                    'PixelValue': denormalize_pixel_val
-                                })
-                                logger.info(f"Date: {curr_date}: {pixel_val}")
-                                point_found = True
-                                break  
-                        else:
-                            logger.info(f'Point not in {image}')
-                    except Exception as e:
-                        logger.warning(f"Error processing image {image}: {e}")
-
-                if point_found:
-                    break  
+            values, inside = sample_ndvi_values(latitudes[point_index], longitudes[point_index], path)
+            valid = inside & (values != 0)
+            hits = point_index[valid]
+            found[hits] = True
 
+            time_series.append(pd.DataFrame({
+                'ID': ids[hits],
+                'Date': curr_date,
+                'File': os.path.basename(path),
+                'PixelValue': denormalize_ndvi(values[valid])
+            }))
+            logger.info(f"Date: {curr_date}: {hits.size} points sampled from {image}")
         except Exception as e:
-            logger.warning(f"Error processing file {file}: {e}")
+            logger.warning(f"Error processing image {image}: {e}")
+    return time_series
+
+def assemble_points_rows(results):
+    time_series = [frame for frames in results for frame in frames]
+    if not time_series:
+        return pd.DataFrame(columns=POINTS_COLUMNS)
+    df = pd.concat(time_series, ignore_index=True)
+    return df.sort_values(['ID', 'Date'], kind='stable', ignore_index=True)
+
+def plan_points_timeseries(points_df, start_date, end_date, search_dir):
+    ids = points_df['ID'].to_numpy()
+    latitudes = points_df['Latitude'].to_numpy(dtype=np.float64)
+    longitudes = points_df['Longitude'].to_numpy(dtype=np.float64)
+    if len(ids) == 0:
+        return points_values_for_date, [], assemble_points_rows
 
-    df = pd.DataFrame(time_series)
-    return df
+    bounds = [longitudes.min(), latitudes.min(), longitudes.max(), latitudes.max()]
+    candidates = query_raster_index(search_dir, bounds, start_date, end_date)
+    date_args = [(ids, latitudes, longitudes, curr_date, images) for curr_date, images in group_candidates_by_date(candidates).items()]
+    return points_values_for_date, date_args, assemble_points_rows
+
+#Point time series for many points at once. Every candidate image is opened once per date and
+#samples all the points inside its MBR, so the cost follows the number of images, not of points.
+def ndvi_timeseries_points(points_df, start_date, end_date, search_dir, workers=1, executor=None, use_processes=False):
+    return run_timeseries(plan_points_timeseries(points_df, start_date, end_date, search_dir), workers, executor, use_processes)
+
+#Reads a GeoPackage, GeoJSON or shapefile of Polygons and MultiPolygons, keyed by id_column (or the row number)
+def read_features_table(features_path, id_column=None):
+    import geopandas as gpd
+    features_gdf = gpd.read_file(features_path)
+    if features_gdf.crs is not None:
+        features_gdf = features_gdf.to_crs('EPSG:4326')
+
+    features_gdf = features_gdf[features_gdf.geometry.geom_type.isin(['Polygon', 'MultiPolygon'])]
+    if id_column is None:
+        ids = features_gdf['ID'] if 'ID' in features_gdf.columns else features_gdf.index
+    elif id_column in features_gdf.columns:
+        ids = features_gdf[id_column]
+    else:
+        raise ValueError(f"Features file {features_path} has no column {id_column}")
+    return gpd.GeoDataFrame({'ID': list(ids)}, geometry=list(features_gdf.geometry), crs='EPSG:4326')
+
+def features_statistics_for_date(ids, geometries, feature_bounds, curr_date, images):
+    histograms = np.zeros((len(ids), 256), dtype=np.int64)
+    covered = np.zeros(len(ids), dtype=bool)
+    for image, path, curr_mbr in images:
+        min_lon, min_lat, max_lon, max_lat = curr_mbr
+        feature_index = np.flatnonzero((feature_bounds[:, 0] <= max_lon) & (feature_bounds[:, 2] >= min_lon)
+                                       & (feature_bounds[:, 1] <= max_lat) & (feature_bounds[:, 3] >= min_lat))
+        if feature_index.size == 0:
+            continue
+        try:
+            with open_dataset(path) as dataset:
+                histograms[feature_index] += dataset_label_histograms(dataset, [geometries[i] for i in feature_index])
+            covered[feature_index] = True
+        except Exception as e:
+            logger.warning(f"Error processing image {image}: {e}")
 
-def ndvi_timeseries_range(wkt_string, start_date, end_date, search_dir):
-    search_files = os.listdir(search_dir)
     time_series = []
+    for i in np.flatnonzero(covered):
+        min_val, max_val, median_val, mean_val = histogram_statistics(histograms[i])
+        time_series.append({
+            'ID': ids[i],
+            'Date': curr_date,
+            'NDVI_MIN': min_val,
+            'NDVI_MAX': max_val,
+            'NDVI_MEDIAN': median_val,
+            'NDVI_MEAN': mean_val,
+        })
+    logger.info(f"Date: {curr_date}: statistics for {covered.sum()} features")
+    return time_series
+
+def assemble_features_rows(results):
+    time_series = [row for rows in results for row in rows]
+    if not time_series:
+        return pd.DataFrame(columns=FEATURES_COLUMNS)
+    df = pd.DataFrame(time_series, columns=FEATURES_COLUMNS)
+    return df.sort_values(['ID', 'Date'], kind='stable', ignore_index=True)
+
+def plan_features_timeseries(features_gdf, start_date, end_date, search_dir):
+    if len(features_gdf) == 0:
+        return features_statistics_for_date, [], assemble_features_rows
+
+    ids = features_gdf['ID'].to_numpy()
+    geometries = list(features_gdf.geometry)
+    feature_bounds = features_gdf.geometry.bounds.to_numpy()
+    images_by_date = mosaic_candidates_by_date(search_dir, list(features_gdf.total_bounds), start_date, end_date)
+    date_args = [(ids, geometries, feature_bounds, curr_date, images) for curr_date, images in sorted(images_by_date.items())]
+    return features_statistics_for_date, date_args, assemble_features_rows
+
+#Range time series for a whole feature collection. Each candidate image is opened once per date and all the
+#features intersecting its MBR get their histograms from the same decoded windows.
+def ndvi_timeseries_features(features_gdf, start_date, end_date, search_dir, workers=1, executor=None, use_processes=False):
+    return run_timeseries(plan_features_timeseries(features_gdf, start_date, end_date, search_dir), workers, executor, use_processes)
+
+#Point time series from the datacube instead of the NDVI images. The pixel's whole history is read from one chunk
+#per DATACUBE_TIME_CHUNK dates, and dates without data are dropped like in ndvi_timeseries_point.
+def datacube_timeseries_point(latitude, longitude, start_date, end_date, store_path):
+    from datacube_functions import open_datacube, DATACUBE_VARIABLE
+    cube = open_datacube(store_path)
+    x, y = get_transformer('EPSG:4326', cube.rio.crs).transform(longitude, latitude)
+    row, col = rowcol(cube.rio.transform(), x, y)
+    if not (0 <= row < cube.sizes['y'] and 0 <= col < cube.sizes['x']):
+        logger.warning(f"Point {latitude}, {longitude} is outside the datacube")
+        return pd.DataFrame(columns=DATACUBE_POINT_COLUMNS)
 
-    for file in search_files:
+    history = cube[DATACUBE_VARIABLE].isel(y=row, x=col).sortby('time').sel(time=slice(start_date, end_date)).load()
+    valid = history.values != 0
+    return pd.DataFrame({
+        'Date': history['time'].to_index()[valid].strftime('%Y-%m-%d'),
+        'PixelValue': denormalize_ndvi(history.values[valid])
+    }, columns=DATACUBE_POINT_COLUMNS)
+
+#NDVI history of every datacube pixel inside the polygon as a lazy (time, y, x) DataArray, NaN where there is no data
+def datacube_region(wkt_string, start_date, end_date, store_path):
+    from datacube_functions import open_datacube, DATACUBE_VARIABLE
+    cube = open_datacube(store_path)
+    geometry = load_wkt(wkt_string)
+    codes = cube[DATACUBE_VARIABLE].sortby('time').sel(time=slice(start_date, end_date))
+    codes = codes.rio.clip([geometry], crs='EPSG:4326', drop=True)
+    return denormalize_ndvi(codes.where(codes != 0)).rio.write_crs(cube.rio.crs)
+
+# Rollup time series read the month, season or year composites written by rollup_functions.build_rollups, one row
+# per whole period between the start and end dates, dated by the period's first day. Periods take the place of
+# dates in the plans, so a 20 year query reads 20 yearly composites instead of every date.
+def group_rollups_by_period(candidates):
+    rollups_by_period = {}
+    for period_date, period, file_name, path, count_path, mbr in candidates:
+        rollups_by_period.setdefault((period_date, period), []).append((file_name, path, count_path, mbr))
+    return rollups_by_period
+
+#Like point_value_for_date, the first composite with data at the point answers
+def rollup_point_for_period(latitude, longitude, period_date, period, rollups):
+    for file_name, path, count_path, mbr in rollups:
         try:
-            year, month, day = file.split('-')
-            year, month, day = int(year), int(month), int(day)
-            curr_date = date.datetime(year, month, day)
-
-            if start_date <= curr_date <= end_date:
-                curr_dir = os.path.join(search_dir, file)
-                curr_list = os.listdir(curr_dir)
-                curr_list = [f for f in curr_list if f.endswith('.tif')]
-
-                curr_ndvi_values = []
-                raster_path = os.path.join(curr_dir, 'raster_index.csv')
-                raster_df = pd.read_csv(raster_path)
-                for image in curr_list:
-                    try:
-                        curr_mbr = wkt_to_bounds(raster_df.loc[raster_df['FileName'] == image.split('.')[0], 'MBR'].iloc[0])
-                        
-                        if inBoundingBox_range(wkt_string, curr_mbr):
-                            path = os.path.join(curr_dir, image)
-                            aoi_values = get_ndvi_from_range(wkt_string, path)
-                            curr_ndvi_values.extend(aoi_values)
-                    except Exception as e:
-                        logger.warning(f"Error processing image {image}: {e}")
-
-                ndvi_values_array = np.array(curr_ndvi_values)
-
-                if ndvi_values_array.size == 0:
-                    min_val, max_val, median_val, mean_val = np.nan, np.nan, np.nan, np.nan
-                else:
-                    ndvi_values_denormalized = denormalize_ndvi(ndvi_values_array)
-                    min_val = np.nanmin(ndvi_values_denormalized)
-                    max_val = np.nanmax(ndvi_values_denormalized)
-                    median_val = np.nanmedian(ndvi_values_denormalized)
-                    mean_val = np.nanmean(ndvi_values_denormalized)
-
-                time_series.append({
-                    'Date': curr_date,
-                    'NDVI_MIN': min_val,
-                    'NDVI_MAX': max_val,
-                    'NDVI_MEDIAN': median_val,
-                    'NDVI_MEAN': mean_val,
-                })
+            with open_dataset(path) as dataset:
+                codes = [sample_dataset_values(dataset, [latitude], [longitude], band_id=band_id)[0][0]
+                         for band_id in (ROLLUP_BANDS['max'], ROLLUP_BANDS['mean'], ROLLUP_BANDS['median'])]
+            if codes[2] == 0:
+                continue
+            with open_dataset(count_path) as dataset:
+                valid_count = sample_dataset_values(dataset, [latitude], [longitude])[0][0]
+            return {
+                'Date': period_date,
+                'Period': period,
+                'File': file_name,
+                'NDVI_MAX': denormalize_ndvi(codes[0]),
+                'NDVI_MEAN': denormalize_ndvi(codes[1]),
+                'NDVI_MEDIAN': denormalize_ndvi(codes[2]),
+                'VALID_COUNT': int(valid_count),
+            }
+        except Exception as e:
+            logger.warning(f"Error processing rollup {path}: {e}")
+    return None
+
+def assemble_rollup_point_rows(rows):
+    return pd.DataFrame([row for row in rows if row is not None], columns=ROLLUP_POINT_COLUMNS)
+
+def plan_rollup_point_timeseries(latitude, longitude, start_date, end_date, search_dir, level):
+    candidates = query_rollup_index(search_dir, level, [longitude, latitude, longitude, latitude], start_date, end_date)
+    period_args = [(latitude, longitude, period_date, period, rollups)
+                   for (period_date, period), rollups in group_rollups_by_period(candidates).items()]
+    return rollup_point_for_period, period_args, assemble_rollup_point_rows
 
+def ndvi_rollup_point(latitude, longitude, start_date, end_date, search_dir, level, workers=1, executor=None, use_processes=False):
+    return run_timeseries(plan_rollup_point_timeseries(latitude, longitude, start_date, end_date, search_dir, level), workers, executor, use_processes)
+
+#Range statistics over the polygon's pixels of one composite band: the per-pixel max, mean or median of the period
+def rollup_range_for_period(geometry, key, band_id, period_date, period, rollups):
+    histogram = np.zeros(256, dtype=np.int64)
+    for file_name, path, count_path, mbr in rollups:
+        try:
+            with open_dataset(path) as dataset:
+                histogram += dataset_zonal_histogram(dataset, geometry, band_id=band_id, key=key)
         except Exception as e:
-            logger.warning(f"Error processing file {file}: {e}")
+            logger.warning(f"Error processing rollup {path}: {e}")
+
+    min_val, max_val, median_val, mean_val = histogram_statistics(histogram)
+    return {
+        'Date': period_date,
+        'Period': period,
+        'NDVI_MIN': min_val,
+        'NDVI_MAX': max_val,
+        'NDVI_MEDIAN': median_val,
+        'NDVI_MEAN': mean_val,
+    }
+
+def assemble_rollup_range_rows(rows):
+    return pd.DataFrame(rows, columns=ROLLUP_RANGE_COLUMNS)
+
+def plan_rollup_range_timeseries(wkt_string, start_date, end_date, search_dir, level, composite='median'):
+    geometry = load_wkt(wkt_string)
+    key = geometry_key(geometry)
+    candidates = query_rollup_index(search_dir, level, wkt_to_bounds(wkt_string), start_date, end_date)
+    rollups_by_period = group_rollups_by_period(candidates)
+
+    period_args = [(geometry, key, ROLLUP_BANDS[composite], period_date, period, rollups_by_period.get((period_date, period), []))
+                   for period_date, period in query_rollup_periods(search_dir, level, start_date, end_date)]
+    return rollup_range_for_period, period_args, assemble_rollup_range_rows
+
+def ndvi_rollup_range(wkt_string, start_date, end_date, search_dir, level, composite='median', workers=1, executor=None, use_processes=False):
+    return run_timeseries(plan_rollup_range_timeseries(wkt_string, start_date, end_date, search_dir, level, composite), workers, executor, use_processes)
 
-    df = pd.DataFrame(time_series)
-    return df
\ No newline at end of file
+TIMESERIES_PLANNERS = {
+    'point': plan_point_timeseries,
+    'points': plan_points_timeseries,
+    'range': plan_range_timeseries,
+    'features': plan_features_timeseries,
+    'rollup_point': plan_rollup_point_timeseries,
+    'rollup_range': plan_rollup_range_timeseries,
+}
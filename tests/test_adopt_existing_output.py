@@ -0,0 +1,63 @@
+import os
+import sys
+import pytest
+
+pytest.importorskip('osgeo')
+pytest.importorskip('rasterio')
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from manifest_functions import conversion_params
+from osgeo import gdal, osr
+from ndvi_image_functions import adopt_existing_output
+
+#A legacy NDVI image cut short by a crash: a valid TIFF header followed by garbage
+CORRUPT_TIFF = b'II*\x00\x08\x00\x00\x00' + b'\xff' * 64
+
+#A legacy NDVI image as earlier versions wrote it, a striped JPEG GTiff at quality 60
+def write_legacy_output(path):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32611)
+    dataset = gdal.GetDriverByName('GTiff').Create(path, 64, 64, 1, gdal.GDT_Byte, options=['COMPRESS=JPEG', 'JPEG_QUALITY=60'])
+    dataset.SetGeoTransform((380000, 30, 0, 3790000, 0, -30))
+    dataset.SetProjection(srs.ExportToWkt())
+    dataset.GetRasterBand(1).Fill(128)
+    dataset = None
+    return path
+
+def write_file(path, content):
+    with open(path, 'wb') as file:
+        file.write(content)
+    return path
+
+@pytest.fixture
+def scene(tmp_path):
+    band4 = write_file(str(tmp_path / 'SCENE_B4.TIF'), b'red')
+    band5 = write_file(str(tmp_path / 'SCENE_B5.TIF'), b'nir')
+    return band4, band5, str(tmp_path / 'SCENE.tif')
+
+def test_corrupt_output_is_converted_again(scene):
+    band4, band5, output_path = scene
+    write_file(output_path, CORRUPT_TIFF)
+    assert adopt_existing_output(band4, band5, output_path, conversion_params()) is None
+
+def test_empty_output_is_converted_again(scene):
+    band4, band5, output_path = scene
+    write_file(output_path, b'')
+    assert adopt_existing_output(band4, band5, output_path, conversion_params()) is None
+
+def test_missing_output_is_converted(scene):
+    band4, band5, output_path = scene
+    assert adopt_existing_output(band4, band5, output_path, conversion_params()) is None
+
+def test_legacy_output_is_adopted_with_its_own_params(scene):
+    band4, band5, output_path = scene
+    write_legacy_output(output_path)
+    record = adopt_existing_output(band4, band5, output_path, conversion_params())
+    assert record is not None
+    assert record['params'] == conversion_params('60', 'JPEG', False)
+
+def test_legacy_output_written_with_other_params_is_converted_again(scene):
+    band4, band5, output_path = scene
+    write_legacy_output(output_path)
+    assert adopt_existing_output(band4, band5, output_path, conversion_params('60', 'ZSTD', True)) is None
@@ -0,0 +1,35 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+pytest.importorskip('rasterio')
+pytest.importorskip('shapely')
+pytest.importorskip('pyproj')
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ndvi_kernel_functions import denormalize_ndvi
+from time_series_functions import histogram_statistics
+
+def code_histogram(codes):
+    return np.bincount(codes, minlength=256).astype(np.int64)
+
+#Statistics taken directly over the denormalized values, as range queries computed them before histograms
+@pytest.mark.parametrize('count', [1, 2, 7, 8, 1001, 1000])
+def test_statistics_match_the_values(count):
+    codes = np.random.default_rng(count).integers(1, 256, count)
+    values = denormalize_ndvi(codes)
+    expected = (np.min(values), np.max(values), np.median(values), np.mean(values))
+    np.testing.assert_allclose(histogram_statistics(code_histogram(codes)), expected, rtol=0, atol=1e-12)
+
+def test_even_count_median_averages_the_two_middle_values():
+    histogram = code_histogram(np.array([10, 10, 200, 250]))
+    assert histogram_statistics(histogram)[2] == (denormalize_ndvi(10) + denormalize_ndvi(200)) / 2
+
+def test_odd_count_median_is_the_middle_value():
+    histogram = code_histogram(np.array([10, 200, 250]))
+    assert histogram_statistics(histogram)[2] == denormalize_ndvi(200)
+
+def test_empty_histogram_is_nan():
+    assert all(np.isnan(histogram_statistics(np.zeros(256, dtype=np.int64))))
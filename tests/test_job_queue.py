@@ -0,0 +1,111 @@
+import os
+import sys
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import job_queue_functions
+from job_queue_functions import JobQueue, LEASE_SECONDS, MAX_ATTEMPTS
+
+#Stands in for the time module of job_queue_functions, so leases expire without waiting for them
+class FakeClock:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(job_queue_functions, 'time', clock)
+    return clock
+
+@pytest.fixture
+def queues(tmp_path, clock):
+    first, second = JobQueue(str(tmp_path), 'first'), JobQueue(str(tmp_path), 'second')
+    first.enqueue_directory('2023-01-05', [('A_B4.TIF', 'A_B5.TIF', 'A', False), ('B_B4.TIF', 'B_B5.TIF', 'B', True)])
+    return first, second
+
+def test_claim_hands_each_job_out_once(queues):
+    first, second = queues
+    job = first.claim()
+    assert job[1:] == ('2023-01-05', 'A_B4.TIF', 'A_B5.TIF', 'A', 0)
+    assert second.claim()[4:] == ('B', 1)
+    assert first.claim() is None
+    assert first.counts()['leased'] == 2
+
+def test_expired_lease_is_claimed_by_another_worker(queues, clock):
+    first, second = queues
+    job_id = first.claim()[0]
+    second.claim()
+    assert second.claim() is None
+
+    clock.now += LEASE_SECONDS + 1
+    assert second.claim()[0] == job_id
+    assert not first.complete(job_id, {'file': 'A'})
+    assert second.complete(job_id, {'file': 'A'})
+
+def test_renew_keeps_the_lease(queues, clock):
+    first, second = queues
+    first.claim()
+    first.claim()
+    clock.now += LEASE_SECONDS - 1
+    first.renew()
+    clock.now += 2
+    assert second.claim() is None
+
+def test_failed_job_is_retried_until_max_attempts(queues):
+    first, second = queues
+    for attempt in range(MAX_ATTEMPTS):
+        job_id, *_, file_name, adopt = first.claim()
+        assert file_name == 'A'
+        first.fail(job_id, 'read error')
+    assert first.claim()[4] == 'B'
+    assert first.counts()['failed'] == 1
+
+def test_lease_expired_max_attempts_times_is_failed(queues, clock):
+    first, second = queues
+    for attempt in range(MAX_ATTEMPTS):
+        assert second.claim()[4] == 'A'
+        clock.now += LEASE_SECONDS + 1
+    assert first.claim()[4] == 'B'
+    counts = first.counts()
+    assert (counts['failed'], counts['leased']) == (1, 1)
+
+def finish_jobs(queue):
+    while (job := queue.claim()) is not None:
+        queue.complete(job[0], {})
+
+def test_drained_once_every_directory_is_finalized(queues):
+    first, second = queues
+    assert not first.is_drained()
+    finish_jobs(first)
+    assert not first.is_drained()
+    assert first.finishable_directories() == ['2023-01-05']
+    assert set(first.directory_records('2023-01-05')) == {'A', 'B'}
+    first.mark_finalized('2023-01-05')
+    assert first.is_drained()
+
+def test_not_drained_while_another_worker_scans(queues):
+    first, second = queues
+    finish_jobs(first)
+    first.mark_finalized('2023-01-05')
+    assert second.try_lease('scan')
+    assert not first.try_lease('scan')
+    assert not first.is_drained()
+    second.release('scan')
+    assert first.is_drained()
+
+def test_failed_jobs_count_as_finished(queues):
+    first, second = queues
+    for attempt in range(MAX_ATTEMPTS):
+        first.fail(first.claim()[0], 'read error')
+    finish_jobs(first)
+    assert first.finishable_directories() == ['2023-01-05']
+    assert set(first.directory_records('2023-01-05')) == {'B'}
+    first.mark_finalized('2023-01-05')
+    assert first.is_drained()
@@ -0,0 +1,53 @@
+import os
+import sys
+import pytest
+
+pytest.importorskip('rasterio')
+pytest.importorskip('shapely')
+pytest.importorskip('pyproj')
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from resource_cache import LRUCache
+
+def test_least_recently_used_entry_is_evicted_first():
+    evicted = []
+    cache = LRUCache('test', max_entries=3, on_evict=evicted.append)
+    for key in 'abc':
+        cache.put(key, key.upper())
+    assert cache.get('a') == 'A'
+    cache.put('d', 'D')
+    cache.put('e', 'E')
+    assert evicted == ['B', 'C']
+    assert [cache.get(key) for key in 'abcde'] == ['A', None, None, 'D', 'E']
+    assert cache.stats()['evictions'] == 2
+
+def test_size_bound_evicts_until_the_total_fits():
+    evicted = []
+    cache = LRUCache('test', max_bytes=10, sizeof=len, on_evict=evicted.append)
+    for value in ['aaaa', 'bbbb', 'cc']:
+        cache.put(value[0], value)
+    cache.get('a')
+    cache.put('d', 'dddddd')
+    assert evicted == ['bbbb', 'cc']
+    assert cache.stats()['bytes'] == 10
+
+def test_replaced_value_is_handed_to_on_evict():
+    evicted = []
+    cache = LRUCache('test', max_entries=2, on_evict=evicted.append)
+    cache.put('a', 'old')
+    cache.put('b', 'B')
+    cache.put('a', 'new')
+    cache.put('c', 'C')
+    assert evicted == ['old', 'B']
+    assert cache.get('a') == 'new'
+
+def test_get_or_create_builds_once():
+    built = []
+    cache = LRUCache('test', max_entries=2)
+    def factory():
+        built.append(1)
+        return 'value'
+    assert cache.get_or_create('a', factory) == 'value'
+    assert cache.get_or_create('a', factory) == 'value'
+    assert len(built) == 1
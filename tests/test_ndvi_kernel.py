@@ -0,0 +1,52 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from ndvi_kernel_functions import make_ndvi_kernel, ndvi_codes_reference
+
+#Random DNs plus the edges of the chain: 0/0 (NaN), a zero band on either side and the largest DNs
+def uint16_bands():
+    rng = np.random.default_rng(0)
+    red = rng.integers(0, 65536, (64, 96), dtype=np.uint16)
+    nir = rng.integers(0, 65536, (64, 96), dtype=np.uint16)
+    red[0, :4], nir[0, :4] = [0, 0, 500, 65535], [0, 500, 0, 65535]
+    return red, nir
+
+#Float bands as a caller could pass them: NaN in either band, and red == -nir so the denominator is zero but the
+#numerator is not
+def float_bands():
+    red, nir = (band.astype(np.float64) for band in uint16_bands())
+    red[1, :3], nir[1, :3] = [np.nan, 100, np.nan], [100, np.nan, np.nan]
+    red[2, :2], nir[2, :2] = [-300, 300], [300, -300]
+    return red, nir
+
+def run_kernel(backend, red, nir, chunk_shape=None):
+    kernel = make_ndvi_kernel(chunk_shape or red.shape, backend)
+    codes = np.empty(red.shape, dtype=np.uint8)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return kernel(red, nir, codes)
+
+@pytest.fixture(params=['numpy', 'numba'])
+def backend(request):
+    if request.param == 'numba':
+        pytest.importorskip('numba')
+    return request.param
+
+@pytest.mark.parametrize('bands', [uint16_bands, float_bands])
+def test_kernel_matches_original_chain(backend, bands):
+    red, nir = bands()
+    assert np.array_equal(run_kernel(backend, red, nir), ndvi_codes_reference(red, nir))
+
+def test_zero_denominator_is_nodata(backend):
+    red, nir = uint16_bands()
+    codes = run_kernel(backend, red, nir)
+    assert codes[0, 0] == 0
+    assert list(codes[0, 1:4]) == [255, 1, 128]
+
+def test_partial_chunk_matches_original_chain(backend):
+    red, nir = uint16_bands()
+    red, nir = red[:10, :7], nir[:10, :7]
+    assert np.array_equal(run_kernel(backend, red, nir, chunk_shape=(64, 96)), ndvi_codes_reference(red, nir))
@@ -0,0 +1,32 @@
+import os
+import sys
+import datetime as date
+import pytest
+
+pytest.importorskip('shapely')
+pytest.importorskip('pyproj')
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from raster_index_functions import add_rasters_to_index, set_date_mosaics, query_mosaic_index, query_index_dates
+
+MBR = 'POLYGON ((-117 34, -116 34, -116 35, -117 35, -117 34))'
+BOUNDS = [-117, 34, -116, 35]
+
+#Date folders as older runs named them, zero-padded or not
+@pytest.fixture
+def index_directory(tmp_path):
+    for dir_name in ['2023-01-04', '2023-1-5', '2023-01-10', '2023-2-1']:
+        add_rasters_to_index(str(tmp_path), dir_name, [('SCENE', MBR)])
+        set_date_mosaics(str(tmp_path), dir_name, [('mosaic_0.tif', BOUNDS)])
+    return str(tmp_path)
+
+def test_index_dates_match_non_padded_folders(index_directory):
+    dates = query_index_dates(index_directory, date.datetime(2023, 1, 5), date.datetime(2023, 1, 31))
+    assert dates == [date.datetime(2023, 1, 5), date.datetime(2023, 1, 10)]
+
+def test_mosaics_match_non_padded_folders_in_date_order(index_directory):
+    mosaics = query_mosaic_index(index_directory, BOUNDS, date.datetime(2023, 1, 1), date.datetime(2023, 12, 31))
+    assert [mosaic[0] for mosaic in mosaics] == [date.datetime(2023, 1, 4), date.datetime(2023, 1, 5),
+                                                 date.datetime(2023, 1, 10), date.datetime(2023, 2, 1)]
+    assert mosaics[1][2] == os.path.join(index_directory, '2023-1-5', 'mosaic_0.tif')
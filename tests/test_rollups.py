@@ -0,0 +1,61 @@
+import os
+import sys
+import datetime as date
+import numpy as np
+import pytest
+
+pytest.importorskip('shapely')
+pytest.importorskip('pyproj')
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from rollup_functions import composite_codes, rollup_period, whole_periods
+
+#Per-pixel statistics over the valid (non-zero) codes only, rounded to a whole code like the composites
+def expected_composite(stack):
+    shape = stack.shape[1:]
+    max_codes, mean_codes, median_codes, counts = (np.zeros(shape, dtype=np.int64) for _ in range(4))
+    for index in np.ndindex(shape):
+        valid = stack[(slice(None),) + index]
+        valid = valid[valid > 0]
+        counts[index] = len(valid)
+        if len(valid):
+            max_codes[index] = valid.max()
+            mean_codes[index] = np.rint(valid.mean())
+            median_codes[index] = np.rint(np.median(valid))
+    return max_codes, mean_codes, median_codes, counts
+
+@pytest.mark.parametrize('dates', [1, 2, 5, 6])
+def test_composite_codes_skip_nodata(dates):
+    rng = np.random.default_rng(dates)
+    stack = rng.integers(1, 256, (dates, 16, 16)).astype(np.uint8)
+    stack[rng.random(stack.shape) < 0.3] = 0
+    stack[:, 0, 0] = 0
+    for result, expected in zip(composite_codes(stack), expected_composite(stack)):
+        assert np.array_equal(result, expected)
+
+def test_composite_codes_of_an_all_nodata_pixel_are_zero():
+    stack = np.zeros((3, 1, 1), dtype=np.uint8)
+    assert [int(result[0, 0]) for result in composite_codes(stack)] == [0, 0, 0, 0]
+
+@pytest.mark.parametrize('level, curr_date, expected', [
+    ('month', date.datetime(2024, 2, 10), ('2024-02', date.datetime(2024, 2, 1), date.datetime(2024, 2, 29))),
+    ('month', date.datetime(2023, 12, 31), ('2023-12', date.datetime(2023, 12, 1), date.datetime(2023, 12, 31))),
+    ('season', date.datetime(2022, 12, 5), ('2023-DJF', date.datetime(2022, 12, 1), date.datetime(2023, 2, 28))),
+    ('season', date.datetime(2023, 2, 28), ('2023-DJF', date.datetime(2022, 12, 1), date.datetime(2023, 2, 28))),
+    ('season', date.datetime(2023, 8, 1), ('2023-JJA', date.datetime(2023, 6, 1), date.datetime(2023, 8, 31))),
+    ('year', date.datetime(2023, 7, 4), ('2023', date.datetime(2023, 1, 1), date.datetime(2023, 12, 31))),
+])
+def test_rollup_period(level, curr_date, expected):
+    assert rollup_period(level, curr_date) == expected
+
+def test_unknown_rollup_level():
+    with pytest.raises(ValueError):
+        rollup_period('week', date.datetime(2023, 1, 1))
+
+def test_whole_periods_leave_out_partial_periods():
+    months = whole_periods('month', date.datetime(2023, 1, 15), date.datetime(2023, 6, 30))
+    assert [period for period, start, end in months] == ['2023-02', '2023-03', '2023-04', '2023-05', '2023-06']
+    seasons = whole_periods('season', date.datetime(2023, 1, 1), date.datetime(2023, 12, 31))
+    assert [period for period, start, end in seasons] == ['2023-MAM', '2023-JJA', '2023-SON']
+    assert whole_periods('year', date.datetime(2023, 1, 2), date.datetime(2023, 12, 31)) == []
@@ -0,0 +1,65 @@
+import os
+import sys
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from manifest_functions import conversion_params, scene_record, scene_is_current
+
+MBR = 'POLYGON ((-117 34, -116 34, -116 35, -117 35, -117 34))'
+
+def write_file(path, content):
+    with open(path, 'wb') as file:
+        file.write(content)
+    return path
+
+#Moves a file's mtime without changing its content, as a copy or a touch would
+def touch_later(path):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+@pytest.fixture
+def scene(tmp_path):
+    band4 = write_file(str(tmp_path / 'SCENE_B4.TIF'), b'red')
+    band5 = write_file(str(tmp_path / 'SCENE_B5.TIF'), b'nir')
+    output_path = write_file(str(tmp_path / 'SCENE.tif'), b'ndvi')
+    return band4, band5, output_path, scene_record(band4, band5, output_path, conversion_params(), MBR)
+
+def test_unchanged_scene_is_current(scene):
+    band4, band5, output_path, record = scene
+    assert scene_is_current(record, band4, band5, output_path, conversion_params()) == (True, False)
+    assert scene_is_current(record, band4, band5, output_path, conversion_params(), verify=True) == (True, False)
+
+def test_missing_record_or_new_params_convert_again(scene):
+    band4, band5, output_path, record = scene
+    assert scene_is_current(None, band4, band5, output_path, conversion_params()) == (False, False)
+    assert scene_is_current(record, band4, band5, output_path, conversion_params('60', 'ZSTD', True)) == (False, False)
+
+def test_touched_input_with_same_content_is_refreshed(scene):
+    band4, band5, output_path, record = scene
+    touch_later(band5)
+    assert scene_is_current(record, band4, band5, output_path, conversion_params()) == (True, True)
+    assert record['inputs']['B5']['mtime_ns'] == os.stat(band5).st_mtime_ns
+    assert scene_is_current(record, band4, band5, output_path, conversion_params()) == (True, False)
+
+def test_changed_input_converts_again(scene):
+    band4, band5, output_path, record = scene
+    write_file(band4, b'RED')
+    touch_later(band4)
+    assert scene_is_current(record, band4, band5, output_path, conversion_params()) == (False, False)
+    write_file(band4, b'longer red')
+    assert scene_is_current(record, band4, band5, output_path, conversion_params()) == (False, False)
+
+def test_missing_files_convert_again(scene):
+    band4, band5, output_path, record = scene
+    os.remove(band5)
+    assert scene_is_current(record, band4, band5, output_path, conversion_params()) == (False, False)
+    os.remove(output_path)
+    assert scene_is_current(record, band4, band5, output_path, conversion_params()) == (False, False)
+
+#A same-size output is only caught by hashing it
+def test_verify_hashes_the_output(scene):
+    band4, band5, output_path, record = scene
+    write_file(output_path, b'NDVI')
+    assert scene_is_current(record, band4, band5, output_path, conversion_params()) == (True, False)
+    assert scene_is_current(record, band4, band5, output_path, conversion_params(), verify=True) == (False, False)
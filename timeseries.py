@@ -7,47 +7,159 @@ import logging
 # Add directories to sys.path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
 
-# Import functions
-from bounding_box_functions import *
-from ndvi_extraction_functions import *
-from ndvi_image_functions import *
-from time_series_functions import *
-from wkt_functions import *
+# Import functions. GDAL, geopandas, xarray and the server are only imported by the modes that use them.
+from time_series_functions import (ndvi_timeseries_point, ndvi_timeseries_points, ndvi_timeseries_range, ndvi_timeseries_features,
+                                   ndvi_rollup_point, ndvi_rollup_range, datacube_timeseries_point, datacube_region,
+                                   read_points_table, read_features_table)
+from rollup_functions import choose_rollup_level, ROLLUP_LEVELS, ROLLUP_BANDS
+from wkt_functions import wkt_to_bounds
+from resource_cache import log_cache_stats
+from disk_block_cache import enable_disk_block_cache
+from metrics import enable_metrics, log_metrics_summary, profile_run, PROFILERS
 from log_config import logger, console_handler
-def handle_point_timeseries(lat, lon, start_date, end_date, ndvi_dir):
+def handle_point_timeseries(lat, lon, start_date, end_date, ndvi_dir, workers=1, use_processes=False, resolution='day'):
     try:
-        time_series_point = ndvi_timeseries_point(lat, lon, start_date, end_date, ndvi_dir)
-        file_name = f"{start_date.date()}_to_{end_date.date()}_at_Longitude_{lon}_and_Latitude_{lat}.csv"
+        if resolution == 'day':
+            time_series_point = ndvi_timeseries_point(lat, lon, start_date, end_date, ndvi_dir, workers, use_processes=use_processes)
+            file_name = f"{start_date.date()}_to_{end_date.date()}_at_Longitude_{lon}_and_Latitude_{lat}.csv"
+        else:
+            time_series_point = ndvi_rollup_point(lat, lon, start_date, end_date, ndvi_dir, resolution, workers, use_processes=use_processes)
+            file_name = f"{start_date.date()}_to_{end_date.date()}_{resolution}_at_Longitude_{lon}_and_Latitude_{lat}.csv"
         time_series_point.to_csv(file_name, index=False)
         logger.info(f"Point time series saved to {file_name}")
         logger.debug(f"Time series data: {time_series_point}")
     except Exception as e:
         logger.error(f"Error processing point time series: {e}")
 
-def handle_range_timeseries(wkt, start_date, end_date, ndvi_dir):
+def handle_datacube_point_timeseries(lat, lon, start_date, end_date, store_path):
+    try:
+        time_series_point = datacube_timeseries_point(lat, lon, start_date, end_date, store_path)
+        file_name = f"{start_date.date()}_to_{end_date.date()}_at_Longitude_{lon}_and_Latitude_{lat}.csv"
+        time_series_point.to_csv(file_name, index=False)
+        logger.info(f"Point time series from the datacube saved to {file_name}")
+        logger.debug(f"Time series data: {time_series_point}")
+    except Exception as e:
+        logger.error(f"Error processing datacube point time series: {e}")
+
+def handle_datacube_range(wkt, start_date, end_date, store_path):
+    try:
+        region = datacube_region(wkt, start_date, end_date, store_path)
+        mbr = wkt_to_bounds(wkt)
+        file_name = f"{start_date.date()}_to_{end_date.date()}_at_{mbr}.zarr"
+        region.to_dataset(name='ndvi').to_zarr(file_name, mode='w', zarr_format=2)
+        logger.info(f"NDVI history of {region.sizes['y'] * region.sizes['x']} pixels over {region.sizes['time']} dates saved to {file_name}")
+    except Exception as e:
+        logger.error(f"Error processing datacube range: {e}")
+
+def handle_batch_timeseries(points_path, start_date, end_date, ndvi_dir, workers=1, use_processes=False):
+    try:
+        points_df = read_points_table(points_path)
+        time_series_points = ndvi_timeseries_points(points_df, start_date, end_date, ndvi_dir, workers, use_processes=use_processes)
+        points_name = os.path.splitext(os.path.basename(points_path))[0]
+        file_name = f"{start_date.date()}_to_{end_date.date()}_at_points_{points_name}.csv"
+        time_series_points.to_csv(file_name, index=False)
+        logger.info(f"Batch point time series for {len(points_df)} points saved to {file_name}")
+        logger.debug(f"Time series data: {time_series_points}")
+    except Exception as e:
+        logger.error(f"Error processing batch point time series: {e}")
+
+def handle_features_timeseries(features_path, start_date, end_date, ndvi_dir, id_column=None, workers=1, use_processes=False):
+    try:
+        features_gdf = read_features_table(features_path, id_column)
+        time_series_features = ndvi_timeseries_features(features_gdf, start_date, end_date, ndvi_dir, workers, use_processes=use_processes)
+        features_name = os.path.splitext(os.path.basename(features_path))[0]
+        file_name = f"{start_date.date()}_to_{end_date.date()}_at_features_{features_name}.csv"
+        time_series_features.to_csv(file_name, index=False)
+        logger.info(f"Range time series for {len(features_gdf)} features saved to {file_name}")
+        logger.debug(f"Time series data: {time_series_features}")
+    except Exception as e:
+        logger.error(f"Error processing feature collection time series: {e}")
+
+def handle_range_timeseries(wkt, start_date, end_date, ndvi_dir, workers=1, use_processes=False, resolution='day', composite='median'):
     try:
-        time_series_range = ndvi_timeseries_range(wkt, start_date, end_date, ndvi_dir)
         mbr = wkt_to_bounds(wkt)
-        file_name = f"{start_date.date()}_to_{end_date.date()}_at_{mbr}.csv"
+        if resolution == 'day':
+            time_series_range = ndvi_timeseries_range(wkt, start_date, end_date, ndvi_dir, workers, use_processes=use_processes)
+            file_name = f"{start_date.date()}_to_{end_date.date()}_at_{mbr}.csv"
+        else:
+            time_series_range = ndvi_rollup_range(wkt, start_date, end_date, ndvi_dir, resolution, composite, workers, use_processes=use_processes)
+            file_name = f"{start_date.date()}_to_{end_date.date()}_{resolution}_{composite}_at_{mbr}.csv"
         time_series_range.to_csv(file_name, index=False)
         logger.info(f"Range time series saved to {file_name}")
         logger.debug(f"Time series data: {time_series_range}")
     except Exception as e:
         logger.error(f"Error processing range time series: {e}")
 
+def run_queries(args, ndvi_dir, start_date, end_date):
+    resolution = args.resolution
+    if resolution == 'auto':
+        resolution = choose_rollup_level(start_date, end_date, ndvi_dir)
+        logger.info(f"Answering from the {resolution} level")
+    if resolution != 'day' and (args.batch or args.features or args.datacube):
+        logger.warning("--resolution only applies to point and range time series, the other queries read every date")
+
+    if args.point and args.datacube:
+        latitude, longitude = args.point
+        handle_datacube_point_timeseries(latitude, longitude, start_date, end_date, args.datacube)
+    elif args.point:
+        latitude, longitude = args.point
+        handle_point_timeseries(latitude, longitude, start_date, end_date, ndvi_dir, args.workers, args.processes, resolution)
+
+    if args.batch:
+        if os.path.isfile(args.batch):
+            handle_batch_timeseries(args.batch, start_date, end_date, ndvi_dir, args.workers, args.processes)
+        else:
+            logger.warning(f"The points file {args.batch} does not exist.")
+
+    if args.features:
+        if os.path.isfile(args.features):
+            handle_features_timeseries(args.features, start_date, end_date, ndvi_dir, args.id_column, args.workers, args.processes)
+        else:
+            logger.warning(f"The features file {args.features} does not exist.")
+
+    if args.wkt:
+        wkt_path = args.wkt
+        if os.path.isfile(wkt_path):
+            with open(wkt_path, 'r') as file:
+                wkt_string = file.read()
+            if args.datacube:
+                handle_datacube_range(wkt_string, start_date, end_date, args.datacube)
+            else:
+                handle_range_timeseries(wkt_string, start_date, end_date, ndvi_dir, args.workers, args.processes, resolution, args.composite)
+        else:
+            logger.warning(f"The WKT file {wkt_path} does not exist.")
+
 def main():
     parser = argparse.ArgumentParser(description='NDVI Image and Time Series Processing')
     parser.add_argument('-i', '--input', metavar='input_directory', type=str, required=True, help='Input directory of NDVI images')
     parser.add_argument('-p', '--point', nargs=2, metavar=('latitude', 'longitude'), type=float, help='Latitude and Longitude for point time series')
+    parser.add_argument('-b', '--batch', metavar='points_file', type=str, help='Path to CSV or Parquet file with ID, Latitude and Longitude columns for batch point time series')
     parser.add_argument('-w', '--wkt', metavar='wkt_file', type=str, help='Path to WKT file for range time series')
-    parser.add_argument('-s', '--start', metavar='start_date', type=str, required=True, help='Start date in YYYY-MM-DD format')
-    parser.add_argument('-e', '--end', metavar='end_date', type=str, required=True, help='End date in YYYY-MM-DD format')
+    parser.add_argument('-f', '--features', metavar='features_file', type=str, help='Path to GeoPackage, GeoJSON or shapefile of polygons for range time series of every feature')
+    parser.add_argument('--id-column', metavar='column', type=str, help='Feature ID column of the features file (default: ID, or the row number)')
+    parser.add_argument('-s', '--start', metavar='start_date', type=str, help='Start date in YYYY-MM-DD format')
+    parser.add_argument('-e', '--end', metavar='end_date', type=str, help='End date in YYYY-MM-DD format')
+    parser.add_argument('--resolution', choices=['day'] + ROLLUP_LEVELS + ['auto'], default='day', help='Time step of point and range time series, read from the rollups built by process_ndvi.py --rollups; auto takes the coarsest built level that fits the range (default: day)')
+    parser.add_argument('--composite', choices=list(ROLLUP_BANDS), default='median', help='Per-pixel composite the range statistics of a rollup are taken over (default: median)')
+    parser.add_argument('--workers', metavar='num_workers', type=int, default=1, help='Number of dates processed in parallel (default: 1)')
+    parser.add_argument('--processes', action='store_true', help='Use worker processes instead of threads for --workers')
+    parser.add_argument('-c', '--datacube', metavar='store_path', type=str, help='Read point time series and per-pixel range history from a datacube written by process_ndvi.py')
+    parser.add_argument('--cache-dir', metavar='cache_directory', type=str, help='Directory for a persistent cache of decoded image blocks')
+    parser.add_argument('--cache-size', metavar='megabytes', type=int, default=1024, help='Size budget of the block cache in MB (default: 1024)')
+    parser.add_argument('--serve', action='store_true', help='Answer point and range time series requests over HTTP instead of running one query')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address the server listens on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='Port the server listens on (default: 8765)')
+    parser.add_argument('--socket', metavar='socket_path', type=str, help='Listen on this Unix socket instead of a TCP port')
+    parser.add_argument('--batch-window', metavar='milliseconds', type=float, default=5, help='How long the server waits to batch concurrent point requests (default: 5)')
+    parser.add_argument('--metrics', metavar='metrics_file', type=str, help='Write per-stage timings, byte counts and pool utilization to this JSON-lines file')
+    parser.add_argument('--profile', metavar='profile_file', type=str, help='Profile the queries and write the profile to this file')
+    parser.add_argument('--profiler', choices=PROFILERS, default='cprofile', help='Profiler used by --profile (default: cprofile)')
     parser.add_argument('-q', '--quiet', action='store_true', help='Turns off Messages until WARNING LEVEL')
     args = parser.parse_args()
+    if not args.serve and (args.start is None or args.end is None):
+        parser.error('the following arguments are required: -s/--start, -e/--end')
 
     ndvi_dir = args.input
-    start_date = date.datetime.strptime(args.start, '%Y-%m-%d')
-    end_date = date.datetime.strptime(args.end, '%Y-%m-%d')
 
     quiet = args.quiet
     if quiet:
@@ -55,18 +167,23 @@ def main():
     else:
         console_handler.setLevel(logging.DEBUG)
     
-    if args.point:
-        latitude, longitude = args.point
-        handle_point_timeseries(latitude, longitude, start_date, end_date, ndvi_dir)
+    if args.cache_dir:
+        enable_disk_block_cache(args.cache_dir, args.cache_size * 1024 * 1024)
 
-    if args.wkt:
-        wkt_path = args.wkt
-        if os.path.isfile(wkt_path):
-            with open(wkt_path, 'r') as file:
-                wkt_string = file.read()
-            handle_range_timeseries(wkt_string, start_date, end_date, ndvi_dir)
+    if args.metrics:
+        enable_metrics(args.metrics)
+
+    with profile_run(args.profile, args.profiler):
+        if args.serve:
+            from query_server import serve_timeseries
+            serve_timeseries(ndvi_dir, args.host, args.port, args.socket, max(args.workers, 1), args.batch_window / 1000)
         else:
-            logger.warning(f"The WKT file {wkt_path} does not exist.")
+            start_date = date.datetime.strptime(args.start, '%Y-%m-%d')
+            end_date = date.datetime.strptime(args.end, '%Y-%m-%d')
+            run_queries(args, ndvi_dir, start_date, end_date)
+
+    log_cache_stats()
+    log_metrics_summary()
     
     
         